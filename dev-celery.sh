@@ -1,2 +1,2 @@
 #!/bin/sh
-exec celery worker -A luohua.tasks.celery --loglevel=INFO
+exec celery worker -A luohua.tasks.celery -B --loglevel=INFO
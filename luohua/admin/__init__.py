@@ -19,5 +19,30 @@
 
 from __future__ import unicode_literals, division
 
+__all__ = [
+        'install_cache_publisher',
+        ]
+
+from ..rt import cachesync
+from ..utils import dblayer
+
+
+def install_cache_publisher():
+    '''让本进程保存或删除文档时通知其他进程丢掉缓存.
+
+    管理脚本不跑 gevent 的事件循环, 所以与 Celery worker 一样只发送通知,
+    不接收. 本进程已经装上了缓存一致性机制 (例如在应用服务器里调用管理
+    函数) 的话什么都不做.
+
+    '''
+
+    if dblayer.get_cache_coherence() is None:
+        cachesync.install(listen=False)
+
+
+# 导入任何管理模块时都装上, 否则在这里修改的用户, 角色等文档要等缓存过期
+# 才会在各 worker 进程中生效
+install_cache_publisher()
+
 
 # vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
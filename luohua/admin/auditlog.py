@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 管理工具 / 审计记录查询
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division, print_function
+
+__all__ = [
+        'compact_closed_partitions',
+        'dump_audit_log',
+        'main',
+        ]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from weiyu.helpers.misc import smartstr
+
+from ..auth import audit
+from ..auth import auditarchive
+from ..auth.auditquery import AuditQuery
+
+# 命令行接受的日期时间格式, 按本地时间解释
+_DATETIME_FORMATS = (
+        '%Y-%m-%d %H:%M:%S',
+        '%Y-%m-%dT%H:%M:%S',
+        '%Y-%m-%d',
+        )
+
+
+def dump_audit_log(query, out, limit=None, cursor=None):
+    '''把符合条件的审计记录逐行以 JSON 格式写到 ``out``.
+
+    记录是边查询边输出的, 查询结果再多也不会堆在内存里.
+
+    :param query: 查询条件.
+    :type query: :class:`AuditQuery <luohua.auth.auditquery.AuditQuery>`
+    :param out: 输出的文件对象.
+    :param limit: 最多输出的记录条数, :const:`None` 表示不限.
+    :type limit: int
+    :param cursor: 从哪条记录之后开始, 见
+            :func:`encode_cursor <luohua.auth.auditquery.encode_cursor>`.
+    :type cursor: :data:`six.text_type`
+    :return: 输出的记录条数.
+    :rtype: int
+
+    '''
+
+    count = 0
+    for entry in query.iter_entries(cursor):
+        if limit is not None and count >= limit:
+            break
+
+        record = entry.copy()
+        out.write(json.dumps(record, sort_keys=True) + '\n')
+        count += 1
+
+    return count
+
+
+def compact_closed_partitions():
+    '''压缩所有已经结束足够久, 但还没压缩的审计记录分区.
+
+    适合定期执行, 已经压缩过的分区会被跳过.
+
+    :return: 分区名到压缩统计数据的映射, 统计数据格式见
+            :meth:`AuditArchive.compact
+            <luohua.auth.auditarchive.AuditArchive.compact>`.
+    :rtype: dict
+
+    '''
+
+    archive = auditarchive.AuditArchive()
+    deadline = time.time() - auditarchive.AUDIT_COMPACT_GRACE_SECS
+    last_open = audit.partition_of_ts(deadline)
+
+    results = {}
+    for partition in audit.iter_partitions(None, deadline):
+        if audit.next_partition(partition) > last_open:
+            break
+        if archive.load_manifest(partition) is not None:
+            continue
+
+        results[partition] = archive.compact(partition)
+
+    return results
+
+
+def _parse_time(value):
+    if value.isdigit():
+        return int(value)
+
+    for fmt in _DATETIME_FORMATS:
+        try:
+            return int(time.mktime(time.strptime(value, fmt)))
+        except ValueError:
+            pass
+
+    raise argparse.ArgumentTypeError('invalid time: %s' % (value, ))
+
+
+def _make_parser():
+    parser = argparse.ArgumentParser(
+            prog='python -m luohua.admin.auditlog',
+            description='查询审计记录, 每行输出一条 JSON.',
+            )
+    parser.add_argument('--uid', help='操作者的用户 ID')
+    parser.add_argument('--module', help='产生记录的模块名')
+    parser.add_argument('--type', help='事件类型')
+    parser.add_argument('--group', help='记录组')
+    parser.add_argument(
+            '--since',
+            type=_parse_time,
+            help='起始时间, Unix 时间戳或 YYYY-MM-DD[ HH:MM:SS]',
+            )
+    parser.add_argument(
+            '--until',
+            type=_parse_time,
+            help='结束时间, 格式同 --since',
+            )
+    parser.add_argument('--limit', type=int, help='最多输出的记录条数')
+    parser.add_argument('--cursor', help='从这个游标之后开始')
+    parser.add_argument(
+            '--compact',
+            action='store_true',
+            help='不查询, 而是压缩所有已结束的分区',
+            )
+
+    return parser
+
+
+def main(argv=None):
+    args = _make_parser().parse_args(argv)
+
+    # 与 Celery worker 一样, 走到项目根目录初始化微雨框架
+    from weiyu import init
+    os.chdir(os.path.join(os.path.dirname(__file__), '../..'))
+    init.boot()
+
+    if args.compact:
+        results = compact_closed_partitions()
+        for partition in sorted(results):
+            print(json.dumps({partition: results[partition]}))
+        return 0
+
+    def _arg(value):
+        return smartstr(value) if value is not None else None
+
+    query = AuditQuery(
+            _arg(args.uid),
+            _arg(args.module),
+            _arg(args.type),
+            _arg(args.group),
+            args.since,
+            args.until,
+            )
+    dump_audit_log(query, sys.stdout, args.limit, _arg(args.cursor))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
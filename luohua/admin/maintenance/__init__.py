@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 管理工具 / 维护操作 / 包
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'resync_2i',
+        ]
+
+
+def resync_2i(doc_cls):
+    '''重新保存某类文档的所有对象, 以按照当前的实现重建它们的 2i 索引.
+
+    新增索引之后, 已有的对象只有在下一次保存时才会带上新索引; 部署新版本后
+    可以用这个函数一次性补齐.
+
+    :param doc_cls: 欲处理的文档类, 如
+            :class:`VThread <luohua.datastructures.vthread.VThread>`.
+    :type doc_cls: :class:`RiakDocument <luohua.utils.dblayer.RiakDocument>`
+            的子类
+    :return: 处理失败的对象列表, 每条记录形如 ``(对象, 抛出的异常, )``
+    :rtype: list
+
+    '''
+
+    assert doc_cls.uses_2i
+
+    failures = []
+
+    with doc_cls.storage as conn:
+        for obj in doc_cls.find_all():
+            try:
+                obj.save_to_conn(conn)
+            except Exception as e:
+                failures.append((obj, e, ))
+
+    return failures
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -43,6 +43,9 @@ def require_login(fn):
 
 
 def require_cap(cap):
+    # 权限名的合法性只在装饰时检查一次, 非法的话这里就会抛异常
+    role.has_cap((), cap)
+
     def _decorator_(fn):
         def _wrapped_(fn, request, *args, **kwargs):
             # 同上, 需要 session user 中间件
@@ -50,7 +53,7 @@ def require_cap(cap):
             if user is None:
                 return acl.EACCES_reply(request._user_check_fail_reason)
 
-            if not role.has_cap(user.caps, cap):
+            if cap not in user.caps:
                 return acl.EACCES_reply(2)
 
             return fn(request, *args, **kwargs)
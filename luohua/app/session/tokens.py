@@ -20,6 +20,7 @@
 from __future__ import unicode_literals, division
 
 __all__ = [
+        'get_token_ttl',
         'new_token_string',
         'query_token',
         'allocate_token',
@@ -27,40 +28,212 @@ __all__ = [
         'revoke_token',
         'purge_token',
         'user_from_token',
+        'sweep_tokens',
         ]
 
+import json
 import time
 
-from weiyu.db import db_hub
-
 from ...auth import audit
 from ...auth import user
 from ...utils import randomness
+from ...utils import redispool
 
 SESSION_TOKENS_STORAGE_ID = 'luohua.app.session.tokens'
 TOKEN_STRING_LENGTH = 64
-TOKENS_HASH_KEY = 'hash:tokens'
-TOKEN_KEY_FORMAT = 'token:{typ}:{uid}:{addr}'
 
-_CLIENT_CACHE = []
+# 每个用户一个 (类型, IP)-token 映射的 hash, 随其中的 token 一起过期
+USER_TOKENS_KEY_PREFIX = 'tokens:user:'
+USER_TOKENS_KEY_FORMAT = USER_TOKENS_KEY_PREFIX + '{uid}'
+TOKEN_FIELD_FORMAT = '{typ}:{addr}'
+
+# 旧版的全局映射, 现在只由 sweep_tokens 迁移和清理
+LEGACY_TOKENS_HASH_KEY = 'hash:tokens'
+
+# 各类型 token 的有效期 (秒). 每次请求到已有 token 时会续期
+TOKEN_TTLS = {
+        'login': 30 * 86400,
+        }
+DEFAULT_TOKEN_TTL = 86400
+
+# 清理时每批处理的映射条目数
+SWEEP_BATCH_SIZE = 100
+
+# 查找或新建 token, 并为 token 和映射续期.
+# 查找和新建在同一个脚本里, 所以中间不会有别的请求插进来
+# KEYS: 用户的映射 hash, 新 token
+# ARGV: 映射中的字段名, 是否无视已有 token 强制新建 ('1' 或 '0'), 有效期,
+#       以及新 token 的类型, 创建时间, 远端地址, UID
+# 返回: {token, 是否新建 (1 或 0)}
+_ALLOCATE_SCRIPT = '''
+local token = redis.call('HGET', KEYS[1], ARGV[1])
+local allocated = 0
+if ARGV[2] == '1' or not token or redis.call('EXISTS', token) == 0 then
+    token = KEYS[2]
+    allocated = 1
+    redis.call(
+            'HMSET', token,
+            'type', ARGV[4],
+            'ctime', ARGV[5],
+            'remote_addr', ARGV[6],
+            'uid', ARGV[7])
+    redis.call('HSET', KEYS[1], ARGV[1], token)
+end
+
+-- 映射的有效期取其中所有 token 的最大值
+local ttl = tonumber(ARGV[3])
+redis.call('EXPIRE', token, ttl)
+if redis.call('TTL', KEYS[1]) < ttl then
+    redis.call('EXPIRE', KEYS[1], ttl)
+end
+return {token, allocated}
+'''
+
+# 验证并删除 token
+# KEYS: token
+# ARGV: 要求的 token 类型和 UID, 空串表示不检查; 映射 hash 的键名前缀
+# 返回: {状态, token 的全部字段...}. 状态 0 为已删除; 1 为 token 不存在或
+#       类型不符, 此时不返回字段; 2 为 UID 不符
+# 映射的键名和字段名按 token 的内容推算, 与 USER_TOKENS_KEY_FORMAT 和
+# TOKEN_FIELD_FORMAT 一致. 映射只在仍然指向这个 token 时才删除, 以免误删
+# 后来分配的 token
+_REVOKE_SCRIPT = '''
+local data = redis.call('HGETALL', KEYS[1])
+if #data == 0 then
+    return {1}
+end
+
+local token = {}
+for i = 1, #data, 2 do
+    token[data[i]] = data[i + 1]
+end
+
+if ARGV[1] ~= '' and token['type'] ~= ARGV[1] then
+    return {1}
+end
+if ARGV[2] ~= '' and token['uid'] ~= ARGV[2] then
+    return {2, unpack(data)}
+end
+
+local mapping = ARGV[3] .. token['uid']
+local field = token['type'] .. ':' .. token['remote_addr']
+if redis.call('HGET', mapping, field) == KEYS[1] then
+    redis.call('HDEL', mapping, field)
+end
+redis.call('DEL', KEYS[1])
+return {0, unpack(data)}
+'''
+
+# 删除用户映射中指向已过期 token 的字段
+# KEYS: 用户的映射 hash
+# 返回: {检查的字段数, 删除的字段数}
+_SWEEP_SCRIPT = '''
+local data = redis.call('HGETALL', KEYS[1])
+local reclaimed = 0
+for i = 1, #data, 2 do
+    if redis.call('EXISTS', data[i + 1]) == 0 then
+        redis.call('HDEL', KEYS[1], data[i])
+        reclaimed = reclaimed + 1
+    end
+end
+return {#data / 2, reclaimed}
+'''
+
+# 把旧版全局映射中的条目迁移到用户映射, 同时给旧 token 补上有效期.
+# 有效期按创建时间计算, 已经过期的 token 直接删除
+# KEYS: 旧版全局映射
+# ARGV: 用户映射的键名前缀, 各类型有效期 (JSON), 默认有效期, 当前时间,
+#       以及要迁移的字段名...
+# 返回: {迁移的条目数, 删除的条目数}
+_MIGRATE_SCRIPT = '''
+local ttls = cjson.decode(ARGV[2])
+local default_ttl = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local migrated = 0
+local reclaimed = 0
+
+for i = 5, #ARGV do
+    local token = redis.call('HGET', KEYS[1], ARGV[i])
+    if token then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+
+        local data = redis.call(
+                'HMGET', token,
+                'type', 'ctime', 'remote_addr', 'uid')
+        local ttl = 0
+        if data[1] then
+            ttl = (ttls[data[1]] or default_ttl)
+                    - (now - (tonumber(data[2]) or now))
+        end
+
+        if ttl <= 0 then
+            redis.call('DEL', token)
+            reclaimed = reclaimed + 1
+        else
+            if redis.call('TTL', token) == -1 then
+                redis.call('EXPIRE', token, ttl)
+            end
+
+            -- 迁移期间新分配的 token 优先
+            local mapping = ARGV[1] .. data[4]
+            redis.call('HSETNX', mapping, data[1] .. ':' .. data[3], token)
+            if redis.call('TTL', mapping) < ttl then
+                redis.call('EXPIRE', mapping, ttl)
+            end
+            migrated = migrated + 1
+        end
+    end
+end
+return {migrated, reclaimed}
+'''
+
+REVOKE_OK = 0
+REVOKE_NOT_FOUND = 1
+REVOKE_UID_MISMATCH = 2
+
+# 脚本源码 -> 注册好的脚本对象
+_SCRIPT_CACHE = {}
 
 
 def _get_redis():
     '''获取 StrictRedis 客户端对象.'''
 
-    # XXX 这一段的形式跟 rt.pubsub 的相应部分几乎一样... 该重构
+    return redispool.get_client(SESSION_TOKENS_STORAGE_ID)
+
+
+def _get_script(source):
+    '''获取注册好的 Lua 脚本对象.
+
+    脚本对象第一次调用时用 ``EVALSHA``, 服务器上没有缓存再退回 ``EVAL``,
+    所以每个操作都只需要一次往返.
+
+    '''
+
     try:
-        return _CLIENT_CACHE[0]
-    except IndexError:
+        return _SCRIPT_CACHE[source]
+    except KeyError:
         pass
 
-    client = db_hub.get_storage(SESSION_TOKENS_STORAGE_ID).raw()
-    _CLIENT_CACHE.append(client)
-    return client
+    script = _SCRIPT_CACHE[source] = _get_redis().register_script(source)
+    return script
+
+
+def _pairs_to_dict(values):
+    return dict(zip(values[::2], values[1::2]))
+
+
+def _get_user_tokens_key(uid):
+    return USER_TOKENS_KEY_FORMAT.format(uid=uid)
 
 
-def _get_token_hash_key(typ, remote_addr, uid):
-    return TOKEN_KEY_FORMAT.format(typ=typ, uid=uid, addr=remote_addr)
+def _get_token_field(typ, remote_addr):
+    return TOKEN_FIELD_FORMAT.format(typ=typ, addr=remote_addr)
+
+
+def get_token_ttl(typ):
+    '''返回给定类型 token 的有效期 (秒).'''
+
+    return TOKEN_TTLS.get(typ, DEFAULT_TOKEN_TTL)
 
 
 def new_token_string():
@@ -79,13 +252,10 @@ def query_token(typ, token):
     return result
 
 
-def allocate_token(request, typ, uid):
-    '''为指定用户新建一个给定类型的 token.'''
-
+def _allocate(request, typ, uid, force):
     curtime = int(time.time())
 
     token = new_token_string()
-    hash_key = _get_token_hash_key(typ, request.remote_addr, uid)
     token_data = {
             'type': typ,
             'ctime': curtime,
@@ -93,21 +263,36 @@ def allocate_token(request, typ, uid):
             'uid': uid,
             }
 
-    conn = _get_redis()
-    with conn.pipeline() as pipe:
-        # 记录 token
-        pipe.hmset(token, token_data)
+    # 记录 token 并设置 (类型, IP)-token 映射, 不强制新建时已有的 token 优先
+    token, allocated = _get_script(_ALLOCATE_SCRIPT)(
+            keys=[_get_user_tokens_key(uid), token, ],
+            args=[
+                _get_token_field(typ, request.remote_addr),
+                '1' if force else '0',
+                get_token_ttl(typ),
+                typ,
+                curtime,
+                request.remote_addr,
+                uid,
+                ],
+            )
 
-        # 设置 (IP, UID)-token 映射
-        pipe.hset(TOKENS_HASH_KEY, hash_key, token)
+    if allocated:
+        # 记录审计事件
+        record = AllocateTokenAction(
+                request,
+                token=token,
+                token_data=token_data,
+                )
+        record.save()
 
-        pipe.execute()
+    return token
 
-    # 记录审计事件
-    record = AllocateTokenAction(request, token=token, token_data=token_data)
-    record.save()
 
-    return token
+def allocate_token(request, typ, uid):
+    '''为指定用户新建一个给定类型的 token.'''
+
+    return _allocate(request, typ, uid, True)
 
 
 def request_token(request, typ, uid):
@@ -116,71 +301,41 @@ def request_token(request, typ, uid):
 
     '''
 
-    hash_key = _get_token_hash_key(typ, request.remote_addr, uid)
-
     # 记录审计事件
     record = RequestTokenAction(request, type=typ, uid=uid)
     record.save()
 
-    # 取 token
-    conn = _get_redis()
-    # 因为 allocate_token() 里使用了 pipeline,
-    # 所以这里 token 的记录和映射的更新过程是原子的, 直接取就好了
-    maybe_token = conn.hget(TOKENS_HASH_KEY, hash_key)
-    if maybe_token is not None:
-        # 已经有一个此 IP / UID 对应的 token, 返回
-        return maybe_token
-
-    return allocate_token(request, typ, uid)
+    # 查找和新建在同一个 Lua 脚本里完成, 只需一次往返, 也没有竞争
+    return _allocate(request, typ, uid, False)
 
 
 def revoke_token(request, typ, uid, token):
     '''销毁一个给定用户创建的给定类型的 token.'''
 
-    conn = _get_redis()
-    token_data = query_token(typ, token)
-    if token_data is None:
-        # 所请求的 token 不存在或类型不正确
-        record = RevokeTokenFailedAction(
-                request,
-                token=token,
-                token_data=None,
-                type=typ,
-                uid=uid,
-                )
-        record.save()
-        return False
-
-    # 验证权限
     # TODO: 让某角色的用户可以代替其他用户删除他们的 token?
-    if token_data['uid'] != uid:
-        # 操作用户不匹配
+    # 验证类型和用户, 以及删除, 都在同一个 Lua 脚本里完成
+    result = _get_script(_REVOKE_SCRIPT)(
+            keys=[token, ],
+            args=[typ, uid, USER_TOKENS_KEY_PREFIX, ],
+            )
+    status, token_data = result[0], _pairs_to_dict(result[1:])
+
+    if status != REVOKE_OK:
+        # 所请求的 token 不存在, 类型不正确, 或者操作用户不匹配
         record = RevokeTokenFailedAction(
                 request,
                 token=token,
-                token_data=token_data,
+                token_data=(
+                    token_data
+                    if status == REVOKE_UID_MISMATCH
+                    else None
+                    ),
                 type=typ,
                 uid=uid,
                 )
         record.save()
         return False
 
-    # 验证类型是否匹配
-    if token_data['type'] != typ:
-        # 欲删除 token 类型不匹配
-        record = RevokeTokenFailedAction(
-            request,
-            token=token,
-            token_data=token_data,
-            type=typ,
-            uid=uid,
-            )
-        record.save()
-        return False
-
-    remote_addr = token_data['remote_addr']
-    hash_key = _get_token_hash_key(typ, remote_addr, uid)
-
     # 记录审计事件
     record = RevokeTokenAction(
             request,
@@ -191,26 +346,23 @@ def revoke_token(request, typ, uid, token):
             )
     record.save()
 
-    purge_token(token, hash_key)
     return True
 
 
-def purge_token(token, hash_key=None):
+def purge_token(token):
     '''删除给定的 token.
 
     注意: 这个操作没有日志记录, 仅适用于系统检测到不一致状态时,
     用来销毁不一致的数据, 或其他内部用途.
 
-    '''
+    映射只在仍然指向这个 token 时才会被删除.
 
-    conn = _get_redis()
-    with conn.pipeline() as pipe:
-        pipe.delete(token)
-
-        if hash_key is not None:
-            pipe.hdel(TOKENS_HASH_KEY, hash_key)
+    '''
 
-        pipe.execute()
+    _get_script(_REVOKE_SCRIPT)(
+            keys=[token, ],
+            args=['', '', USER_TOKENS_KEY_PREFIX, ],
+            )
 
 
 def user_from_token(typ, token):
@@ -229,12 +381,94 @@ def user_from_token(typ, token):
     usr = user.User.fetch(tok['uid'])
     if usr is None:
         # token 指定的用户不存在... 销毁 token
-        tokens.purge_token(token)
+        purge_token(token)
         return None
 
     return usr
 
 
+def _sweep_legacy(conn, batch_size, stats):
+    script = _get_script(_MIGRATE_SCRIPT)
+    fixed_args = [
+            USER_TOKENS_KEY_PREFIX,
+            json.dumps(TOKEN_TTLS),
+            DEFAULT_TOKEN_TTL,
+            int(time.time()),
+            ]
+
+    def _migrate(fields):
+        migrated, reclaimed = script(
+                keys=[LEGACY_TOKENS_HASH_KEY, ],
+                args=fixed_args + fields,
+                )
+        stats['legacy_migrated'] += migrated
+        stats['legacy_reclaimed'] += reclaimed
+
+    fields = []
+    for field, _ in conn.hscan_iter(LEGACY_TOKENS_HASH_KEY, count=batch_size):
+        fields.append(field)
+        if len(fields) >= batch_size:
+            _migrate(fields)
+            fields = []
+
+    if fields:
+        _migrate(fields)
+
+
+def _sweep_users(conn, batch_size, stats):
+    script = _get_script(_SWEEP_SCRIPT)
+
+    def _sweep(keys):
+        with conn.pipeline(transaction=False) as pipe:
+            for key in keys:
+                script(keys=[key, ], client=pipe)
+            results = pipe.execute()
+
+        stats['mappings'] += len(keys)
+        for checked, reclaimed in results:
+            stats['checked'] += checked
+            stats['reclaimed'] += reclaimed
+
+    keys = []
+    pattern = USER_TOKENS_KEY_PREFIX + '*'
+    for key in conn.scan_iter(match=pattern, count=batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            _sweep(keys)
+            keys = []
+
+    if keys:
+        _sweep(keys)
+
+
+def sweep_tokens(batch_size=SWEEP_BATCH_SIZE):
+    '''清理会话 token 映射, 返回统计信息.
+
+    token 本身到期后由 Redis 删除, 但用户映射 hash 的有效期取的是其中
+    最晚过期的 token, 所以会残留指向已过期 token 的字段. 这个函数删除这些
+    字段, 并把旧版全局映射 ``hash:tokens`` 中的条目迁移到用户映射.
+
+    返回的 ``dict`` 中, ``mappings`` 和 ``checked`` 分别是检查过的用户映射
+    和字段数, ``reclaimed`` 是删除的字段数; ``legacy_migrated`` 和
+    ``legacy_reclaimed`` 是旧版映射中迁移和因过期而删除的条目数.
+
+    '''
+
+    conn = _get_redis()
+    stats = {
+            'mappings': 0,
+            'checked': 0,
+            'reclaimed': 0,
+            'legacy_migrated': 0,
+            'legacy_reclaimed': 0,
+            }
+
+    _sweep_legacy(conn, batch_size, stats)
+    _sweep_users(conn, batch_size, stats)
+
+    return stats
+
+
 # 审计事件
 class BaseSessionTokenAction(audit.BaseAuditedAction):
     MODULE_NAME = 'luohua.app.session.tokens'
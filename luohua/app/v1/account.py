@@ -34,6 +34,7 @@ from ...utils.viewhelpers import jsonreply, parse_form
 
 from ...auth import ident
 from ...auth import user
+from ...rt import state as rt_state
 
 IDENT_CHECK_RETCODE_MAP = {
         ident.IDENT_OK: (True, ident.IDENT_OK, ),
@@ -176,6 +177,39 @@ def account_stat_self_v1_view(request):
     return jsonreply(r=0, s=stat_obj)
 
 
+@http
+@jsonview
+@only_methods(['GET', ])
+def account_online_v1_view(request):
+    '''v1 在线用户查询接口.
+
+    :Allow: GET
+    :URL 格式: :wyurl:`api:account-online-v1`
+    :GET 参数: 无
+    :POST 参数: 无
+    :返回:
+        :r:
+            === ===========================================================
+             0   查询成功
+            === ===========================================================
+
+        :l: 当前在实时信道上在线的用户列表.
+
+            ====== ========= ==============================================
+             字段   类型      说明
+            ====== ========= ==============================================
+             u      unicode   用户的 UID
+             n      unicode   用户的显示名称 (昵称), 偶尔可能为 ``null``
+            ====== ========= ==============================================
+
+    :副作用: 无
+
+    '''
+
+    online = rt_state.state_mgr.online_users()
+    return jsonreply(r=0, l=[{'u': uid, 'n': name, } for uid, name in online])
+
+
 @http
 @jsonview
 @only_methods(['POST', ])
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 应用 / API v1 / 审计记录
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+from weiyu.shortcuts import http, jsonview
+from weiyu.utils.decorators import only_methods
+
+from ..session.decorators import require_cap
+from ...auth.auditquery import AuditQuery
+from ...utils.viewhelpers import jsonreply, parse_query
+
+# 审计记录查询接口的默认每页条数和每页条数上限
+AUDIT_QUERY_DEFAULT_LIMIT = 50
+AUDIT_QUERY_MAX_LIMIT = 200
+
+
+def _audit_entry_to_json(entry):
+    return {
+            'i': entry['id'],
+            'u': entry['uid'],
+            'a': entry['remote_addr'],
+            'c': entry['ctime'],
+            'm': entry['module'],
+            't': entry['type'],
+            'g': entry['group'],
+            'p': entry['params'],
+            }
+
+
+def _parse_optional_int(value):
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ValueError(value)
+    return int(value)
+
+
+@http
+@jsonview
+@only_methods(['GET', ])
+@require_cap('audit-query')
+def audit_query_v1_view(request):
+    '''v1 审计记录查询接口.
+
+    :Allow: GET
+    :URL 格式: :wyurl:`api:audit-query-v1`
+    :GET 参数:
+        ======== ========= ================================================
+         字段     类型      说明
+        ======== ========= ================================================
+         uid      unicode   **可选** 操作者的用户 ID
+         module   unicode   **可选** 产生记录的模块名
+         type     unicode   **可选** 事件类型
+         group    unicode   **可选** 记录组, 即一组相关记录中首条的 ID
+         start    int       **可选** 起始时间, Unix 时间戳, 含
+         end      int       **可选** 结束时间, Unix 时间戳, 含
+         limit    int       **可选** 每页条数, 默认为 50, 最大为 200
+         cursor   unicode   **可选** 上一页返回的 ``n``, 首页省略
+        ======== ========= ================================================
+
+        以上参数均以查询字符串的形式传递, 各条件之间是 "与" 的关系.
+
+    :POST 参数: 无
+    :返回:
+        :r:
+            ==== ==========================================================
+             0    查询成功
+             22   传入参数格式不正确
+            ==== ==========================================================
+
+        :l:
+            符合条件的审计记录列表, 按时间顺序排列. 如果查询不成功,
+            此属性为空列表.
+
+            ====== ========= ==============================================
+             字段   类型      说明
+            ====== ========= ==============================================
+             i      unicode   记录 ID
+             u      unicode   操作者的用户 ID, 未登录时为空串
+             a      unicode   操作者的 IP 地址
+             c      float     记录时间 Unix 时间戳
+             m      unicode   模块名
+             t      unicode   事件类型
+             g      unicode   记录组
+             p      dict      事件参数
+            ====== ========= ==============================================
+
+        :n: 下一页的游标; 如果已经是最后一页, 此属性为 ``null``.
+
+    :副作用: 无
+
+    '''
+
+    uid, module, typ, group, start, end, limit, cursor = parse_query(
+            request,
+            'uid',
+            'module',
+            'type',
+            'group',
+            'start',
+            'end',
+            'limit',
+            'cursor',
+            uid=None,
+            module=None,
+            type=None,
+            group=None,
+            start=None,
+            end=None,
+            limit=None,
+            cursor=None,
+            )
+
+    try:
+        start, end = _parse_optional_int(start), _parse_optional_int(end)
+        limit = _parse_optional_int(limit)
+    except ValueError:
+        return jsonreply(r=22, l=[])
+
+    if limit is None:
+        limit = AUDIT_QUERY_DEFAULT_LIMIT
+    elif not 0 < limit <= AUDIT_QUERY_MAX_LIMIT:
+        return jsonreply(r=22, l=[])
+
+    query = AuditQuery(uid, module, typ, group, start, end)
+    try:
+        entries, next_cursor = query.page(limit, cursor)
+    except ValueError:
+        # 游标格式不对
+        return jsonreply(r=22, l=[])
+
+    return jsonreply(
+            r=0,
+            l=[_audit_entry_to_json(entry) for entry in entries],
+            n=next_cursor,
+            )
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -32,31 +32,49 @@ from weiyu.shortcuts import http, jsonview
 from weiyu.utils.decorators import only_methods
 
 from ..session.decorators import require_cap
-from ...utils.viewhelpers import jsonreply, parse_form
-from ...utils.sequences import time_ascending_suffixed
+from ...utils.viewhelpers import jsonreply, stream_jsonreply
+from ...utils.viewhelpers import parse_form, parse_query
+from ...utils.sequences import time_ascending_unique
 from ...datastructures.vtag import VTag
 from ...datastructures.vthread import VThread, VThreadTree
 from ...datastructures.vfile import VFile
 
 from ...rt import pubsub
 
+BATCHREAD_DEFAULT_LIMIT = 50
+BATCHREAD_MAX_LIMIT = 200
+
 
 def _new_vfid(timestamp):
-    for trial in xrange(5):
-        temp_vfid = time_ascending_suffixed(timestamp)
-        if VFile.fetch(temp_vfid) is None:
-            # 不重复, 可用
-            return temp_vfid
-    raise RuntimeError('UNLIKELY: failed to generate sequential vfid')
+    # 生成的 ID 保证不重复, 不需要再查询数据库确认
+    return time_ascending_unique(timestamp)
 
 
 def _new_vthid(timestamp):
-    for trial in xrange(5):
-        temp_vthid = time_ascending_suffixed(timestamp)
-        if VThread.fetch(temp_vthid) is None:
-            # 不重复, 可用
-            return temp_vthid
-    raise RuntimeError('UNLIKELY: failed to generate sequential vthid')
+    return time_ascending_unique(timestamp)
+
+
+def _vfile_to_json(vf):
+    return {
+            't': vf['title'],
+            'o': vf['owner'],
+            'c': vf['ctime'],
+            'n': vf['content'],
+            'f': vf['format'],
+            'x': vf['xattr'],
+            }
+
+
+def _iter_batchread_result(vfids):
+    # 并发读取, 结果顺序与 vfids 一致
+    for vfid, vf in six.moves.zip(vfids, VFile.fetch_multiple(vfids)):
+        if vf is None:
+            yield None
+            continue
+
+        result = _vfile_to_json(vf)
+        result['i'] = vfid
+        yield result
 
 
 @http
@@ -109,20 +127,11 @@ def vfile_read_v1_view(request, vfid):
         if vf['ctime'] <= client_cache_ts:
             return 304, {}, {'last_modified': vf['ctime'], }
 
-    stat_obj = {
-            't': vf['title'],
-            'o': vf['owner'],
-            'c': vf['ctime'],
-            'n': vf['content'],
-            'f': vf['format'],
-            'x': vf['xattr'],
-            }
-
     return (
             200,
             {
                 'r': 0,
-                's': stat_obj,
+                's': _vfile_to_json(vf),
                 },
             {
                 'last_modified': vf['ctime'],
@@ -130,6 +139,96 @@ def vfile_read_v1_view(request, vfid):
             )
 
 
+@http
+@jsonview
+@only_methods(['GET', ])
+def vfile_batchread_v1_view(request):
+    '''v1 虚文件批量读取接口.
+
+    用于一次取回渲染一页线索所需的全部虚文件, 免得逐个请求
+    :wyurl:`api:vfile-read-v1`.
+
+    :Allow: GET
+    :URL 格式: :wyurl:`api:vfile-batchread-v1`
+    :GET 参数:
+        ======= ========= =================================================
+         字段    类型      说明
+        ======= ========= =================================================
+         ids     unicode   逗号分隔的虚文件 ID 列表, 最多 200 个
+         vthid   unicode   虚线索 ID. 与 ``ids`` 二选一
+         limit   int       **可选** 配合 ``vthid`` 使用, 每页条数,
+                           默认为 50, 最大为 200
+         page    int       **可选** 配合 ``vthid`` 使用, 页码, 从 0 开始,
+                           默认为 0
+        ======= ========= =================================================
+
+        以上参数均以查询字符串的形式传递. 给出 ``vthid`` 时, 返回该虚线索\
+        中按时间顺序分页后的一页, 分页方式与 :wyurl:`api:vthread-getdents-v1`
+        相同.
+
+    :POST 参数: 无
+    :返回:
+        :r:
+            ==== ==========================================================
+             0    查询成功
+             2    所请求的虚线索不存在
+             22   传入参数格式不正确
+            ==== ==========================================================
+
+        :l:
+            所请求虚文件的列表, 顺序与 ``ids`` 或线索中的顺序相同.
+            每个虚文件的形式与 :wyurl:`api:vfile-read-v1` 返回的 ``s``
+            相同, 另有 ``i`` 字段为虚文件 ID; 不存在的虚文件对应位置为
+            ``null``. 如果查询不成功, 此属性为空列表.
+
+    :副作用: 无
+
+    .. note::
+
+        响应是边读取边输出的, 很长的线索也不会在服务器上占用大量内存.
+
+    '''
+
+    ids, vthid, limit, page = parse_query(
+            request,
+            'ids',
+            'vthid',
+            'limit',
+            'page',
+            ids=None,
+            vthid=None,
+            limit=None,
+            page='0',
+            )
+
+    if (ids is None) == (vthid is None):
+        return jsonreply(r=22, l=[])
+
+    if ids is not None:
+        vfids = [vfid for vfid in ids.split(',') if vfid]
+        if not vfids or len(vfids) > BATCHREAD_MAX_LIMIT:
+            return jsonreply(r=22, l=[])
+
+        return stream_jsonreply('l', _iter_batchread_result(vfids), r=0)
+
+    if limit is None:
+        limit = BATCHREAD_DEFAULT_LIMIT
+    elif limit.isdigit() and 0 < int(limit) <= BATCHREAD_MAX_LIMIT:
+        limit = int(limit)
+    else:
+        return jsonreply(r=22, l=[])
+
+    if not page.isdigit():
+        return jsonreply(r=22, l=[])
+
+    vth = VThread.fetch(vthid)
+    if vth is None:
+        return jsonreply(r=2, l=[])
+
+    vfids = list(vth['tree'].iter_paginated(limit, int(page)))
+    return stream_jsonreply('l', _iter_batchread_result(vfids), r=0)
+
+
 @http
 @jsonview
 @require_cap('vf-creat')
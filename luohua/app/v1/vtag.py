@@ -26,13 +26,17 @@ from weiyu.shortcuts import http, jsonview
 from weiyu.utils.decorators import only_methods
 
 from ..session.decorators import require_cap
-from ...utils.viewhelpers import jsonreply, parse_form
+from ...utils.viewhelpers import jsonreply, parse_form, parse_query
 from ...datastructures.vtag import VTag
 from ...datastructures.vthread import VThread
 from ...utils.sequences import time_ascending_short_suffixed
 
 VTAG_SLUG_RE = re.compile(r'^[^\s:;\\/\.\(\)\[\]\{\}]{0,16}$')
 
+# 虚线索列表接口的默认每页条数和每页条数上限
+GETDENTS_DEFAULT_LIMIT = 50
+GETDENTS_MAX_LIMIT = 200
+
 
 @http
 @jsonview
@@ -199,8 +203,13 @@ def vtag_getdents_v1_view(request, vtpid, vtagid, time_start, time_end):
          vtagid       unicode   虚标签 ID
          time_start   int       起始时间戳
          time_end     int       结束时间戳
+         limit        int       **可选** 每页条数, 默认为 50, 最大为 200
+         cursor       unicode   **可选** 上一页返回的 ``n`` 值,
+                                省略则返回第一页
         ============ ========= ============================================
 
+        ``limit`` 与 ``cursor`` 以查询字符串的形式传递.
+
     :POST 参数: 无
     :返回:
         :r:
@@ -226,30 +235,61 @@ def vtag_getdents_v1_view(request, vtpid, vtagid, time_start, time_end):
              m      int       最后变化时间戳
             ====== ========= ==============================================
 
+            列表按最后变化时间从新到旧排列.
+
+        :n:
+            获取下一页时应传入的 ``cursor`` 值. 如果已经是最后一页,
+            或查询不成功, 此属性为 ``null``.
+
     :副作用: 无
 
     '''
 
     if not time_start.isdigit() or not time_end.isdigit():
-        return jsonreply(r=22, l=[])
+        return jsonreply(r=22, l=[], n=None)
 
     time_start, time_end = int(time_start), int(time_end)
 
+    limit, cursor = parse_query(
+            request,
+            'limit',
+            'cursor',
+            limit=None,
+            cursor=None,
+            )
+
+    if limit is None:
+        limit = GETDENTS_DEFAULT_LIMIT
+    elif limit.isdigit() and 0 < int(limit) <= GETDENTS_MAX_LIMIT:
+        limit = int(limit)
+    else:
+        return jsonreply(r=22, l=[], n=None)
+
     vtag = VTag.fetch(vtagid)
     if vtag is None or vtag['vtpid'] != vtpid:
-        return jsonreply(r=2, l=[])
-
-    result = []
-    for vth in VThread.from_vtag_mtime(vtag['id'], time_start, time_end):
-        result.append({
-                'i': vth['id'],
-                't': vth['title'],
-                'o': vth['owner'],
-                'c': vth['ctime'],
-                'm': vth['mtime'],
-                })
-
-    return jsonreply(r=0, l=result)
+        return jsonreply(r=2, l=[], n=None)
+
+    # 列表所需的字段都在摘要索引里, 不必读取虚线索本体
+    summaries, next_cursor = VThread.summaries_from_vtag_mtime(
+            vtag['id'],
+            time_start,
+            time_end,
+            limit,
+            cursor or None,
+            )
+
+    result = [
+            {
+                'i': summary['id'],
+                't': summary['title'],
+                'o': summary['owner'],
+                'c': summary['ctime'],
+                'm': summary['mtime'],
+                }
+            for summary in summaries
+            ]
+
+    return jsonreply(r=0, l=result, n=next_cursor)
 
 
 @http
@@ -22,9 +22,56 @@ from __future__ import unicode_literals, division
 from weiyu.shortcuts import http, jsonview
 from weiyu.utils.decorators import only_methods
 
-from ...utils.viewhelpers import jsonreply, parse_form
+from ...utils.viewhelpers import jsonreply, parse_form, parse_query
 from ...datastructures.vthread import VThread
 
+GETDENTS_MAX_LIMIT = 200
+
+
+def _not_modified_since(request, mtime):
+    client_cache_ts = request.conditional.get('If-Modified-Since', None)
+    return client_cache_ts is not None and mtime <= client_cache_ts
+
+
+def _getdents_etag(tree_version, limit, page):
+    # 分页与否, 每页多少条都会影响内容, 所以一并算进 ETag
+    if limit is None:
+        return '"%d"' % (tree_version, )
+    return '"%d-%d-%d"' % (tree_version, limit, page, )
+
+
+def _getdents_ctx(mtime, etag):
+    # weiyu 只会把 ctx 里的 headers 转成响应头, ETag 只能自己放进去
+    return {
+            'last_modified': mtime,
+            'headers': [('ETag', etag, ), ],
+            }
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.env.get('HTTP_IF_NONE_MATCH', None)
+    if if_none_match is None:
+        return None
+
+    if if_none_match.strip() == '*':
+        return True
+
+    # 忽略弱验证标记, 本接口的 ETag 只用于判断是否需要重新下载
+    tags = (tag.strip() for tag in if_none_match.split(','))
+    return any(
+            (tag[2:] if tag.startswith('W/') else tag) == etag
+            for tag in tags
+            )
+
+
+def _getdents_not_modified(request, mtime, etag):
+    # If-None-Match 优先于 If-Modified-Since
+    etag_result = _etag_matches(request, etag)
+    if etag_result is not None:
+        return etag_result
+
+    return _not_modified_since(request, mtime)
+
 
 @http
 @jsonview
@@ -68,15 +115,24 @@ def vthread_stat_v1_view(request, vthid):
 
     '''
 
+    # If-Modified-Since
+    # 先查新鲜度记录, 没有变化的话就不用读取虚线索本体了
+    conditional = 'If-Modified-Since' in request.conditional
+    if conditional:
+        fresh = VThread.peek_freshness(vthid)
+        if fresh is not None and _not_modified_since(request, fresh[0]):
+            return 304, {}, {'last_modified': fresh[0], }
+
     vth = VThread.fetch(vthid)
     if vth is None:
         return jsonreply(r=2)
 
-    # If-Modified-Since
-    client_cache_ts = request.conditional.get('If-Modified-Since', None)
-    if client_cache_ts is not None:
-        if vth['mtime'] <= client_cache_ts:
-            return 304, {}, {'last_modified': vth['mtime'], }
+    if conditional and fresh is None:
+        # 补上新鲜度记录, 下次就能直接返回 304 了
+        vth.remember_freshness()
+
+    if _not_modified_since(request, vth['mtime']):
+        return 304, {}, {'last_modified': vth['mtime'], }
 
     stat_obj = {
             't': vth['title'],
@@ -113,18 +169,23 @@ def vthread_getdents_v1_view(request, vthid):
          字段    类型      说明
         ======= ========= =================================================
          vthid   unicode   虚线索 ID
+         limit   int       **可选** 每页条数, 最大为 200. 省略则不分页
+         page    int       **可选** 页码, 从 0 开始, 默认为 0
         ======= ========= =================================================
 
+        ``limit`` 与 ``page`` 以查询字符串的形式传递.
+
     :POST 参数: 无
     :返回:
         :r:
             ==== ==========================================================
              0    查询成功
              2    所请求的虚线索不存在
+             22   传入参数格式不正确
             ==== ==========================================================
 
         :l:
-            所请求虚线索中所有虚文件的层次结构列表, 形式如下::
+            不分页时, 是所请求虚线索中所有虚文件的层次结构列表, 形式如下::
 
                 [
                   楼主虚文件,
@@ -133,37 +194,88 @@ def vthread_getdents_v1_view(request, vthid):
                   ...,
                 ]
 
+            分页时, 是所请求页中虚文件 ID 的列表, 直接回复和楼中楼回复\
+            一起按时间顺序排列. 页码超出范围则为空列表.
+
             如果查询不成功, 该属性不存在.
 
-            .. note::
+        :p:
+            分页时为总页数. 不分页或查询不成功时, 该属性不存在.
 
-                **此 API 不分页**, 这是考虑到大多数线索不会很长而做出的设计.
-                如有分页需求请在前端自行实现.
+        :v:
+            虚线索树的版本号, 每次添加回复都会增大. 如果查询不成功,
+            该属性不存在.
+
+        .. note::
+
+            响应带有 ``Last-Modified`` 和 ``ETag``, 支持 ``If-Modified-Since``
+            和 ``If-None-Match`` 条件请求; 同时给出时以后者为准. 没有变化时
+            返回 304, 且不必读取虚线索本体.
+
+        .. note::
+
+            大多数线索不会很长, 一次取回整个层次结构即可; 很长的线索\
+            请使用分页, 以节约流量.
 
     :副作用: 无
 
     '''
 
+    limit, page = parse_query(request, 'limit', 'page', limit=None, page='0')
+
+    if limit is not None:
+        if not limit.isdigit() or not page.isdigit():
+            return jsonreply(r=22)
+
+        limit, page = int(limit), int(page)
+        if not 0 < limit <= GETDENTS_MAX_LIMIT:
+            return jsonreply(r=22)
+
+    # If-None-Match, If-Modified-Since
+    # 先查新鲜度记录, 没有变化的话就不用读取虚线索本体了
+    conditional = (
+            'If-Modified-Since' in request.conditional
+            or 'HTTP_IF_NONE_MATCH' in request.env
+            )
+    if conditional:
+        fresh = VThread.peek_freshness(vthid)
+        if fresh is not None:
+            mtime, tree_version = fresh
+            etag = _getdents_etag(tree_version, limit, page)
+            if _getdents_not_modified(request, mtime, etag):
+                return 304, {}, _getdents_ctx(mtime, etag)
+
     vth = VThread.fetch(vthid)
     if vth is None:
         return jsonreply(r=2)
 
-    # If-Modified-Since
-    client_cache_ts = request.conditional.get('If-Modified-Since', None)
-    if client_cache_ts is not None:
-        if vth['mtime'] <= client_cache_ts:
-            return 304, {}, {'last_modified': vth['mtime'], }
+    if conditional and fresh is None:
+        # 补上新鲜度记录, 下次就能直接返回 304 了
+        vth.remember_freshness()
 
-    return (
-            200,
-            {
+    tree = vth['tree']
+    tree_version = tree.version
+    etag = _getdents_etag(tree_version, limit, page)
+    ctx = _getdents_ctx(vth['mtime'], etag)
+
+    if conditional and _getdents_not_modified(request, vth['mtime'], etag):
+        return 304, {}, ctx
+
+    if limit is None:
+        result = {
                 'r': 0,
-                'l': vth['tree'].tree,
-                },
-            {
-                'last_modified': vth['mtime'],
-                },
-            )
+                'l': tree.tree,
+                'v': tree_version,
+                }
+    else:
+        result = {
+                'r': 0,
+                'l': list(tree.iter_paginated(limit, page)),
+                'p': tree.num_pages(limit),
+                'v': tree_version,
+                }
+
+    return 200, result, ctx
 
 
 @http
@@ -30,6 +30,18 @@ os.chdir(_PROJECT_PATH)
 application = None
 init.inject_app()
 
+# 定期检查共享的 Redis 连接池
+from ..utils import redispool
+redispool.pool_mgr.ensure_health_checks()
+
+# 各 worker 进程之间同步文档缓存的失效
+from ..rt import cachesync
+cachesync.install()
+
+# 审计记录改由后台 greenlet 分批写入, 不再拖慢登录等请求
+from ..auth import auditwriter
+auditwriter.install()
+
 
 # Sentry init
 if 'SENTRY_DSN' in os.environ:
@@ -22,6 +22,13 @@ from __future__ import unicode_literals, division
 __all__ = [
         'AUDIT_ENTRY_STRUCT_ID',
         'AuditEntry',
+        'install_writer',
+        'iter_partitions',
+        'next_partition',
+        'partition_of_key',
+        'partition_of_ts',
+        'submit_entry',
+        'write_entry',
         ]
 
 import six
@@ -41,12 +48,78 @@ AUDIT_ACTION_IDX = b'audit_act_bin'
 AUDIT_GROUP_IDX = b'audit_group_bin'
 AUDIT_TIMESTAMP_IDX = b'audit_ts_int'
 
+# 审计记录按月分区存放, 每个分区是一个单独的 bucket, 名为
+# ``<原 bucket 名>.<YYYYMM>``. 分区按 UTC 时间划分
+AUDIT_PARTITION_FORMAT = '%Y%m'
+
+# 查询不限起始时间时, 从这个分区开始找. 更早的记录只会在分区之前的旧
+# bucket 里, 需要先用 luohua.auth.auditarchive.migrate_legacy 迁移过来
+AUDIT_PARTITION_EPOCH = '201401'
+
+# 审计记录 ID 末尾随机后缀的长度, 见 sequences.time_ascending_suffixed
+_AUDIT_KEY_SUFFIX_LEN = 4
+
 AUDIT_MODULE_AUDIT = 'luohua.auth.audit'
 
 AUDIT_TYPE_UPDATE = 'update'
 
 _number_types = six.integer_types + (float, )
 
+# 异步写入审计记录的实现, 见 install_writer
+_WRITER = []
+
+
+def partition_of_ts(ts):
+    '''返回某一时刻的审计记录所在的分区名, 形如 ``'201405'``.'''
+
+    return smartstr(
+            time.strftime(AUDIT_PARTITION_FORMAT, time.gmtime(int(ts)))
+            )
+
+
+def partition_of_key(key):
+    '''从审计记录 ID 推算记录所在的分区名.
+
+    审计记录的 ID 以 36 进制的创建时间开头, 所以不用读出记录就能知道它在\
+    哪个分区.
+
+    :raises ValueError: ID 不是审计记录 ID 的格式.
+
+    '''
+
+    return partition_of_ts(int(key[:-_AUDIT_KEY_SUFFIX_LEN], 36))
+
+
+def next_partition(partition):
+    '''返回紧接着给定分区的下一个分区名.'''
+
+    year, month = int(partition[:4]), int(partition[4:])
+    year, month = (year + 1, 1, ) if month == 12 else (year, month + 1, )
+    return '%04d%02d' % (year, month, )
+
+
+def iter_partitions(start=None, end=None):
+    '''按时间顺序列出覆盖一段时间的所有分区名.
+
+    :param start: 起始 Unix 时间戳, :const:`None` 表示从
+            :data:`AUDIT_PARTITION_EPOCH` 开始.
+    :param end: 结束 Unix 时间戳, :const:`None` 表示到当前时刻为止.
+    :return: 分区名的迭代器.
+    :rtype: :data:`types.GeneratorType`
+
+    '''
+
+    partition = (
+            partition_of_ts(start)
+            if start is not None
+            else AUDIT_PARTITION_EPOCH
+            )
+    last = partition_of_ts(end if end is not None else time.time())
+
+    while partition <= last:
+        yield partition
+        partition = next_partition(partition)
+
 
 class AuditEntry(dblayer.RiakDocument):
     '''审计记录条目.'''
@@ -66,6 +139,44 @@ class AuditEntry(dblayer.RiakDocument):
         if ts is None:
             self['ctime'] = now
 
+    @property
+    def partition(self):
+        '''本条记录所在的分区名.'''
+
+        return partition_of_ts(self['ctime'])
+
+    @classmethod
+    def partition_storage(cls, partition):
+        '''返回某个分区的数据库存储, 用法与 :attr:`storage` 相同.'''
+
+        storage = cls.storage
+        return storage.driver('%s.%s' % (storage.bucket, partition, ))
+
+    @classmethod
+    def fetch(cls, key):
+        '''按 ID 获取一条审计记录.
+
+        先在记录所在的分区里找, 找不到再去该分区压缩后的归档里找.
+
+        '''
+
+        partition = partition_of_key(key)
+        with cls.partition_storage(partition) as conn:
+            entry = cls._fetch_one(conn, key)
+
+        if entry is not None:
+            return entry
+
+        # 函数内导入, 避免循环依赖
+        from . import auditarchive
+        return auditarchive.fetch_archived(partition, key)
+
+    def save(self):
+        '''保存记录到它所在的分区.'''
+
+        with self.partition_storage(self.partition) as conn:
+            return self.save_to_conn(conn)
+
     def _do_sync_2i(self, obj):
         obj.set_index(AUDIT_UID_IDX, smartbytes(self['uid']))
         obj.set_index(AUDIT_MODULE_IDX, smartbytes(self['module']))
@@ -97,6 +208,40 @@ class AuditEntry(dblayer.RiakDocument):
                 )
 
 
+def install_writer(impl):
+    '''装上异步写入审计记录的实现.
+
+    ``impl`` 需要提供 ``submit(entry, event_type)`` 方法, 负责在稍后把
+    ``entry`` 保存到数据库, 并在审计频道发出 ``event_type`` 类型的事件.
+
+    ``impl`` 为 :const:`None` 则卸下当前的实现, 此后审计记录重新变为同步\
+    写入. 目前的实现见 :mod:`luohua.auth.auditwriter`.
+
+    '''
+
+    _WRITER[:] = [impl] if impl is not None else []
+
+
+def write_entry(entry, event_type):
+    '''同步保存一条审计记录, 并实时通知审计频道.'''
+
+    entry.save()
+    pubsub.publish_event('_auditlog', event_type, obj=entry)
+
+
+def submit_entry(entry, event_type):
+    '''提交一条审计记录.
+
+    装有异步写入的实现时只是把记录交给它排队, 否则立即同步写入.
+
+    '''
+
+    if _WRITER:
+        return _WRITER[0].submit(entry, event_type)
+
+    return write_entry(entry, event_type)
+
+
 class BaseAuditedAction(object):
     '''审计事件类型.'''
 
@@ -133,17 +278,11 @@ class BaseAuditedAction(object):
         self._check_params_spec(new_params)
 
         new_entry = self.entry.make_update_object(uid, new_params)
-        new_entry.save()
-
-        # 实时通知审计频道
-        pubsub.publish_event('_auditlog', 'update', obj=new_entry)
+        submit_entry(new_entry, 'update')
 
     def save(self):
         self._check_params_spec(self.entry['params'])
-        self.entry.save()
-
-        # 实时通知审计频道
-        pubsub.publish_event('_auditlog', 'save', obj=self.entry)
+        submit_entry(self.entry, 'save')
 
 
 # 数据库序列化/反序列化
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 认证 / 审计记录归档
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'AuditArchive',
+        'compact_partition',
+        'fetch_archived',
+        'migrate_legacy',
+        ]
+
+import itertools
+import json
+import time
+import zlib
+
+from gevent.pool import Pool
+
+from weiyu.helpers.misc import smartstr, smartbytes
+
+from ..utils import dblayer
+
+from . import audit
+
+# 归档所在的分区名, 即 bucket ``<原 bucket 名>.archive``
+AUDIT_ARCHIVE_PARTITION = 'archive'
+
+# 每个归档块容纳的记录条数
+AUDIT_ARCHIVE_CHUNK_SIZE = 2000
+
+# 分区结束之后至少过这么久才允许压缩, 单位: 秒. 留出余量给还在缓冲区里
+# 没写出的记录
+AUDIT_COMPACT_GRACE_SECS = 7 * 86400
+
+# 归档块的 2i 索引: 所属分区, 以及块中出现过的各个值 (多值索引)
+AUDIT_ARCHIVE_PART_IDX = b'audit_part_bin'
+
+# 归档块索引名 -> 对应的记录字段
+_ARCHIVE_INDEXED_FIELDS = (
+        (audit.AUDIT_UID_IDX, 'uid', ),
+        (audit.AUDIT_MODULE_IDX, 'module', ),
+        (audit.AUDIT_ACTION_IDX, 'type', ),
+        (audit.AUDIT_GROUP_IDX, 'group', ),
+        )
+
+_ARCHIVE_CONTENT_TYPE = 'application/octet-stream'
+
+# (文档类, 分区名) -> 已读到的归档清单. 清单写入之后就不再改变, 所以可以\
+# 一直缓存; 没有清单的分区随时可能被压缩, 不缓存
+_MANIFESTS = {}
+
+
+def archive_index_value(partition, value):
+    '''归档块索引值. 带上分区名, 这样按值查询时只会查到一个分区的块.'''
+
+    return smartbytes('%s/%s' % (partition, value, ))
+
+
+def _chunk_key(partition, seq):
+    return '%s.%04d' % (partition, seq, )
+
+
+def _pack_chunk(records):
+    # 每行一条记录, 内容是记录在数据库中的原始形式, 整块用 zlib 压缩
+    lines = (
+            json.dumps({'i': key, 'd': data, }, sort_keys=True)
+            for key, data in records
+            )
+    return zlib.compress(smartbytes('\n'.join(lines)))
+
+
+def _unpack_chunk(blob):
+    for line in smartstr(zlib.decompress(blob)).split('\n'):
+        record = json.loads(line)
+        yield record['i'], record['d']
+
+
+class AuditArchive(object):
+    '''审计记录分区的压缩归档.
+
+    压缩把一个分区的全部记录按 ID 顺序打包成若干个归档块, 每块是
+    zlib 压缩的 JSON Lines, 存在归档 bucket 中, ID 为 ``<分区名>.<序号>``.
+    块上带有多值 2i 索引, 记录了块中出现过的用户 ID, 模块, 事件类型和记录\
+    组, 供查询时跳过不相关的块. 全部块写入之后再写入以分区名为 ID 的清单,
+    清单存在即表示该分区已压缩, 这之后才删除分区中的原始对象.
+
+    :param entry_cls: 审计记录的文档类.
+
+    '''
+
+    def __init__(self, entry_cls=audit.AuditEntry):
+        self.entry_cls = entry_cls
+
+    @property
+    def storage(self):
+        return self.entry_cls.partition_storage(AUDIT_ARCHIVE_PARTITION)
+
+    def load_manifest(self, partition):
+        '''读取分区的归档清单.
+
+        :return: 清单; 如果分区没有压缩过则为 :const:`None`. 清单中 ``c``
+                是各块的信息列表, 每块有 ``k`` (块 ID), ``n`` (记录条数),
+                ``f`` 和 ``l`` (首末记录 ID), ``s`` 和 ``e`` (最早和最晚的\
+                记录时间戳).
+        :rtype: dict
+
+        '''
+
+        cache_key = (self.entry_cls, partition, )
+        try:
+            return _MANIFESTS[cache_key]
+        except KeyError:
+            pass
+
+        with self.storage as conn:
+            obj = conn.get(smartbytes(partition))
+            if not obj.exists:
+                return None
+
+        manifest = _MANIFESTS[cache_key] = obj.data
+        return manifest
+
+    def chunk_keys(self, partition, conditions):
+        '''用块上的 2i 索引找出可能含有符合条件记录的块.
+
+        :param conditions: ``(索引名, 值)`` 的列表, 之间是 "与" 的关系.
+        :return: 块 ID 的集合.
+        :rtype: set
+
+        '''
+
+        keys = None
+        with self.storage as conn:
+            for idx, value in conditions:
+                found = set(
+                        smartstr(key)
+                        for key in dblayer.iter_index(
+                            conn,
+                            idx,
+                            archive_index_value(partition, value),
+                            ))
+                keys = found if keys is None else keys & found
+                if not keys:
+                    break
+
+        return keys or set()
+
+    def iter_entries(
+            self,
+            partition,
+            manifest,
+            chunk_keys=None,
+            start=None,
+            end=None,
+            concurrency=None,
+            ):
+        '''按 ID 顺序逐条返回分区归档中的记录.
+
+        :param chunk_keys: 只读取这些块, :const:`None` 表示全部.
+        :param start: 跳过最晚记录早于此时间戳的块.
+        :param end: 跳过最早记录晚于此时间戳的块.
+        :param concurrency: 同时读取的块数.
+        :return: 审计记录的迭代器.
+        :rtype: :data:`types.GeneratorType`
+
+        '''
+
+        chunks = [
+                chunk['k']
+                for chunk in manifest['c']
+                if (chunk_keys is None or chunk['k'] in chunk_keys)
+                and (start is None or chunk['e'] >= start)
+                and (end is None or chunk['s'] <= end)
+                ]
+
+        entry_cls = self.entry_cls
+        with self.storage as conn:
+            def _read_chunk(key):
+                return list(_unpack_chunk(conn.get(key).encoded_data))
+
+            # 块的读取并发进行, imap 保证顺序不变
+            pool = Pool(concurrency or len(chunks) or 1)
+            try:
+                for records in pool.imap(_read_chunk, chunks):
+                    for key, data in records:
+                        yield entry_cls(data, key)
+            finally:
+                pool.kill()
+
+    def fetch(self, partition, key):
+        '''从归档中取出一条记录, 不存在则返回 :const:`None`.'''
+
+        manifest = self.load_manifest(partition)
+        if manifest is None:
+            return None
+
+        for chunk in manifest['c']:
+            if chunk['f'] <= key <= chunk['l']:
+                chunk_manifest = {'c': [chunk, ], }
+                for entry in self.iter_entries(partition, chunk_manifest):
+                    if entry['id'] == key:
+                        return entry
+                break
+
+        return None
+
+    def _store_chunk(self, conn, partition, seq, records, entries):
+        key = _chunk_key(partition, seq)
+        blob = _pack_chunk(records)
+
+        obj = conn.new(
+                smartbytes(key),
+                content_type=_ARCHIVE_CONTENT_TYPE,
+                encoded_data=blob,
+                )
+        obj.add_index(AUDIT_ARCHIVE_PART_IDX, smartbytes(partition))
+        for idx, field in _ARCHIVE_INDEXED_FIELDS:
+            for value in set(entry[field] for entry in entries):
+                obj.add_index(idx, archive_index_value(partition, value))
+        obj.store()
+
+        timestamps = [int(entry['ctime']) for entry in entries]
+        return {
+                'k': key,
+                'n': len(records),
+                'f': records[0][0],
+                'l': records[-1][0],
+                's': min(timestamps),
+                'e': max(timestamps),
+                }, len(blob)
+
+    def compact(self, partition, chunk_size=None, concurrency=None):
+        '''压缩一个分区.
+
+        对已经压缩过的分区再次调用, 只会删除上次没删完的原始对象. 清单写入\
+        之后才出现在分区里的对象不在归档中, 不会被删除, 计入 ``stray``;
+        查询时它们和归档中的记录一起返回.
+
+        :param partition: 分区名.
+        :param chunk_size: 每块的记录条数, 默认为
+                :data:`AUDIT_ARCHIVE_CHUNK_SIZE`.
+        :param concurrency: 读取原始对象时的并发数.
+        :return: 统计数据, 包含 ``entries``, ``chunks``, ``raw_bytes``,
+                ``packed_bytes``, ``deleted`` 和 ``stray``.
+        :rtype: dict
+        :raises ValueError: 分区还没结束足够久, 可能还会有新记录写入.
+
+        '''
+
+        now = time.time()
+        deadline = audit.partition_of_ts(now - AUDIT_COMPACT_GRACE_SECS)
+        if audit.next_partition(partition) > deadline:
+            raise ValueError('partition %s is still open' % (partition, ))
+
+        chunk_size = chunk_size or AUDIT_ARCHIVE_CHUNK_SIZE
+        stats = {
+                'entries': 0,
+                'chunks': 0,
+                'raw_bytes': 0,
+                'packed_bytes': 0,
+                'deleted': 0,
+                'stray': 0,
+                }
+
+        entry_cls = self.entry_cls
+        with entry_cls.partition_storage(partition) as part_conn:
+            keys = sorted(
+                    smartstr(key)
+                    for key in itertools.chain.from_iterable(
+                        part_conn.stream_keys()
+                        ))
+
+            manifest = self.load_manifest(partition)
+            if manifest is None:
+                manifest = self._pack_partition(
+                        partition,
+                        part_conn,
+                        keys,
+                        chunk_size,
+                        concurrency,
+                        stats,
+                        )
+
+            archived = set()
+            for entry in self.iter_entries(partition, manifest):
+                archived.add(entry['id'])
+            stats['entries'] = len(archived)
+            stats['chunks'] = len(manifest['c'])
+
+            for key in keys:
+                if key in archived:
+                    part_conn.delete(smartbytes(key))
+                    stats['deleted'] += 1
+                else:
+                    stats['stray'] += 1
+
+        return stats
+
+    def _pack_partition(
+            self,
+            partition,
+            part_conn,
+            keys,
+            chunk_size,
+            concurrency,
+            stats,
+            ):
+        entries = (
+                entry
+                for entry in self.entry_cls._do_bulk_fetch(
+                    part_conn,
+                    keys,
+                    concurrency,
+                    )
+                if entry is not None
+                )
+
+        chunks = []
+        with self.storage as conn:
+            while True:
+                batch = list(itertools.islice(entries, chunk_size))
+                if not batch:
+                    break
+
+                records = [(entry['id'], entry.encode(), ) for entry in batch]
+                stats['raw_bytes'] += sum(
+                        len(json.dumps(data)) for _, data in records
+                        )
+                chunk, size = self._store_chunk(
+                        conn,
+                        partition,
+                        len(chunks),
+                        records,
+                        batch,
+                        )
+                chunks.append(chunk)
+                stats['packed_bytes'] += size
+
+            # 块都写好了才写清单
+            manifest = {'v': 1, 'c': chunks, }
+            conn.new(smartbytes(partition), manifest).store()
+            _MANIFESTS[(self.entry_cls, partition, )] = manifest
+
+        return manifest
+
+
+def compact_partition(partition, chunk_size=None, concurrency=None):
+    '''压缩一个分区, 见 :meth:`AuditArchive.compact`.'''
+
+    return AuditArchive().compact(partition, chunk_size, concurrency)
+
+
+def fetch_archived(partition, key):
+    '''从分区归档中取出一条记录, 见 :meth:`AuditArchive.fetch`.'''
+
+    return AuditArchive().fetch(partition, key)
+
+
+def migrate_legacy(entry_cls=audit.AuditEntry):
+    '''把分区之前存在单一 bucket 里的审计记录迁移到各自的分区.
+
+    :return: 处理失败的对象列表, 每条记录形如 ``(对象, 抛出的异常, )``
+    :rtype: list
+
+    '''
+
+    failures = []
+
+    with entry_cls.storage as legacy_conn:
+        for entry in entry_cls.find_all():
+            try:
+                # 不再关联旧 bucket 中的对象, 这样 save 才会写到分区里
+                entry._rawobj = None
+                entry.save()
+                legacy_conn.delete(smartbytes(entry['id']))
+            except Exception as e:
+                failures.append((entry, e, ))
+
+    # 旧记录写进了以前的分区. 函数内导入, 避免循环依赖
+    from . import auditquery
+    auditquery.clear_first_partitions()
+
+    return failures
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
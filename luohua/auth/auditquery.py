@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 认证 / 审计记录查询
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'AuditQuery',
+        'clear_first_partitions',
+        'decode_cursor',
+        'encode_cursor',
+        ]
+
+import heapq
+import itertools
+import time
+
+from gevent.pool import Pool
+
+from weiyu.helpers.misc import smartstr, smartbytes
+
+from ..utils import dblayer
+from ..utils.radixcodec import encode36
+from ..utils.sequences import TIMESTAMP_LIMIT
+
+from . import audit
+from . import auditarchive
+
+# 逐页读取 2i 查询结果时的每页条数
+AUDIT_INDEX_PAGE_SIZE = 1000
+
+# 记下的最早有记录的分区的有效期, 单位: 秒. 迁移旧记录或重新写入转存的\
+# 记录时会往以前的分区里写, 执行这些操作的进程会立即清掉自己记下的, 其他\
+# 进程最晚过了这么久也会重新查找
+AUDIT_FIRST_PARTITION_TTL_SECS = 600
+
+# 文档类 -> (最早的有记录的分区, 过期时间), 见 AuditQuery._first_partition
+_FIRST_PARTITIONS = {}
+
+# 查询条件名 -> (对应的 2i 索引, 对应的记录字段)
+_EQUALITY_FILTERS = (
+        ('uid', audit.AUDIT_UID_IDX, 'uid', ),
+        ('module', audit.AUDIT_MODULE_IDX, 'module', ),
+        ('type', audit.AUDIT_ACTION_IDX, 'type', ),
+        ('group', audit.AUDIT_GROUP_IDX, 'group', ),
+        )
+
+
+def clear_first_partitions():
+    '''清掉本进程记下的最早有记录的分区.
+
+    往当前最早的分区之前写入记录之后调用, 见
+    :func:`migrate_legacy <luohua.auth.auditarchive.migrate_legacy>` 和
+    :func:`replay_spilled <luohua.auth.auditwriter.replay_spilled>`.
+
+    '''
+
+    _FIRST_PARTITIONS.clear()
+
+
+def encode_cursor(entry):
+    '''由一页的最后一条审计记录生成下一页的游标.
+
+    游标里同时带着记录的时间戳和 ID, 这样不论查询是按 ID 排序还是按时间戳\
+    索引排序, 都可以从这条记录之后继续.
+
+    '''
+
+    return '%d:%s' % (int(entry['ctime']), entry['id'], )
+
+
+def decode_cursor(cursor):
+    '''解析 :func:`encode_cursor` 生成的游标.
+
+    :return: ``(时间戳, 文档 ID)``.
+    :rtype: tuple
+    :raises ValueError: 游标格式不正确.
+
+    '''
+
+    ts, sep, key = smartstr(cursor).partition(':')
+    if not sep or not key:
+        raise ValueError('malformed audit cursor: %r' % (cursor, ))
+
+    return int(ts), key
+
+
+class AuditQuery(object):
+    '''审计记录查询.
+
+    所有条件都是可选的, 给出的条件之间是 "与" 的关系. ``start`` 和 ``end``
+    是闭区间的 Unix 时间戳.
+
+    查询按时间顺序逐个扫描时间范围覆盖的分区 (见
+    :func:`iter_partitions <luohua.auth.audit.iter_partitions>`), 对每个分区:
+
+    * 已压缩的分区, 先用归档块上的索引跳过不相关的块, 读出的记录再逐条\
+      过滤. 压缩之后才写进分区的零星记录仍按下面未压缩分区的方式查询,
+      与归档中的记录按 ID 顺序合并;
+    * 给出了 ``uid``, ``module``, ``type``, ``group`` 中的任意一个时,
+      并发查询对应的 2i 索引, 求出文档 ID 的交集, 按文档 ID 排序 (审计记录\
+      的 ID 以 36 进制的创建时间开头, 所以也就是按时间排序). 时间范围和\
+      游标之外的 ID 在取交集之前就直接丢掉, 不会去读对应的记录;
+    * 只给出时间范围时, 按时间戳索引逐页扫描, 按时间戳排序.
+
+    没有给出起始时间时, 从本进程记下的最早有记录的分区开始扫描, 而不是\
+    每次都从 :data:`AUDIT_PARTITION_EPOCH
+    <luohua.auth.audit.AUDIT_PARTITION_EPOCH>` 开始逐月查询. 结果对象都是\
+    并发读取的.
+
+    '''
+
+    # 查询的文档类型
+    entry_cls = audit.AuditEntry
+
+    def __init__(
+            self,
+            uid=None,
+            module=None,
+            type=None,
+            group=None,
+            start=None,
+            end=None,
+            ):
+        conditions = {
+                'uid': uid,
+                'module': module,
+                'type': type,
+                'group': group,
+                }
+
+        self.filters = [
+                (idx, field, smartstr(conditions[name]), )
+                for name, idx, field in _EQUALITY_FILTERS
+                if conditions[name] is not None
+                ]
+        self.start = int(start) if start is not None else None
+        self.end = int(end) if end is not None else None
+        self.archive = auditarchive.AuditArchive(self.entry_cls)
+
+    def _key_filter(self, after):
+        '''返回判断一个文档 ID 是否落在时间范围内且在游标之后的函数.
+
+        审计记录的 ID 是 36 进制的创建时间加上定长的随机后缀, 而目前的时间戳\
+        在 36 进制下都是同样的位数, 所以直接比较 ID 字符串就是在比较时间.
+
+        '''
+
+        # [lower, upper), 同时要大于 after_key
+        lower = encode36(self.start) if self.start is not None else None
+        upper = encode36(self.end + 1) if self.end is not None else None
+        after_key = after[1] if after is not None else None
+
+        def _wanted(key):
+            if lower is not None and key < lower:
+                return False
+            if after_key is not None and key <= after_key:
+                return False
+            return upper is None or key < upper
+
+        return _wanted
+
+    def _iter_keys_by_filters(self, conn, after):
+        wanted = self._key_filter(after)
+
+        def _fetch_keys(flt):
+            idx, _, value = flt
+            keys = set()
+            for key in dblayer.iter_index(
+                    conn,
+                    idx,
+                    smartbytes(value),
+                    page_size=AUDIT_INDEX_PAGE_SIZE,
+                    ):
+                key = smartstr(key)
+                # 游标之前和时间范围之外的 ID 不参与求交集
+                if wanted(key):
+                    keys.add(key)
+            return keys
+
+        pool = Pool(len(self.filters))
+        keys = None
+        for found in pool.imap_unordered(_fetch_keys, self.filters):
+            keys = found if keys is None else keys & found
+            if not keys:
+                pool.kill()
+                return
+
+        for key in sorted(keys):
+            yield key
+
+    def _iter_keys_by_time(self, conn, after):
+        start = self.start if self.start is not None else 0
+        if after is not None:
+            start = max(start, after[0])
+
+        results = dblayer.iter_index(
+                conn,
+                audit.AUDIT_TIMESTAMP_IDX,
+                start,
+                self.end if self.end is not None else TIMESTAMP_LIMIT,
+                return_terms=True,
+                page_size=AUDIT_INDEX_PAGE_SIZE,
+                )
+        for term, key in results:
+            key = smartstr(key)
+            if after is not None and (int(term), key, ) <= after:
+                continue
+            yield key
+
+    def _iter_live(self, partition, after, concurrency, timeout):
+        entry_cls = self.entry_cls
+        with entry_cls.partition_storage(partition) as conn:
+            if self.filters:
+                keys = self._iter_keys_by_filters(conn, after)
+            else:
+                keys = self._iter_keys_by_time(conn, after)
+
+            entries = entry_cls._do_bulk_fetch(
+                    conn,
+                    keys,
+                    concurrency,
+                    timeout,
+                    )
+            for entry in entries:
+                # 索引和对象之间可能有短暂的不一致, 跳过已被删除的
+                if entry is not None:
+                    yield entry
+
+    def _iter_archived(self, partition, manifest, after, concurrency):
+        chunk_keys = None
+        if self.filters:
+            chunk_keys = self.archive.chunk_keys(
+                    partition,
+                    [(idx, value, ) for idx, _, value in self.filters],
+                    )
+            if not chunk_keys:
+                return
+
+        entries = self.archive.iter_entries(
+                partition,
+                manifest,
+                chunk_keys,
+                self.start,
+                self.end,
+                concurrency,
+                )
+        for entry in entries:
+            if after is not None and entry['id'] <= after[1]:
+                continue
+            if all(entry[field] == value for _, field, value in self.filters):
+                yield entry
+
+    def _has_entries(self, partition):
+        if self.archive.load_manifest(partition) is not None:
+            return True
+
+        with self.entry_cls.partition_storage(partition) as conn:
+            results = dblayer.iter_index(
+                    conn,
+                    audit.AUDIT_TIMESTAMP_IDX,
+                    0,
+                    TIMESTAMP_LIMIT,
+                    page_size=1,
+                    )
+            return next(results, None) is not None
+
+    def _first_partition(self):
+        '''返回最早的有记录的分区, 一条记录都没有则返回 :const:`None`.
+
+        找到之后在进程内记 :data:`AUDIT_FIRST_PARTITION_TTL_SECS` 秒.
+
+        '''
+
+        now = time.time()
+        cached = _FIRST_PARTITIONS.get(self.entry_cls)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+
+        for partition in audit.iter_partitions():
+            if self._has_entries(partition):
+                _FIRST_PARTITIONS[self.entry_cls] = (
+                        partition,
+                        now + AUDIT_FIRST_PARTITION_TTL_SECS,
+                        )
+                return partition
+
+        return None
+
+    def _merge_strays(self, archived, live):
+        # 两边都按 ID 排序, 合并成一个序列. 压缩进行到一半时同一条记录可能\
+        # 两边都有, 只取一次
+        merged = heapq.merge(
+                ((entry['id'], 0, entry, ) for entry in archived),
+                ((entry['id'], 1, entry, ) for entry in live),
+                )
+        last_key = None
+        for key, _, entry in merged:
+            if key != last_key:
+                yield entry
+            last_key = key
+
+    def _in_time_range(self, entry):
+        ts = int(entry['ctime'])
+        if self.start is not None and ts < self.start:
+            return False
+        return self.end is None or ts <= self.end
+
+    def iter_entries(self, cursor=None, concurrency=None, timeout=None):
+        '''以流的形式逐个返回符合条件的审计记录.
+
+        :param cursor: 从哪条记录之后开始, 见 :func:`encode_cursor`;
+                :const:`None` 表示从头开始.
+        :type cursor: :data:`six.text_type`
+        :param concurrency: 同时进行的读取请求数上限, 含义同
+                :meth:`RiakDocument.fetch_multiple
+                <luohua.utils.dblayer.RiakDocument.fetch_multiple>`.
+        :type concurrency: int
+        :param timeout: 单个读取请求的时间限制, 单位为秒.
+        :type timeout: float
+        :return: 审计记录的迭代器.
+        :rtype: :data:`types.GeneratorType`
+        :raises ValueError: 游标格式不正确.
+
+        '''
+
+        after = decode_cursor(cursor) if cursor is not None else None
+        first = audit.partition_of_ts(after[0]) if after is not None else None
+
+        if self.start is None:
+            earliest = self._first_partition()
+            if earliest is None:
+                return
+            first = max(first, earliest) if first is not None else earliest
+
+        for partition in audit.iter_partitions(self.start, self.end):
+            # 游标之前的分区不用看了
+            if first is not None and partition < first:
+                continue
+
+            entries = self._iter_live(
+                    partition,
+                    after,
+                    concurrency,
+                    timeout,
+                    )
+
+            manifest = self.archive.load_manifest(partition)
+            if manifest is not None:
+                archived = self._iter_archived(
+                        partition,
+                        manifest,
+                        after,
+                        concurrency,
+                        )
+                entries = self._merge_strays(archived, entries)
+
+            for entry in entries:
+                if self._in_time_range(entry):
+                    yield entry
+
+    def page(self, limit, cursor=None):
+        '''取一页符合条件的审计记录.
+
+        :param limit: 每页最多的记录条数.
+        :type limit: int
+        :param cursor: 上一页返回的游标, 首页传 :const:`None`.
+        :type cursor: :data:`six.text_type`
+        :return: ``(记录列表, 下一页的游标)``; 如果已经是最后一页,
+                游标为 :const:`None`.
+        :rtype: tuple
+        :raises ValueError: 游标格式不正确.
+
+        '''
+
+        # 多取一条, 用来判断后面还有没有
+        entries = list(itertools.islice(self.iter_entries(cursor), limit + 1))
+        if len(entries) <= limit:
+            return entries, None
+
+        entries = entries[:limit]
+        return entries, encode_cursor(entries[-1])
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 认证 / 审计记录异步写入
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'AuditWriter',
+        'install',
+        'replay_spilled',
+        ]
+
+import atexit
+import collections
+import itertools
+import json
+import logging
+import os
+
+import gevent
+import gevent.event
+import redis
+
+from ..rt import pubsub
+
+from . import audit
+from . import auditquery
+
+_LOGGER = logging.getLogger(__name__)
+
+# 缓冲区最多容纳的审计记录条数, 超过时由提交记录的一方同步写入
+AUDIT_QUEUE_SIZE = 10000
+
+# 每批写入的审计记录条数, 缓冲区积累到这个数目时立即唤醒后台 greenlet
+AUDIT_BATCH_SIZE = 50
+
+# 后台 greenlet 两次写入之间最长的间隔, 单位: 秒
+AUDIT_FLUSH_INTERVAL_SECS = 1
+
+# 一条审计记录写入失败后最多尝试的次数, 超过则转存到本地文件
+AUDIT_MAX_ATTEMPTS = 5
+
+# 写不进数据库的审计记录转存的文件, 每行一条 JSON. 相对路径以工作目录为准,
+# WSGI 入口启动时会切换到项目根目录
+AUDIT_SPILL_PATH = 'audit-spill.jsonl'
+
+
+class AuditWriter(object):
+    '''把审计记录缓冲在进程内, 由后台 greenlet 分批写入数据库.
+
+    登录等请求因此不再需要等待审计记录写入 Riak 和通知审计频道. 内存占用\
+    由 ``max_pending`` 限制: 缓冲区满时先就地写出一轮, 如果仍然是满的\
+    (例如数据库暂时不可用), 新的记录就和以前一样同步写入, 错误也照常抛给\
+    调用方. 进程正常退出时会把缓冲区中剩下的记录全部写出.
+
+    记录在提交时就先编码一次, 不合格的记录 (编码器断言失败) 和同步写入\
+    时一样直接在调用方抛出 :exc:`AssertionError`, 不会进入缓冲区.
+
+    写入失败的记录放回缓冲区开头等待下一轮, 每条最多尝试
+    ``max_attempts`` 次. 仍然写不进去的记录按错误级别记入日志, 并追加到
+    ``spill_path`` 文件中, 事后可用 :func:`replay_spilled` 重新写入.
+
+    '''
+
+    def __init__(
+            self,
+            max_pending=AUDIT_QUEUE_SIZE,
+            batch_size=AUDIT_BATCH_SIZE,
+            flush_interval=AUDIT_FLUSH_INTERVAL_SECS,
+            max_attempts=AUDIT_MAX_ATTEMPTS,
+            spill_path=AUDIT_SPILL_PATH,
+            ):
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.spill_path = spill_path
+
+        # 每一项为 [entry, event_type, 已尝试次数]
+        self._pending = collections.deque()
+        self._wakeup = gevent.event.Event()
+        self._writer_pid = None
+        self._stats = {
+                'written': 0,
+                'retried': 0,
+                'dropped': 0,
+                'spilled': 0,
+                'sync_written': 0,
+                'publish_failed': 0,
+                }
+
+    def submit(self, entry, event_type):
+        '''把一条审计记录放入缓冲区.
+
+        :param entry: 审计记录.
+        :type entry: :class:`AuditEntry <luohua.auth.audit.AuditEntry>`
+        :param event_type: 写入后在审计频道发出的事件类型.
+        :type event_type: :data:`six.text_type`
+        :return: :const:`None`
+        :raises AssertionError: 记录不符合编码器的要求.
+
+        '''
+
+        # 先编码一次, 让不合格的记录在这里就报错, 而不是在后台默默重试
+        entry.encode()
+
+        self.ensure_running()
+
+        if len(self._pending) >= self.max_pending:
+            self.flush()
+
+            if len(self._pending) >= self.max_pending:
+                # 数据库大概出问题了, 不能再积压, 退回同步写入
+                audit.write_entry(entry, event_type)
+                self._stats['sync_written'] += 1
+                return
+
+        self._pending.append([entry, event_type, 0])
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    def ensure_running(self):
+        '''保证本进程中有负责写入的 greenlet 在运行.'''
+
+        # 按进程号判断, 这样 fork 出来的 worker 进程也会启动自己的 greenlet
+        pid = os.getpid()
+        if self._writer_pid == pid:
+            return
+
+        self._writer_pid = pid
+        # fork 之前父进程缓冲的记录由父进程负责写入
+        self._pending.clear()
+        gevent.spawn(self._write_forever)
+        atexit.register(self.close)
+
+    def flush(self):
+        '''把当前缓冲区中的记录写出一轮.
+
+        每条记录在一轮中最多尝试一次, 写入失败的记录会留在缓冲区中.
+
+        :return: 本轮成功写入的记录条数.
+        :rtype: :data:`six.integer_types`
+
+        '''
+
+        remaining = len(self._pending)
+        written, retry = 0, []
+        try:
+            while remaining > 0 and self._pending:
+                batch = []
+                while self._pending and remaining > 0:
+                    batch.append(self._pending.popleft())
+                    remaining -= 1
+                    if len(batch) >= self.batch_size:
+                        break
+
+                batch_written, batch_retry = self._write_batch(batch)
+                written += batch_written
+                retry.extend(batch_retry)
+        finally:
+            # 放回缓冲区开头, 保持原来的先后顺序. 中途出错也要放回去
+            self._pending.extendleft(reversed(retry))
+
+        return written
+
+    def close(self):
+        '''写出缓冲区中的全部记录, 进程退出时自动调用.
+
+        写不进去的记录每轮都会消耗一次尝试机会, 所以最多
+        ``max_attempts`` 轮之后一定会返回.
+
+        '''
+
+        while self._pending:
+            self.flush()
+
+    def stats(self):
+        '''返回写入情况的统计数据.
+
+        :return: 包含 ``pending``, ``written``, ``retried``, ``dropped``,
+                ``spilled``, ``sync_written`` 和 ``publish_failed`` 的字典.
+        :rtype: dict
+
+        '''
+
+        result = dict(self._stats)
+        result['pending'] = len(self._pending)
+        return result
+
+    def _write_group(self, storage, items, written, failed):
+        done = len(written) + len(failed)
+        try:
+            with storage as conn:
+                for item in items:
+                    try:
+                        item[0].save_to_conn(conn)
+                    except Exception:
+                        failed.append(item)
+                    else:
+                        written.append(item)
+        except Exception:
+            # 连数据库连接都拿不到, 这一组还没处理的全部算作失败
+            processed = len(written) + len(failed) - done
+            failed.extend(items[processed:])
+
+    def _write_batch(self, batch):
+        written, failed = [], []
+
+        # 同一分区的记录共用一条连接. 记录是按时间顺序提交的, 一批里通常
+        # 只有一个分区
+        groups = itertools.groupby(batch, lambda item: item[0].partition)
+        for partition, items in groups:
+            storage = batch[0][0].partition_storage(partition)
+            self._write_group(storage, list(items), written, failed)
+
+        retry = []
+        for item in failed:
+            item[2] += 1
+            if item[2] < self.max_attempts:
+                retry.append(item)
+            else:
+                self._drop(item)
+
+        self._stats['retried'] += len(retry)
+        self._stats['written'] += len(written)
+
+        for entry, event_type, _ in written:
+            try:
+                pubsub.publish_event('_auditlog', event_type, obj=entry)
+            except redis.RedisError:
+                self._stats['publish_failed'] += 1
+            except Exception:
+                # 记录已经写进去了, 通知发不出去不能影响其他记录
+                _LOGGER.exception('failed to publish audit entry %r', entry)
+                self._stats['publish_failed'] += 1
+
+        return len(written), retry
+
+    def _drop(self, item):
+        entry, event_type, attempts = item
+        self._stats['dropped'] += 1
+        _LOGGER.error(
+                'audit entry %r (%s) not written after %d attempts',
+                entry,
+                event_type,
+                attempts,
+                )
+
+        # 写不进数据库的记录可能本身就有问题 (比如参数无法序列化), 转存失败\
+        # 也只记日志, 不能把异常抛给后台 greenlet
+        try:
+            line = json.dumps({
+                    'id': entry['id'],
+                    'data': entry.encode(),
+                    'event_type': event_type,
+                    })
+            with open(self.spill_path, 'a') as fp:
+                fp.write(line + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+        except Exception:
+            _LOGGER.exception(
+                    'failed to spill audit entry %r to %s',
+                    entry,
+                    self.spill_path,
+                    )
+        else:
+            self._stats['spilled'] += 1
+
+    def _write_forever(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            # 任何错误都不能让写入 greenlet 退出, 否则本进程的记录只会越积\
+            # 越多, 再也写不出去
+            try:
+                if self._pending:
+                    self.flush()
+            except Exception:
+                _LOGGER.exception('audit writer flush failed')
+
+
+def install(**kwargs):
+    '''在当前进程中启用审计记录的异步写入.
+
+    参数含义见 :class:`AuditWriter`.
+
+    '''
+
+    audit.install_writer(AuditWriter(**kwargs))
+
+
+def replay_spilled(path=AUDIT_SPILL_PATH):
+    '''把转存到本地文件的审计记录重新同步写入数据库.
+
+    写入成功的记录从文件中移除, 仍然失败的留在文件里等下次重试.
+
+    :param path: 转存文件的路径.
+    :type path: :data:`six.text_type`
+    :return: 成功写入的记录条数.
+    :rtype: :data:`six.integer_types`
+
+    '''
+
+    try:
+        with open(path) as fp:
+            lines = [line for line in fp if line.strip()]
+    except (IOError, OSError):
+        return 0
+
+    written, remaining = 0, []
+    for line in lines:
+        record = json.loads(line)
+        entry = audit.AuditEntry(record['data'], record['id'])
+        try:
+            audit.write_entry(entry, record['event_type'])
+        except Exception:
+            _LOGGER.exception('failed to replay audit entry %s', record['id'])
+            remaining.append(line)
+        else:
+            written += 1
+
+    # 记录保留着原来的时间, 可能写进了以前的分区
+    if written:
+        auditquery.clear_first_partitions()
+
+    # 先写临时文件再改名, 中途出错也不会丢掉还没写入的记录
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        fp.writelines(remaining)
+    os.rename(tmp_path, path)
+
+    return written
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -23,12 +23,15 @@ __all__ = [
         'has_cap',
         'combine_caps',
         'canonicalize_caps',
+        'compile_caps',
+        'CompiledCaps',
         'Role',
         ]
 
 import six
 import itertools
 
+from ..utils import dblayer
 from ..utils.dblayer import RiakDocument
 from ..utils.stringop import escape_lucene
 
@@ -36,6 +39,12 @@ ROLE_STRUCT_ID = 'luohua.role'
 
 OMNI_CAP = '*'
 
+# 编译后的权限表缓存的容量 (角色组合的个数)
+COMPILED_CAPS_CACHE_SIZE = 256
+
+# 角色 ID 元组 -> CompiledCaps 的缓存, 第一次用到时创建
+_COMPILED_CAPS_CACHE = []
+
 
 def _check_valid_cap(cap, allow_omni):
     '''检查权限名合法性.
@@ -55,11 +64,77 @@ def _check_valid_cap(cap, allow_omni):
         raise ValueError('minus sign cannot precede capability name')
 
 
-def has_cap(caps, requested_cap):
-    '''检查给定的权限表是否具备指定的权限, 指定权限可以是全能权限 (``*``).
+class CompiledCaps(object):
+    '''编译后的权限表, 用于频繁的权限检查.
+
+    构造时就把授予权限和剥夺权限分开, 并记下是否有全能权限, 之后每次检查\
+    只需要一两次集合查找. 对象构造后不应修改.
+
+    ``cap in compiled`` 按权限检查的语义判断, 与 :meth:`has` 相同 (不检查\
+    权限名合法性); 迭代则得到原始的权限表.
+
+    '''
+
+    __slots__ = ('caps', 'positive', 'negative', 'omni', )
+
+    def __init__(self, caps):
+        self.caps = frozenset(caps)
+        self.negative = frozenset(
+                cap[1:] for cap in self.caps if cap[0] == '-'
+                )
+        self.positive = frozenset(
+                cap for cap in self.caps if cap[0] != '-'
+                )
+        self.omni = OMNI_CAP in self.caps
+
+    def __repr__(self):
+        return '<CompiledCaps %r>' % (sorted(self.caps), )
+
+    def __iter__(self):
+        return iter(self.caps)
+
+    def __len__(self):
+        return len(self.caps)
+
+    def __contains__(self, cap):
+        return self.has(cap)
+
+    def has(self, cap):
+        '''检查是否具备指定的权限, 不检查权限名合法性.
+
+        :param cap: 所请求的权限, 可以是全能权限 (``*``).
+        :type cap: :data:`six.text_type`
+        :rtype: bool
+
+        '''
+
+        # 拒绝压倒一切
+        if cap in self.negative:
+            return False
+
+        # 全能权限
+        # 已经处理过拒绝权限了所以直接返回就行了
+        return self.omni or cap in self.positive
+
+
+def compile_caps(caps):
+    '''把权限表编译为 :class:`CompiledCaps` 对象.
 
     :param caps: 权限表, 需要是可迭代对象.
     :type caps: :data:`types.GeneratorType`
+    :rtype: :class:`CompiledCaps`
+
+    '''
+
+    return caps if isinstance(caps, CompiledCaps) else CompiledCaps(caps)
+
+
+def has_cap(caps, requested_cap):
+    '''检查给定的权限表是否具备指定的权限, 指定权限可以是全能权限 (``*``).
+
+    :param caps: 权限表, 需要是可迭代对象. 需要反复检查同一权限表的话,
+            最好先用 :func:`compile_caps` 编译一下.
+    :type caps: :data:`types.GeneratorType` 或 :class:`CompiledCaps`
     :param requested_cap: 所请求的权限.
     :type requested_cap: :data:`six.text_type`
     :return: 权限检查的结果, :const:`True` 为具备所指权限, 反之不具备.
@@ -69,19 +144,10 @@ def has_cap(caps, requested_cap):
 
     _check_valid_cap(requested_cap, True)
 
-    caps_set = set(caps) if not isinstance(caps, set) else caps
-    negative_caps = set(cap[1:] for cap in caps_set if cap[0] == '-')
-
-    # 拒绝压倒一切
-    if requested_cap in negative_caps:
-        return False
+    if not isinstance(caps, CompiledCaps):
+        caps = compile_caps(caps)
 
-    # 全能权限
-    # 已经处理过拒绝权限了所以直接返回就行了
-    if OMNI_CAP in caps_set:
-        return True
-
-    return requested_cap in caps_set
+    return caps.has(requested_cap)
 
 
 def combine_caps(*caps_list):
@@ -138,6 +204,9 @@ class Role(RiakDocument):
 
     struct_id = ROLE_STRUCT_ID
 
+    # 每次权限检查都要读取用户的所有角色, 而角色极少变动
+    cache_ttl = 300
+
     def __contains__(self, key):
         return self.hascap(key)
 
@@ -170,6 +239,28 @@ class Role(RiakDocument):
                 if r is not None
                 ])
 
+    @classmethod
+    def compiled_caps(cls, rids):
+        '''返回所请求角色的权限总和, 编译为 :class:`CompiledCaps` 对象.
+
+        结果按角色组合缓存在进程内, 有效期与角色文档的缓存相同; 任何一个\
+        角色被保存或删除 (包括在其他进程中) 时整个缓存都会被清空.
+
+        :param rids: 角色 ID 列表.
+        :type rids: list
+        :rtype: :class:`CompiledCaps`
+
+        '''
+
+        cache = _get_compiled_caps_cache()
+        key = tuple(sorted(set(rids)))
+        result = cache.get(key)
+        if result is None:
+            result = CompiledCaps(cls.allcaps(key))
+            cache.put(key, result)
+
+        return result
+
     def grant_cap(self, cap):
         '''授予该角色一个权限.
 
@@ -215,6 +306,28 @@ class Role(RiakDocument):
             pass
 
 
+def _get_compiled_caps_cache():
+    try:
+        return _COMPILED_CAPS_CACHE[0]
+    except IndexError:
+        pass
+
+    # 角色文档不缓存的话, 编译结果也不应该缓存
+    ttl = Role.cache_ttl if Role.cache_ttl is not None else 0
+    cache = dblayer.DocumentCache(ttl, COMPILED_CAPS_CACHE_SIZE)
+    _COMPILED_CAPS_CACHE.append(cache)
+    return cache
+
+
+def _invalidate_compiled_caps(rid):
+    # 一个角色可能出现在很多组合里, 直接全部清掉; 角色极少变动, 无所谓
+    if _COMPILED_CAPS_CACHE:
+        _COMPILED_CAPS_CACHE[0].clear()
+
+
+dblayer.add_invalidation_hook(ROLE_STRUCT_ID, _invalidate_compiled_caps)
+
+
 # 数据库序列化/反序列化
 @Role.decoder(1)
 def role_dec_v1(data):
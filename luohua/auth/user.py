@@ -57,6 +57,9 @@ class User(dblayer.RiakDocument):
     struct_id = USER_STRUCT_ID
     uses_2i = True
 
+    # 会话中间件每个请求都要取一次当前用户
+    cache_ttl = 60
+
     def __init__(self, data=None, uid=None, rawobj=None):
         super(User, self).__init__(data, uid, rawobj)
 
@@ -135,7 +138,12 @@ class User(dblayer.RiakDocument):
 
     @property
     def caps(self):
-        return role.Role.allcaps(self['roles'])
+        '''用户所有角色的权限总和, 是 :class:`luohua.auth.role.CompiledCaps`
+        对象, 可以直接用 ``cap in user.caps`` 检查权限.
+
+        '''
+
+        return role.Role.compiled_caps(self['roles'])
 
     @property
     def ident(self):
@@ -267,8 +275,13 @@ def user_dec_v1(data):
     # NOTE: 密码的 uid 字段只有 KBS 的 hash 算法用到, 而只有 KBS 导入的用户
     # 才有 KBS 格式的 hash, 所以这里对没有设置别名的用户传入空字符串是完全
     # 没有问题的
+    # 每个请求都要读取会话用户, 但只有登录时才用到密码, 所以延迟构造
     return {
-            'password': passwd.Password(alias or '', data['p']),
+            'password': dblayer.LazyField(
+                passwd.Password,
+                alias or '',
+                data['p'],
+                ),
             'alias': alias,
             'display_name': data['nd'],
             'display_name_mtime': data['ndm'],
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 性能测试
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division, print_function
+
+__all__ = [
+        'run_cases',
+        ]
+
+import timeit
+
+
+def run_cases(title, cases, number, ops_per_call=1):
+    '''运行一组性能测试用例并输出结果.
+
+    各子模块都可以用 ``python -m luohua.bench.<名字>`` 的方式直接运行.
+
+    :param title: 这组用例的标题.
+    :type title: :data:`six.text_type`
+    :param cases: ``(名称, 无参数函数)`` 的列表.
+    :type cases: list
+    :param number: 每个函数调用的次数.
+    :type number: int
+    :param ops_per_call: 每次调用完成的操作数, 用于计算单次操作耗时.
+    :type ops_per_call: int
+    :return: 名称到单次操作耗时 (微秒) 的映射.
+    :rtype: dict
+
+    '''
+
+    print('== %s (%d calls x %d ops) ==' % (title, number, ops_per_call, ))
+
+    results = {}
+    for name, fn in cases:
+        # 取三轮中最快的一轮, 减少其他进程干扰
+        elapsed = min(timeit.repeat(fn, repeat=3, number=number))
+        per_op_us = elapsed * 1e6 / (number * ops_per_call)
+        results[name] = per_op_us
+        print('%-36s %10.3f us/op' % (name, per_op_us, ))
+
+    print()
+    return results
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
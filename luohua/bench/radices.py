@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 性能测试 / 数制转换
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division, print_function
+
+import functools
+import random
+
+from ..utils import radices
+from ..utils import radixcodec
+from . import run_cases
+
+# 批量转换的测试规模
+BULK_SIZE = 1000
+
+
+def main():
+    # 固定随机种子, 保证每次比较的输入相同
+    rng = random.Random(42)
+    # 与生成 ID 时相当的数: 秒级时间戳, 毫秒级时间戳, 工作进程号
+    ts = 1400000000
+    ts_ms = ts * 1000
+    ints = [rng.randrange(ts_ms) for i in range(BULK_SIZE)]
+    strs36 = [radices.to36(x) for x in ints]
+    strs62 = [radices.to62(x) for x in ints]
+
+    run_cases(
+            'encode single int',
+            [
+                ('radices.to36', functools.partial(radices.to36, ts_ms)),
+                ('radixcodec.encode36', functools.partial(
+                    radixcodec.encode36,
+                    ts_ms,
+                    )),
+                ('radices.to62', functools.partial(radices.to62, ts_ms)),
+                ('radixcodec.encode62', functools.partial(
+                    radixcodec.encode62,
+                    ts_ms,
+                    )),
+                ],
+            100000,
+            )
+
+    run_cases(
+            'encode fixed width',
+            [
+                ('radices.to36 + rjust',
+                    lambda: radices.to36(1).rjust(4, '0')),
+                ('radixcodec.encode36_fixed', functools.partial(
+                    radixcodec.encode36_fixed,
+                    1,
+                    4,
+                    )),
+                ],
+            100000,
+            )
+
+    run_cases(
+            'bulk of %d ints' % (BULK_SIZE, ),
+            [
+                ('radices.to36 x N', lambda: [radices.to36(x) for x in ints]),
+                ('radixcodec.encode36_many', functools.partial(
+                    radixcodec.encode36_many,
+                    ints,
+                    )),
+                ('radixcodec.encode36_fixed_many', functools.partial(
+                    radixcodec.encode36_fixed_many,
+                    ints,
+                    9,
+                    )),
+                ('radices.to62 x N', lambda: [radices.to62(x) for x in ints]),
+                ('radixcodec.encode62_many', functools.partial(
+                    radixcodec.encode62_many,
+                    ints,
+                    )),
+                ('radices.from36 x N',
+                    lambda: [radices.from36(s) for s in strs36]),
+                ('radixcodec.decode36_many', functools.partial(
+                    radixcodec.decode36_many,
+                    strs36,
+                    )),
+                ('radices.from62 x N',
+                    lambda: [radices.from62(s) for s in strs62]),
+                ('radixcodec.decode62_many', functools.partial(
+                    radixcodec.decode62_many,
+                    strs62,
+                    )),
+                ],
+            100,
+            BULK_SIZE,
+            )
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 性能测试 / 实时事件分发
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division, print_function
+
+import json
+
+from socketio import packet
+from socketio.defaultjson import default_json_dumps
+
+from ..rt import hub
+from . import run_cases
+
+# 一次全局广播的接收者数目
+CLIENTS = 1000
+
+# 与 user_online 事件相当的消息
+RAW_MESSAGE = json.dumps({
+        'type': 'user_online',
+        'uid': 'someone',
+        'display_name': '某个用户' * 4,
+        })
+
+
+def _per_client():
+    # 原先的做法: 每个连接各自解码, 拆出 type, 再由 emit 编码
+    for i in range(CLIENTS):
+        data = json.loads(RAW_MESSAGE)
+        data_type = data.pop('type')
+        packet.encode(
+                {
+                    'type': 'event',
+                    'name': 'rtEvent',
+                    'args': [
+                        {
+                            'channel': hub.GLOBAL_EVENT_CHANNEL,
+                            'type': data_type,
+                            'data': data,
+                            },
+                        ],
+                    'endpoint': '/rt',
+                    },
+                default_json_dumps,
+                )
+
+
+def _shared_frame():
+    event = hub.Event(hub.GLOBAL_EVENT_CHANNEL, json.loads(RAW_MESSAGE))
+    for i in range(CLIENTS):
+        event.frame('/rt')
+
+
+def main():
+    run_cases(
+            'broadcast to %d clients' % (CLIENTS, ),
+            [
+                ('decode + emit per client', _per_client),
+                ('hub.Event shared frame', _shared_frame),
+                ],
+            20,
+            CLIENTS,
+            )
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
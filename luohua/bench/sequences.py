@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 性能测试 / 序列生成
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division, print_function
+
+import functools
+
+from ..utils import sequences
+from . import run_cases
+
+# 批量生成的测试规模, 大致相当于一次导入或一批审计记录
+BULK_SIZE = 1000
+
+
+def main():
+    # 固定工作进程号, 免得依赖 Redis
+    alloc = sequences.UniqueIDAllocator(1)
+    alloc_ms = sequences.UniqueIDAllocator(1, millis=True)
+
+    run_cases(
+            'single id',
+            [
+                ('time_ascending_suffixed', sequences.time_ascending_suffixed),
+                ('time_ascending_short_suffixed',
+                    sequences.time_ascending_short_suffixed),
+                ('UniqueIDAllocator.ascending', alloc.ascending),
+                ('UniqueIDAllocator.ascending (ms)', alloc_ms.ascending),
+                ('UniqueIDAllocator.descending (ms)', alloc_ms.descending),
+                ],
+            10000,
+            )
+
+    def suffixed_loop():
+        fn = sequences.time_ascending_suffixed
+        return [fn() for i in range(BULK_SIZE)]
+
+    def unique_loop():
+        fn = alloc_ms.ascending
+        return [fn() for i in range(BULK_SIZE)]
+
+    run_cases(
+            'bulk of %d ids' % (BULK_SIZE, ),
+            [
+                ('time_ascending_suffixed x N', suffixed_loop),
+                ('UniqueIDAllocator.ascending x N', unique_loop),
+                ('UniqueIDAllocator.bulk', functools.partial(
+                    alloc_ms.bulk,
+                    BULK_SIZE,
+                    )),
+                ],
+            20,
+            BULK_SIZE,
+            )
+
+
+if __name__ == '__main__':
+    main()
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
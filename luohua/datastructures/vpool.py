@@ -38,6 +38,7 @@ class VPool(RiakDocument):
     '''
 
     struct_id = VTP_STRUCT_ID
+    cache_ttl = 300
 
     def __init__(self, data=None, vtpid=None, rawobj=None):
         super(VPool, self).__init__(data, vtpid, rawobj)
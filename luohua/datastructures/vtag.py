@@ -43,6 +43,7 @@ class VTag(RiakDocument):
 
     struct_id = VTAG_STRUCT_ID
     uses_2i = True
+    cache_ttl = 300
 
     def __init__(self, data=None, vtagid=None, rawobj=None):
         super(VTag, self).__init__(data, vtagid, rawobj)
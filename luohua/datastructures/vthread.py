@@ -19,11 +19,21 @@
 
 from __future__ import unicode_literals, division
 
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import array
+import base64
+import bisect
+
 import six
 
-from weiyu.helpers.misc import smartbytes
+from weiyu.helpers.misc import smartbytes, smartstr
 
-from ..utils.dblayer import RiakDocument
+from ..utils import redispool
+from ..utils.dblayer import LazyField, RiakDocument
 from ..utils.sequences import time_descending
 from .vfile import VFile
 
@@ -35,6 +45,61 @@ VTH_CTIME_INDEX = b'ctime_int'
 VTH_MTIME_INDEX = b'mtime_int'
 VTH_VTAG_CTIME_COMPOSITE_INDEX = b'vtagctime_bin'
 VTH_VTAG_MTIME_COMPOSITE_INDEX = b'vtagmtime_bin'
+VTH_VTAG_MTIME_SUMMARY_INDEX = b'vtagmtimesum_bin'
+
+# 虚线索新鲜度信息 (最后变化时间和树版本) 的存储, 条件请求据此判断能否
+# 直接返回 304, 不用读取 Riak
+VTH_FRESHNESS_STORAGE_ID = 'luohua.vth.freshness'
+VTH_FRESHNESS_HASH_KEY = 'hash:vth:freshness'
+
+
+def _encode_summary(vth):
+    '''把虚线索的摘要信息编码成可以放进索引值的字符串.
+
+    Riak 的 HTTP 协议会把索引值放在 HTTP 头里, 以逗号分隔多个值, 所以这里
+    用 URL-safe Base64 把 JSON 包一层, 避免标题里的逗号和非 ASCII 字符
+    带来麻烦.
+
+    '''
+
+    payload = json.dumps({
+            't': vth['title'],
+            'o': vth['owner'],
+            'c': vth['ctime'],
+            'm': vth['mtime'],
+            })
+    return smartstr(base64.urlsafe_b64encode(smartbytes(payload)))
+
+
+def _get_freshness_redis():
+    '''获取新鲜度存储的 StrictRedis 客户端对象.'''
+
+    return redispool.get_client(VTH_FRESHNESS_STORAGE_ID)
+
+
+def _encode_freshness(vth):
+    return '%d:%d' % (vth['mtime'], vth['tree'].version, )
+
+
+def _decode_summary(vthid, encoded):
+    data = json.loads(base64.urlsafe_b64decode(smartbytes(encoded)))
+    return {
+            'id': vthid,
+            'title': data['t'],
+            'owner': data['o'],
+            'ctime': data['c'],
+            'mtime': data['m'],
+            }
+
+
+# 节点位置编号数组的类型码; Python 2 的 array 只认 str 类型的类型码
+_POS_TYPECODE = str('i')
+
+
+def _intern_id(node):
+    # Python 3 的字符串可以直接 intern; Python 2 的 intern 不接受 unicode,
+    # 这时只能原样使用, 好在索引里引用的也是树里的同一个对象
+    return six.moves.intern(node) if isinstance(node, str) else node
 
 
 class VThreadTree(object):
@@ -46,25 +111,35 @@ class VThreadTree(object):
     * 单名 "线索" 的英文名 ``Thread`` 和 "线程" 冲突,
     * 主要使用场景下线索的节点都是虚文件, 为了一致性而取了这个名字.
 
+    构造时只保存嵌套列表, 节点索引在第一次需要时才建立, 所以只读取线索\
+    状态或原样输出树形结构的场合不必为索引付出代价. 索引中每个节点占用\
+    一个位置编号, 父节点和所在楼层用 :mod:`array` 按位置编号紧凑存放.
+
     '''
 
+    __slots__ = (
+            '_tree',
+            '_ids',
+            '_index',
+            '_parents',
+            '_rows',
+            '_timeorder',
+            )
+
     def __init__(self, l):
         self._tree = l
-        self._build_state()
+        self._index = None
 
     def __len__(self):
         '''本条虚线索的直接回复和楼中楼回复数.'''
 
-        # 为了性能, 假定所有 node 对象在上面的字典里都不冲突
-        # 这一点对实际使用情况的 VFile 对象做节点的情况是成立的
-        # 于是节点总数就是节点字典的总长啦
-        # self._len = 1 + sum(len(reply_l) for reply_l in self._tree[1:])
-        return len(self._flatnodes)
+        self._ensure_state()
+        return len(self._ids)
 
     def num_direct_children(self):
         '''本条虚线索的直接回复数.'''
 
-        return len(self._directreplies) - 1
+        return len(self._tree) - 1
 
     def num_pages(self, limit):
         '''本条虚线索总共需要占用的页数.'''
@@ -75,7 +150,8 @@ class VThreadTree(object):
     def __contains__(self, obj):
         '''判断某元素是否属于这条虚线索.'''
 
-        return obj in self._nodes
+        self._ensure_state()
+        return obj in self._index
 
     @property
     def tree(self):
@@ -91,14 +167,26 @@ class VThreadTree(object):
     def root(self):
         '''提供对虚线索根节点的只读访问.'''
 
-        return self._root
+        return self._tree[0]
+
+    @property
+    def version(self):
+        '''虚线索树的版本号.
+
+        树只会添加节点, 所以直接用节点总数作为版本号, 每次变化都会增大.
+        不需要建立索引.
+
+        '''
+
+        return 1 + sum(len(reply_l) for reply_l in self._tree[1:])
 
     def iter(self):
         '''按时间顺序遍历所有直接回复.'''
 
-        yield self._root
-        for node in self._nodes[self._root]:
-            yield node
+        tree = self._tree
+        yield tree[0]
+        for reply_l in tree[1:]:
+            yield reply_l[0]
 
     def iter_time_order(self):
         '''按时间顺序遍历所有直接回复和楼中楼回复.
@@ -107,10 +195,9 @@ class VThreadTree(object):
 
         '''
 
-        # 直接对节点排序
-        # 这一步的排序肯定需要避免重复进行, 否则时间复杂度会非常坏
-        # TODO: 把结果缓存
-        return sorted(self._flatnodes.iterkeys())
+        # 时序索引在构造和添加回复时维护, 这里不需要再排序
+        self._ensure_state()
+        return iter(self._timeorder)
 
     def iter_paginated(self, limit, idx):
         '''按时间顺序对所有直接回复和楼中楼回复进行分页.
@@ -119,11 +206,9 @@ class VThreadTree(object):
 
         '''
 
-        # 需要借助上一步构造的时序遍历结果进行分页.
-        # 如果上一步有缓存的话, 这一步的复杂度就是 O(n), 否则至少是 O(n^2)
-        # TODO: 这一步的结果可能也需要缓存. 做 profile 确定必要性
-        timeorder = list(self.iter_time_order())
-        return iter(timeorder[limit * idx:limit * (idx + 1)])
+        # 直接切片时序索引, 复杂度只和页大小有关
+        self._ensure_state()
+        return iter(self._timeorder[limit * idx:limit * (idx + 1)])
 
     def append_to(self, in_reply_to, obj):
         '''添加回复.
@@ -133,59 +218,81 @@ class VThreadTree(object):
 
         '''
 
+        obj = _intern_id(obj)
+
         if in_reply_to is None:
             # 直接回复
             self._tree.append([obj, ])
 
-            # 更新缓存
-            self._directreplies.append(obj)
-            self._reply_idx_map[obj] = len(self._tree) - 1  # 因为是最后一个
-            self._nodes[self._root].append(obj)
-            self._nodes[obj] = []
-            self._flatnodes[obj] = self._root
+            # 索引还没建立的话, 等到用的时候再从树上建立就是了
+            if self._index is not None:
+                self._add_node(obj, 0, len(self._tree) - 1)
 
             return
 
         # 寻找指定元素
-        if in_reply_to not in self._nodes:
+        self._ensure_state()
+        pos = self._index.get(in_reply_to)
+        if pos is None or self._parents[pos] != 0:
             # 能执行到这里也可能是因为压根不存在, 反正不是直接回复就对了
             raise ValueError("%s is not a direct reply" % repr(in_reply_to))
 
         # 更新树
-        self._tree[self._reply_idx_map[in_reply_to]].append(obj)
+        row = self._rows[pos]
+        self._tree[row].append(obj)
 
-        # 更新缓存
-        self._nodes[in_reply_to].append(obj)
-        self._flatnodes[obj] = in_reply_to
+        # 更新索引
+        self._add_node(obj, pos, row)
 
         return
 
-    def _build_state(self):
-        # 从嵌套列表构造树形结构
-        # 先是根节点
-        root = self._root = self._tree[0]
-        self._nodes = {root: [reply_l[0] for reply_l in self._tree[1:]], }
-        self._flatnodes = {root: None, }
-
-        # 直接回复列表
-        self._directreplies = [root] + self._nodes[root]
+    def _add_node(self, obj, parent_pos, row):
+        self._index[obj] = len(self._ids)
+        self._ids.append(obj)
+        self._parents.append(parent_pos)
+        self._rows.append(row)
 
-        # 直接回复对应原树形结构 index 的映射
-        self._reply_idx_map = {}
+        # 节点 ID 按时间递增, 新回复几乎总是排在最后, 先检查这种情况
+        timeorder = self._timeorder
+        if not timeorder or timeorder[-1] < obj:
+            timeorder.append(obj)
+        else:
+            bisect.insort(timeorder, obj)
 
-        for reply_idx, reply_l in enumerate(self._tree[1:]):
-            reply_root, subreplies = reply_l[0], reply_l[1:]
+    def _ensure_state(self):
+        if self._index is None:
+            self._build_state()
 
-            # 更新 index 缓存
-            # 注意那个 reply_idx 应该加上 1 才能对上原列表的序号
-            self._reply_idx_map[reply_root] = reply_idx + 1
-
-            # 更新树形结构缓存
-            self._nodes[reply_root] = subreplies
+    def _build_state(self):
+        # 从嵌套列表构造索引, 顺便把树上的节点 ID 换成 intern 过的
+        tree = self._tree
+        root = tree[0] = _intern_id(tree[0])
+
+        # 位置编号 0 是根节点, 其父节点记为 -1
+        ids = [root]
+        parents = array.array(_POS_TYPECODE, [-1])
+        rows = array.array(_POS_TYPECODE, [0])
+
+        for row in six.moves.range(1, len(tree)):
+            reply_l = tree[row]
+            reply_l[:] = [_intern_id(node) for node in reply_l]
+
+            # 直接回复的父节点是根节点, 楼中楼回复的父节点是本楼的直接回复
+            reply_pos = len(ids)
+            ids.extend(reply_l)
+            parents.append(0)
+            parents.extend([reply_pos] * (len(reply_l) - 1))
+            rows.extend([row] * len(reply_l))
+
+        # 为了性能, 假定所有节点 ID 都不重复
+        # 这一点对实际使用情况的 VFile 对象做节点的情况是成立的
+        self._ids = ids
+        self._parents = parents
+        self._rows = rows
+        self._index = {node: pos for pos, node in enumerate(ids)}
 
-            # 更新节点前驱缓存
-            self._flatnodes[reply_root] = root
-            self._flatnodes.update({sr: reply_root for sr in subreplies})
+        # 所有节点的时序索引, 之后由 append_to 增量维护
+        self._timeorder = sorted(ids)
 
 
 class VThread(RiakDocument):
@@ -202,16 +309,88 @@ class VThread(RiakDocument):
         super(VThread, self).__init__(data, vthid, rawobj)
 
     @classmethod
-    def _from_vtag(cls, idx, vtagid, time_start, time_end):
+    def peek_freshness(cls, vthid):
+        '''不读取虚线索本体, 查询其最后变化时间和树版本号.
+
+        :param vthid: 虚线索 ID.
+        :type vthid: :data:`six.text_type`
+        :return: ``(mtime, tree_version)``; 没有记录则返回 :const:`None`,
+                此时应读取虚线索本体.
+        :rtype: tuple
+
+        '''
+
+        result = _get_freshness_redis().hget(VTH_FRESHNESS_HASH_KEY, vthid)
+        if result is None:
+            return None
+
+        mtime, version = smartstr(result).split(':')
+        return int(mtime), int(version)
+
+    def remember_freshness(self):
+        '''为没有新鲜度记录的虚线索补上记录.
+
+        已有记录的话不覆盖, 免得读到旧版本的请求盖掉刚保存的新记录.
+
+        '''
+
+        _get_freshness_redis().hsetnx(
+                VTH_FRESHNESS_HASH_KEY,
+                self['id'],
+                _encode_freshness(self),
+                )
+
+    def save_to_conn(self, conn):
+        super(VThread, self).save_to_conn(conn)
+
+        _get_freshness_redis().hset(
+                VTH_FRESHNESS_HASH_KEY,
+                self['id'],
+                _encode_freshness(self),
+                )
+
+    def purge(self):
+        vthid = self.get('id')
+        super(VThread, self).purge()
+
+        if vthid is not None:
+            _get_freshness_redis().hdel(VTH_FRESHNESS_HASH_KEY, vthid)
+
+    @staticmethod
+    def _vtag_time_range(vtagid, time_start, time_end):
         # 复合索引 key
         key_start = '%s_%s' % (vtagid, time_descending(time_start), )
         key_end = '%s_%s' % (vtagid, time_descending(time_end), )
+        return key_start, key_end
+
+    @classmethod
+    def _from_vtag(cls, idx, vtagid, time_start, time_end):
+        key_start, key_end = cls._vtag_time_range(vtagid, time_start, time_end)
         return cls._do_fetch_range_by_index(
                 idx,
                 key_start,
                 key_end,
                 )
 
+    @classmethod
+    def _from_vtag_paginated(
+            cls,
+            idx,
+            vtagid,
+            time_start,
+            time_end,
+            limit,
+            continuation,
+            ):
+        key_start, key_end = cls._vtag_time_range(vtagid, time_start, time_end)
+        return cls._do_fetch_range_page_by_index(
+                idx,
+                key_start,
+                key_end,
+                limit,
+                continuation,
+                )
+
     @classmethod
     def from_vtag_ctime(cls, vtagid, time_start, time_end):
         return cls._from_vtag(
@@ -230,6 +409,72 @@ class VThread(RiakDocument):
                 time_end,
                 )
 
+    @classmethod
+    def from_vtag_mtime_paginated(
+            cls,
+            vtagid,
+            time_start,
+            time_end,
+            limit,
+            continuation=None,
+            ):
+        '''分页返回指定虚标签中, 最后变化时间在指定区间内的虚线索.
+
+        :return: ``(虚线索列表, 下一页的 continuation)``; 已经是最后一页时
+                continuation 为 :const:`None`.
+        :rtype: tuple
+
+        '''
+
+        return cls._from_vtag_paginated(
+                VTH_VTAG_MTIME_COMPOSITE_INDEX,
+                vtagid,
+                time_start,
+                time_end,
+                limit,
+                continuation,
+                )
+
+    @classmethod
+    def summaries_from_vtag_mtime(
+            cls,
+            vtagid,
+            time_start,
+            time_end,
+            limit,
+            continuation=None,
+            ):
+        '''分页返回指定虚标签中, 最后变化时间在指定区间内的虚线索摘要.
+
+        摘要直接从索引值中解出, 不读取也不解码虚线索本体. 每条摘要是包含
+        ``id``, ``title``, ``owner``, ``ctime`` 和 ``mtime`` 的字典.
+        排列顺序和分页方式与 :meth:`.from_vtag_mtime_paginated` 相同.
+
+        :return: ``(摘要列表, 下一页的 continuation)``.
+        :rtype: tuple
+
+        '''
+
+        key_start, key_end = cls._vtag_time_range(vtagid, time_start, time_end)
+
+        # 摘要索引值形如 "<vtagid>_<递减时间戳>_<摘要>", 所以结束值后面要
+        # 补一个比 '_' 大的字符, 才能把结束时间那一秒的记录也包括进来
+        terms, next_continuation = cls._do_fetch_range_terms_page_by_index(
+                VTH_VTAG_MTIME_SUMMARY_INDEX,
+                key_start,
+                key_end + '~',
+                limit,
+                continuation,
+                )
+
+        prefix_len = len(vtagid) + 1
+        result = []
+        for term, vthid in terms:
+            _, encoded = term[prefix_len:].split('_', 1)
+            result.append(_decode_summary(vthid, encoded))
+
+        return result, next_continuation
+
     def _do_sync_2i(self, obj):
         # 同步 2i 索引
         # 时间
@@ -249,11 +494,15 @@ class VThread(RiakDocument):
         obj.remove_index(VTH_VTAG_INDEX)
         obj.remove_index(VTH_VTAG_CTIME_COMPOSITE_INDEX)
         obj.remove_index(VTH_VTAG_MTIME_COMPOSITE_INDEX)
+        obj.remove_index(VTH_VTAG_MTIME_SUMMARY_INDEX)
 
         # 递减时间戳字符串
         descending_ctime = time_descending(ctime)
         descending_mtime = time_descending(mtime)
 
+        # 列表摘要
+        summary = _encode_summary(self)
+
         for vtag in new_vtags_set:
             obj.add_index(VTH_VTAG_INDEX, smartbytes(vtag))
 
@@ -262,17 +511,25 @@ class VThread(RiakDocument):
             obj.add_index(VTH_VTAG_CTIME_COMPOSITE_INDEX, ctime_idx_val)
             obj.add_index(VTH_VTAG_MTIME_COMPOSITE_INDEX, mtime_idx_val)
 
+            summary_idx_val = smartbytes('%s_%s_%s' % (
+                    vtag,
+                    descending_mtime,
+                    summary,
+                    ))
+            obj.add_index(VTH_VTAG_MTIME_SUMMARY_INDEX, summary_idx_val)
+
         return obj
 
 
 @VThread.decoder(1)
 def vth_dec_v1(data):
+    # 状态查询和列表用不到树形结构, 等到用的时候再构造
     return {
             'title': data['t'],
             'owner': data['o'],
             'ctime': data['c'],
             'mtime': data['m'],
-            'tree': VThreadTree(data['r']),
+            'tree': LazyField(VThreadTree, data['r']),
             'vtags': data['g'],
             'vtpid': data['p'],
             'xattr': data['x'],
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 实时信道 / 缓存一致性
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'CACHE_INVALIDATION_CHANNEL',
+        'CacheSync',
+        'install',
+        ]
+
+import logging
+import os
+
+import gevent
+
+from ..utils import dblayer
+
+from . import pubsub
+
+CACHE_INVALIDATION_CHANNEL = 'cache/invalidate'
+
+# 订阅连接断开后, 重新订阅之前等待的时间, 单位: 秒. 连续失败时每次加倍,
+# 直到上限
+RESUBSCRIBE_DELAY_SECS = 1
+RESUBSCRIBE_MAX_DELAY_SECS = 30
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class CacheSync(object):
+    '''通过 Redis PubSub 在进程之间同步文档缓存的失效.
+
+    任何一个进程保存或删除了启用缓存的文档之后, 都会在
+    :data:`CACHE_INVALIDATION_CHANNEL` 频道广播 ``(struct_id, key, vclock)``;
+    每个进程里都有一个后台 greenlet 订阅该频道, 把对应的缓存条目丢掉.
+
+    :param listen: 是否在本进程中接收失效通知. 不使用 gevent 的进程
+            (例如 Celery worker) 只需要发送通知, 应该传入 :const:`False`.
+    :type listen: bool
+
+    '''
+
+    def __init__(self, listen=True):
+        self.listen = listen
+        self._listener_pid = None
+
+    def publish(self, struct_id, key, vclock):
+        '''广播一条缓存失效通知.'''
+
+        return pubsub.publish_json(CACHE_INVALIDATION_CHANNEL, {
+                's': struct_id,
+                'k': key,
+                'v': vclock,
+                })
+
+    def ensure_listening(self):
+        '''保证本进程中有接收失效通知的 greenlet 在运行.'''
+
+        if not self.listen:
+            return
+
+        # 按进程号判断, 这样 fork 出来的 worker 进程也会启动自己的监听
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+
+        self._listener_pid = pid
+        gevent.spawn(self._listen_forever)
+
+    def _listen_forever(self):
+        channel = pubsub.PUBSUB_CHANNEL_PREFIX + CACHE_INVALIDATION_CHANNEL
+
+        delay = RESUBSCRIBE_DELAY_SECS
+        while True:
+            listener = None
+            try:
+                listener = pubsub.JSONPubSub()
+                listener.subscribe([channel, ])
+                delay = RESUBSCRIBE_DELAY_SECS
+
+                # 订阅成功之前 (包括上一次断线期间) 的通知都收不到了,
+                # 那期间缓存的东西都不可信, 只好全部作废
+                dblayer.clear_caches()
+
+                for msg in listener.listen():
+                    if msg['type'] not in pubsub.DATA_MESSAGE_TYPES:
+                        continue
+
+                    data = msg['data']
+                    try:
+                        struct_id, key = data['s'], data['k']
+                        vclock = data['v']
+                    except (KeyError, TypeError):
+                        # 格式不对的消息, 忽略
+                        continue
+
+                    dblayer.invalidate_cached(struct_id, key, vclock)
+            except Exception:
+                # 连接断开, 连接超时, 消息不是合法的 JSON (生成器已经坏掉了)
+                # 等等. 不管是什么异常, 这个 greenlet 都不能退出, 否则本进程
+                # 的缓存就再也不会失效了
+                _LOGGER.exception('cache invalidation listener failed')
+            finally:
+                if listener is not None:
+                    _close_listener(listener)
+
+            gevent.sleep(delay)
+            delay = min(delay * 2, RESUBSCRIBE_MAX_DELAY_SECS)
+
+
+def _close_listener(listener):
+    # 旧连接上还订阅着频道, 不关掉的话 Redis 会一直往里面塞消息
+    try:
+        listener.close()
+    except Exception:
+        _LOGGER.exception('failed to close cache invalidation listener')
+
+
+def install(listen=True):
+    '''在当前进程中启用基于 Redis PubSub 的缓存一致性机制.
+
+    参数含义见 :class:`CacheSync`.
+
+    '''
+
+    dblayer.install_cache_coherence(CacheSync(listen))
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 实时信道 / 进程内 PubSub 分发
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'GLOBAL_EVENT_CHANNEL',
+        'Event',
+        'PubSubHub',
+        'Subscriber',
+        'pubsub_hub',
+        ]
+
+import logging
+import os
+
+import gevent
+import gevent.queue
+import redis
+
+from socketio import packet
+from socketio.defaultjson import default_json_dumps
+
+from . import pubsub
+
+_LOGGER = logging.getLogger(__name__)
+
+GLOBAL_EVENT_CHANNEL = pubsub.PUBSUB_CHANNEL_PREFIX + 'evt/GLOBAL'
+
+# 每个本地订阅者最多积压的消息数. 积压满了说明客户端跟不上, 直接断开它
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# 订阅连接断开后, 重新订阅之前等待的时间, 单位: 秒. 连续失败时每次加倍,
+# 直到上限
+RESUBSCRIBE_DELAY_SECS = 1
+RESUBSCRIBE_MAX_DELAY_SECS = 30
+
+# 发给客户端的 socket.io 事件名
+RT_EVENT_NAME = 'rtEvent'
+
+
+class Event(object):
+    '''一条分发给本地订阅者的事件消息.
+
+    每条消息只在 :class:`PubSubHub` 里解码一次, 同一个对象交给所有订阅了
+    该频道的订阅者, 所以**不要修改**它. 消息中的 ``type`` 字段拆出来放在
+    :attr:`type` 里, 其余字段在 :attr:`data` 里.
+
+    '''
+
+    __slots__ = ('channel', 'type', 'data', '_frames', )
+
+    def __init__(self, channel, data):
+        if isinstance(data, dict):
+            data = dict(data)
+            typ = data.pop('type', '')
+        else:
+            typ = ''
+
+        self.channel, self.type, self.data = channel, typ, data
+        self._frames = {}
+
+    def frame(self, endpoint):
+        '''返回把这条消息作为 ``rtEvent`` 事件发给客户端的 socket.io 数据包.
+
+        数据包按 ``endpoint`` 缓存, 不管有多少个订阅者, JSON 编码只做一次.
+        结果可以直接交给 ``socket.put_client_msg``.
+
+        '''
+
+        try:
+            return self._frames[endpoint]
+        except KeyError:
+            pass
+
+        frame = self._frames[endpoint] = packet.encode(
+                {
+                    'type': 'event',
+                    'name': RT_EVENT_NAME,
+                    'args': [
+                        {
+                            'channel': self.channel,
+                            'type': self.type,
+                            'data': self.data,
+                            },
+                        ],
+                    'endpoint': endpoint,
+                    },
+                default_json_dumps,
+                )
+        return frame
+
+
+class Subscriber(object):
+    ''':class:`PubSubHub` 的一个本地订阅者, 通常对应一条实时连接.
+
+    收到的是 :class:`Event` 对象.
+
+    '''
+
+    def __init__(self, hub, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self.hub = hub
+        self.channels = set()
+        self.closed = False
+        self.overflowed = False
+        self._queue = gevent.queue.Queue(queue_size)
+
+    def subscribe(self, channels):
+        self.hub._subscribe(self, channels)
+
+    def unsubscribe(self, channels=None):
+        '''退订给定的频道, 不给出则退订全部频道.'''
+
+        self.hub._unsubscribe(
+                self,
+                list(self.channels) if channels is None else channels,
+                )
+
+    def listen(self):
+        '''逐条返回收到的消息, 直到订阅者被关闭.'''
+
+        while True:
+            msg = self._queue.get()
+            if msg is None:
+                return
+            yield msg
+
+    def close(self):
+        '''退订全部频道, 并让 :meth:`listen` 结束. 可以重复调用.'''
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.unsubscribe()
+
+        # 积压的消息不再需要了, 腾出位置放结束标记
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self._queue.put_nowait(None)
+
+    def _deliver(self, msg):
+        try:
+            self._queue.put_nowait(msg)
+        except gevent.queue.Full:
+            self.hub.stats['dropped'] += 1
+            self.overflowed = True
+            self.close()
+
+
+class PubSubHub(object):
+    '''每个进程一条 Redis 订阅连接, 在进程内分发给各个本地订阅者.
+
+    频道按本地订阅者的引用计数在 Redis 上订阅和退订: 第一个订阅者加入时
+    订阅, 最后一个订阅者离开时退订. ``base_channels`` 中的频道则始终保持
+    订阅, 这样订阅连接上至少有一个频道, 不会因为暂时没人订阅而结束.
+
+    '''
+
+    def __init__(self, base_channels=(GLOBAL_EVENT_CHANNEL, )):
+        self.base_channels = frozenset(base_channels)
+        # 频道 -> 订阅者集合
+        self._subscribers = {}
+        self._listener = None
+        self._listener_pid = None
+        self.stats = {
+                'messages': 0,
+                'deliveries': 0,
+                'dropped': 0,
+                }
+
+    def subscriber(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        '''新建一个本地订阅者.'''
+
+        self.ensure_running()
+        return Subscriber(self, queue_size)
+
+    def ensure_running(self):
+        '''保证本进程中有接收消息的 greenlet 在运行.'''
+
+        # 按进程号判断, 这样 fork 出来的 worker 进程也会启动自己的监听
+        pid = os.getpid()
+        if self._listener_pid == pid:
+            return
+
+        self._listener_pid = pid
+        self._listener = None
+        gevent.spawn(self._listen_forever)
+
+    def channel_stats(self):
+        '''返回每个频道的本地订阅者数目.'''
+
+        return dict(
+                (channel, len(subs), )
+                for channel, subs in self._subscribers.items()
+                )
+
+    def _send(self, method, channels):
+        listener = self._listener
+        if listener is None or not channels:
+            # 没有连上的话, 重新连上时会按当时的订阅者订阅
+            return
+
+        try:
+            getattr(listener, method)(channels)
+        except (redis.ConnectionError, redis.TimeoutError):
+            # 监听 greenlet 会发现连接断开并重新订阅
+            pass
+
+    def _subscribe(self, sub, channels):
+        new_channels = []
+        for channel in channels:
+            if channel in sub.channels:
+                continue
+
+            sub.channels.add(channel)
+            subs = self._subscribers.setdefault(channel, set())
+            if not subs and channel not in self.base_channels:
+                new_channels.append(channel)
+            subs.add(sub)
+
+        self._send('subscribe', new_channels)
+
+    def _unsubscribe(self, sub, channels):
+        gone_channels = []
+        for channel in channels:
+            if channel not in sub.channels:
+                continue
+
+            sub.channels.discard(channel)
+            subs = self._subscribers[channel]
+            subs.discard(sub)
+            if not subs:
+                del self._subscribers[channel]
+                if channel not in self.base_channels:
+                    gone_channels.append(channel)
+
+        self._send('unsubscribe', gone_channels)
+
+    def _dispatch(self, msg):
+        self.stats['messages'] += 1
+
+        channel = msg['channel']
+        subs = self._subscribers.get(channel)
+        if not subs:
+            # 重新订阅和退订交错时可能留下没人要的订阅, 顺手退掉
+            if channel not in self.base_channels:
+                self._send('unsubscribe', [channel, ])
+            return
+
+        event = Event(channel, msg['data'])
+
+        # 投递时订阅者可能因为积压而退订, 所以先复制一份
+        targets = list(subs)
+        for sub in targets:
+            sub._deliver(event)
+        self.stats['deliveries'] += len(targets)
+
+    def _listen_forever(self):
+        delay = RESUBSCRIBE_DELAY_SECS
+        while True:
+            listener = None
+            try:
+                # 订阅连接是在第一次订阅时建立的, 建立之前不能让别的
+                # greenlet 通过 _send 使用它, 否则会建立两个连接
+                listener = pubsub.JSONPubSub()
+                subscribed = self.base_channels | set(self._subscribers)
+                listener.subscribe(list(subscribed))
+                self._listener = listener
+                delay = RESUBSCRIBE_DELAY_SECS
+
+                # 补上订阅期间新加入的频道
+                self._send(
+                        'subscribe',
+                        list(set(self._subscribers) - subscribed),
+                        )
+
+                for msg in listener.listen():
+                    if msg['type'] in pubsub.DATA_MESSAGE_TYPES:
+                        self._dispatch(msg)
+            except Exception:
+                # 连接断开, 连接超时, 消息不是合法的 JSON (生成器已经坏掉了)
+                # 等等. 不管是什么异常, 这个 greenlet 都不能退出, 否则整个
+                # 进程都收不到事件了
+                _LOGGER.exception('pubsub hub listener failed')
+            finally:
+                self._listener = None
+                if listener is not None:
+                    self._close_listener(listener)
+
+            gevent.sleep(delay)
+            delay = min(delay * 2, RESUBSCRIBE_MAX_DELAY_SECS)
+
+    def _close_listener(self, listener):
+        # 旧连接上还订阅着频道, 不关掉的话 Redis 会一直往里面塞消息
+        try:
+            listener.close()
+        except Exception:
+            _LOGGER.exception('failed to close pubsub hub listener')
+
+
+pubsub_hub = PubSubHub()
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 实时信道 / 实时会话保活
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'KeepaliveScheduler',
+        'scheduler',
+        ]
+
+import os
+
+import gevent
+import redis
+
+from . import state
+
+# 周期性刷新 Redis 内实时会话记录的时间间隔, 单位: 秒.
+# 这是为了防止实时服务器重启后, 遗留下前一个实例来不及销毁的会话记录而设计的.
+# 此间隔必须比 state 组件中的会话记录 TTL 短, 原因显而易见.
+RT_SESSION_TOUCH_INTERVAL_SECS = 45
+
+# 每次 Lua 脚本调用处理的会话数, 免得一次占用 Redis 太久
+TOUCH_BATCH_SIZE = 500
+
+
+class KeepaliveScheduler(object):
+    '''每个进程一个的实时会话保活调度器.
+
+    本进程中所有活跃的实时会话都登记在这里, 由一个后台 greenlet 定期
+    分批 touch, 而不是每个连接各开一个 greenlet 各自访问 Redis.
+
+    '''
+
+    def __init__(
+            self,
+            interval=RT_SESSION_TOUCH_INTERVAL_SECS,
+            batch_size=TOUCH_BATCH_SIZE,
+            state_mgr=None,
+            ):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._state_mgr = state_mgr
+        self._sessions = set()
+        self._runner_pid = None
+        self.stats = {
+                'ticks': 0,
+                'touched': 0,
+                'expired': 0,
+                'errors': 0,
+                }
+
+    @property
+    def state_mgr(self):
+        if self._state_mgr is None:
+            return state.state_mgr
+        return self._state_mgr
+
+    def add(self, rt_sid):
+        '''登记一个需要保活的实时会话.'''
+
+        self.ensure_running()
+        self._sessions.add(rt_sid)
+
+    def discard(self, rt_sid):
+        '''不再为给定的实时会话保活.'''
+
+        self._sessions.discard(rt_sid)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def ensure_running(self):
+        '''保证本进程中有保活 greenlet 在运行.'''
+
+        # 按进程号判断, 这样 fork 出来的 worker 进程也会启动自己的调度
+        pid = os.getpid()
+        if self._runner_pid == pid:
+            return
+
+        self._runner_pid = pid
+        gevent.spawn(self._run_forever)
+
+    def tick(self):
+        '''touch 一遍所有登记的实时会话.
+
+        Redis 中已经不存在的会话不再保活.
+
+        '''
+
+        self.stats['ticks'] += 1
+
+        rt_sids = list(self._sessions)
+        for i in range(0, len(rt_sids), self.batch_size):
+            batch = rt_sids[i:i + self.batch_size]
+            missing = self.state_mgr.touch_rt_sessions(batch)
+
+            self.stats['touched'] += len(batch) - len(missing)
+            self.stats['expired'] += len(missing)
+            for rt_sid in missing:
+                self._sessions.discard(rt_sid)
+
+    def _run_forever(self):
+        while True:
+            gevent.sleep(self.interval)
+
+            try:
+                self.tick()
+            except redis.RedisError:
+                # 下一轮再试, 会话 TTL 比间隔长, 偶尔失败一次没关系
+                self.stats['errors'] += 1
+
+
+scheduler = KeepaliveScheduler()
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
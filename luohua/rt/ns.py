@@ -29,18 +29,14 @@ from weiyu.async import async_hub
 from weiyu import VERSION_STR as weiyu_version
 from .. import __version__ as luohua_version
 
-from . import pubsub
+from . import hub
+from . import keepalive
 from . import state
 
 # 连接建立到必须发送 hello 消息的最长时间间隔, 单位: 秒.
 # 超过此值指定时间间隔仍未发送 hello 的客户端将被断开.
 INITIAL_TIMEOUT_SECS = 30
 
-# 周期性刷新 Redis 内实时会话记录的时间间隔, 单位: 秒.
-# 这是为了防止实时服务器重启后, 遗留下前一个实例来不及销毁的会话记录而设计的.
-# 此间隔必须比 state 组件中的会话记录 TTL 短, 原因显而易见.
-RT_SESSION_TOUCH_INTERVAL_SECS = 45
-
 
 @async_hub.register_ns('socketio', '/rt')
 class RTNamespace(BaseNamespace, BroadcastMixin):
@@ -52,24 +48,13 @@ class RTNamespace(BaseNamespace, BroadcastMixin):
         if not self.session['hello_done']:
             self.disconnect()
 
-    def _rt_session_touch_thread(self, interval):
-        while True:
-            time.sleep(interval)
-
-            # 虽说这个值应该不会被修改, 在登陆成功的实时会话里也不会为空...
-            # 还是小心一点为好
-            rt_sid = self.session.get('rt_sid', None)
-            if not rt_sid:
-                return
-
-            state.state_mgr.touch_rt_session(rt_sid)
-
     def _rt_events_thread(self):
-        self.session['listener'] = listener = pubsub.JSONPubSub()
+        # 整个进程共用一条 Redis 订阅连接, 这里只是其中的一个本地订阅者
+        self.session['listener'] = listener = hub.pubsub_hub.subscriber()
 
         # 默认订阅全局事件频道
         # TODO: 允许配置其他频道, 例如某用户的事件频道
-        listener.subscribe(['/lh/evt/GLOBAL', ])
+        listener.subscribe([hub.GLOBAL_EVENT_CHANNEL, ])
 
         # 自己的事件频道
         rt_sid = self.session.get('rt_sid', None)
@@ -81,30 +66,15 @@ class RTNamespace(BaseNamespace, BroadcastMixin):
                 listener.subscribe([self_user_channel, ])
 
         # 准备就绪, 开听!
+        # 连接断开时这个 greenlet 会被杀掉, 所以要在 finally 里退订
         disconnect_flag = False
-        for msg in listener.listen():
-            msg_type = msg['type']
-
-            # print '[{0}] {1}: {2}'.format(
-            #         self.session['rt_sid'],
-            #         msg_type,
-            #         repr(msg),
-            #         )
-
-            if msg_type in pubsub.DATA_MESSAGE_TYPES:
-                channel = msg['channel']
-                data = msg['data']
-                try:
-                    data_type = data.pop('type')
-                except KeyError:
-                    # 应该不会发生...
-                    data_type = ''
-
-                self.emit('rtEvent', {
-                        'channel': channel,
-                        'type': data_type,
-                        'data': data,
-                        })
+        try:
+            for event in listener.listen():
+                channel, data_type = event.channel, event.type
+
+                # 编码好的数据包是所有本地订阅者共享的, 直接放进发送队列,
+                # 不用每个连接都 emit 一遍 (emit 会重新做 JSON 编码)
+                self.socket.put_client_msg(event.frame(self.ns_name))
 
                 if data_type == 'logged_out' and channel == self_user_channel:
                     # 注销事件, 强行断线
@@ -115,6 +85,11 @@ class RTNamespace(BaseNamespace, BroadcastMixin):
                     # 强行断线事件, 比如服务器维护之类
                     disconnect_flag = True
                     break
+            else:
+                # 消息积压太多, 客户端跟不上了. 断开让它重连
+                disconnect_flag = listener.overflowed
+        finally:
+            listener.close()
 
         if disconnect_flag:
             self._graceful_disconnect()
@@ -129,6 +104,7 @@ class RTNamespace(BaseNamespace, BroadcastMixin):
         rt_sid = self.session.get('rt_sid', None)
         if rt_sid is not None:
             # 注销自己的实时会话
+            keepalive.scheduler.discard(rt_sid)
             state.state_mgr.do_rt_logout(rt_sid)
 
         self.disconnect()
@@ -175,11 +151,9 @@ class RTNamespace(BaseNamespace, BroadcastMixin):
         # 表示 hello 序列已经完成
         self.session['hello_done'] = True
 
-        # 启动实时会话 touch 线程
-        self.spawn(
-                self._rt_session_touch_thread,
-                RT_SESSION_TOUCH_INTERVAL_SECS,
-                )
+        # 登记到本进程的保活调度器, 由它定期批量 touch
+        if rt_sid is not None:
+            keepalive.scheduler.add(rt_sid)
 
         # 启动实时事件监听线程
         self.spawn(self._rt_events_thread)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 实时信道 / 在线状态
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'PRESENCE_EVENT_TYPE',
+        'PresenceEngine',
+        'engine',
+        ]
+
+import logging
+import os
+
+import gevent
+import redis
+
+from weiyu import registry
+
+from . import pubsub
+
+_LOGGER = logging.getLogger(__name__)
+
+# 合并后的上下线通知的全局事件类型
+PRESENCE_EVENT_TYPE = 'presence'
+
+# 默认的合并窗口, 单位: 秒. 可以在 luohua.rt 配置的 presence.debounce_secs
+# 中修改
+DEFAULT_DEBOUNCE_SECS = 5
+
+
+def _read_debounce_secs():
+    try:
+        return registry.request('luohua.rt')['presence']['debounce_secs']
+    except KeyError:
+        return DEFAULT_DEBOUNCE_SECS
+
+
+class PresenceEngine(object):
+    '''合并用户上下线通知的组件, 每个实时服务器进程一个.
+
+    用户上线或下线时不再立即广播, 而是先记下来, 由后台 greenlet 每隔一个
+    合并窗口把这段时间内的变化一次性发出去. 发出前会再向 Redis 确认用户
+    的当前状态, 在窗口内下线又上线 (或者反过来) 的用户不会出现在通知里.
+
+    通知是一条 :data:`PRESENCE_EVENT_TYPE` 类型的全局事件, ``online`` 和
+    ``offline`` 两个参数分别是上线和下线用户的列表, 列表元素形如
+    ``{'uid': UID, 'display_name': 显示名称}``.
+
+    '''
+
+    def __init__(self, window=None, state_mgr=None, publish=None):
+        self._window = window
+        self._state_mgr = state_mgr
+        self._publish = publish or pubsub.publish_global_event
+        # UID -> {'initial': 窗口开始时是否在线, 'online': 最后一次变化后
+        # 是否在线, 'display_name': 显示名称}
+        self._pending = {}
+        self._flusher_pid = None
+        self.stats = {
+                'flushes': 0,
+                'published': 0,
+                'suppressed': 0,
+                }
+
+    @property
+    def window(self):
+        if self._window is None:
+            self._window = _read_debounce_secs()
+        return self._window
+
+    @property
+    def state_mgr(self):
+        if self._state_mgr is None:
+            # state 组件引用了这个模块, 所以不能在模块级加载
+            from . import state
+            return state.state_mgr
+        return self._state_mgr
+
+    def mark_online(self, uid, display_name):
+        '''记录一个用户上线.'''
+
+        self._mark(uid, True, display_name)
+
+    def mark_offline(self, uid, display_name):
+        '''记录一个用户下线.'''
+
+        self._mark(uid, False, display_name)
+
+    def _mark(self, uid, online, display_name):
+        self.ensure_running()
+
+        try:
+            entry = self._pending[uid]
+        except KeyError:
+            # 窗口内第一次变化, 变化之前的状态自然是反过来的
+            entry = self._pending[uid] = {'initial': not online, }
+
+        entry['online'] = online
+        entry['display_name'] = display_name
+
+    def flush(self):
+        '''把积攒的上下线变化合并成一条通知发出去.
+
+        返回 ``(上线列表, 下线列表)``; 没有需要通知的变化时不发送. 查询\
+        状态或者发送通知时 Redis 出错的话, 这一窗口的变化放回去等下次再发,
+        错误照常抛出.
+
+        '''
+
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return [], []
+
+        self.stats['flushes'] += 1
+        try:
+            current = self.state_mgr.online_states(pending.keys())
+        except redis.RedisError:
+            self._requeue(pending)
+            raise
+
+        online, offline = [], []
+        for uid in sorted(pending):
+            entry = pending[uid]
+            is_online = current.get(uid, entry['online'])
+            if is_online == entry['initial']:
+                # 窗口内来回抖动, 最终没有变化
+                self.stats['suppressed'] += 1
+                continue
+
+            item = {
+                    'uid': uid,
+                    'display_name': entry['display_name'],
+                    }
+            (online if is_online else offline).append(item)
+
+        if online or offline:
+            try:
+                self._publish(
+                        PRESENCE_EVENT_TYPE,
+                        online=online,
+                        offline=offline,
+                        )
+            except redis.RedisError:
+                self._requeue(pending)
+                raise
+            self.stats['published'] += len(online) + len(offline)
+
+        return online, offline
+
+    def _requeue(self, pending):
+        # 放回去下次再试. 这期间又有变化的用户保留更早的初始状态
+        for uid, entry in pending.items():
+            newer = self._pending.get(uid)
+            if newer is None:
+                self._pending[uid] = entry
+            else:
+                newer['initial'] = entry['initial']
+
+    def ensure_running(self):
+        '''保证本进程中有定期发送通知的 greenlet 在运行.'''
+
+        # 按进程号判断, 这样 fork 出来的 worker 进程也会启动自己的发送
+        pid = os.getpid()
+        if self._flusher_pid == pid:
+            return
+
+        self._flusher_pid = pid
+        gevent.spawn(self._flush_forever)
+
+    def _flush_forever(self):
+        while True:
+            gevent.sleep(self.window)
+
+            # 任何错误都不能让发送 greenlet 退出, 否则本进程再也不会发通知
+            try:
+                self.flush()
+            except Exception:
+                _LOGGER.exception('presence flush failed')
+
+
+engine = PresenceEngine()
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -32,28 +32,21 @@ try:
 except ImportError:
     import json
 
-from weiyu.db import db_hub
+from ..utils import redispool
 
 PUBSUB_STORAGE_ID = 'luohua.rt.pubsub'
 PUBSUB_CHANNEL_PREFIX = '/lh/'
 
 DATA_MESSAGE_TYPES = frozenset({'message', 'pmessage', })
 
-_PUBSUB_CLIENT_CACHE = []
-
 
 def _get_pubsub_client():
-    if _PUBSUB_CLIENT_CACHE:
-        return _PUBSUB_CLIENT_CACHE[0]
-
-    storage = db_hub.get_storage(PUBSUB_STORAGE_ID)
-    client = storage.raw()
-    _PUBSUB_CLIENT_CACHE.append(client)
-    return client
+    return redispool.get_client(PUBSUB_STORAGE_ID)
 
 
 def _get_pubsub():
-    return _get_pubsub_client().pubsub()
+    # 订阅连接不放进有上限的连接池
+    return redispool.get_pubsub_client(PUBSUB_STORAGE_ID).pubsub()
 
 
 def publish_json(channel, data):
@@ -146,6 +139,11 @@ class JSONPubSub(object):
     def punsubscribe(self, patterns=[]):
         return self.pubsub.punsubscribe(patterns)
 
+    def close(self):
+        '''断开订阅连接. 连接不会回到连接池里被别人复用.'''
+
+        return self.pubsub.close()
+
     def listen(self):
         for msg in self.pubsub.listen():
             msg_type = msg['type']
@@ -25,13 +25,14 @@ __all__ = [
 
 import time
 
-from weiyu.db import db_hub
 from weiyu.helpers.misc import smartstr
 
 from ..auth import user
+from ..utils import redispool
 from ..utils import sequences
 from ..app.session import tokens
 
+from . import presence
 from . import pubsub
 
 RT_STATE_STORAGE_ID = 'luohua.rt.state'
@@ -40,11 +41,55 @@ LOGIN_DISABLED_KEY = 'rt:nologin'
 RT_SESSION_KEY_FMT = 'rt:sess:{0}'
 USERS_KEY = 'rt:users'
 USER_SESSIONS_KEY_FMT = 'rt:usersess:{0}'
+# 在线用户显示名称的缓存, 与用户会话索引同生共死
+USER_NAME_KEY_FMT = 'rt:username:{0}'
 
 # Redis 中实时会话记录的 TTL, 单位: 秒
-# 该间隔必须比 ns 组件中的定期 touch 间隔长, 原因显而易见
+# 该间隔必须比 keepalive 组件中的定期 touch 间隔长, 原因显而易见
 RT_SESSION_TTL_SECS = 120
 
+# 批量 touch 实时会话. 已经不存在的会话不会被重新创建, 而是报告给调用方
+# KEYS: 各实时会话的键
+# ARGV: 当前时间, TTL, 全局活跃用户集合的键, 用户会话索引键的前缀,
+#       显示名称缓存键的前缀
+# 返回: 不存在的实时会话的键
+_TOUCH_SCRIPT = '''
+local missing = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('HSET', key, 'atime', ARGV[1])
+        redis.call('EXPIRE', key, ARGV[2])
+
+        local info = redis.call('HMGET', key, 'logged_in', 'uid')
+        local logged_in, uid = info[1], info[2]
+        if logged_in and logged_in ~= '0' and uid and uid ~= '0' then
+            redis.call('ZADD', ARGV[3], ARGV[1], uid)
+            redis.call('EXPIRE', ARGV[4] .. uid, ARGV[2])
+            redis.call('EXPIRE', ARGV[5] .. uid, ARGV[2])
+        end
+    else
+        missing[#missing + 1] = key
+    end
+end
+return missing
+'''
+
+# 在线用户快照. 顺便清掉全局活跃用户集合中早已不再 touch 的用户, 例如
+# 崩溃的实时服务器上遗留下来的
+# KEYS: 全局活跃用户集合
+# ARGV: 过期时间点, 显示名称缓存键的前缀
+# 返回: {UID, 显示名称 (没有缓存时为空), ...}
+_ONLINE_SCRIPT = '''
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[1])
+
+local result = {}
+for i, uid in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+    result[#result + 1] = uid
+    result[#result + 1] = redis.call('GET', ARGV[2] .. uid)
+end
+return result
+'''
+
 
 def get_rt_session_key(rt_sid):
     return RT_SESSION_KEY_FMT.format(rt_sid)
@@ -54,24 +99,23 @@ def get_user_sessions_key(uid):
     return USER_SESSIONS_KEY_FMT.format(uid)
 
 
+def get_user_name_key(uid):
+    return USER_NAME_KEY_FMT.format(uid)
+
+
 class RTStateManager(object):
     '''实时信道全局状态组件.'''
 
     def __init__(self):
         # 这么写是为了防止在模块 import 时做出真正的初始化动作
-        self._conn = None
+        self._touch_script = None
+        self._online_script = None
 
     @property
     def conn(self):
         '''获取 Redis 连接.'''
 
-        # 其实是又一种保留 Redis 对象的方法... rt.pubsub 和 app.session.tokens
-        # 表示 "重构是什么可以吃吗?"
-        if self._conn is not None:
-            return self._conn
-
-        conn = self._conn = db_hub.get_storage(RT_STATE_STORAGE_ID).raw()
-        return conn
+        return redispool.get_client(RT_STATE_STORAGE_ID)
 
     def purge_state(self):
         '''清空所有实时会话.'''
@@ -131,21 +175,10 @@ class RTStateManager(object):
             return None
 
         # 生成实时会话 ID
-        rt_sid, is_sid_ok = sequences.time_ascending_suffixed(curtime), False
+        # 生成的 ID 保证不重复, 这里的 hsetnx 只是以防万一
+        rt_sid = sequences.time_ascending_ms()
         rt_session_key = get_rt_session_key(rt_sid)
-        for retries in range(5):
-            # 虽然不太可能但还是防范一下... 同一秒产生了多个连接请求,
-            # 而生成的实时会话 ID 后缀的随机数也发生重复的情况
-            if conn.hsetnx(rt_session_key, 'occupied', 1):
-                is_sid_ok = True
-                break
-
-            # 果然重复了... 重新生成一个会话 ID
-            # 这次就不用缓存的时间了
-            rt_sid = sequences.time_ascending_suffixed()
-            rt_session_key = get_rt_session_key(rt_sid)
-
-        if not is_sid_ok:
+        if not conn.hsetnx(rt_session_key, 'occupied', 1):
             # 这一定不可能... 让客户端再做一次请求吧
             return None
 
@@ -171,7 +204,7 @@ class RTStateManager(object):
 
             with conn.pipeline() as pipe:
                 # 记录到全局活跃用户集合
-                pipe.zadd(USERS_KEY, curtime, uid)
+                pipe.zadd(USERS_KEY, {uid: curtime, })
 
                 # 记录到用户状态中, 并检查是否新上线
                 pipe.sadd(user_sessions_key, rt_sid)
@@ -181,23 +214,21 @@ class RTStateManager(object):
 
                 pipe.scard(user_sessions_key)
 
+                # 缓存显示名称, 下线通知和在线用户快照都要用
+                pipe.set(
+                        get_user_name_key(uid),
+                        user_obj['display_name'],
+                        ex=RT_SESSION_TTL_SECS,
+                        )
+
                 results = pipe.execute()
 
             session_count = results[3]
             if session_count == 1:
-                # 确实是该用户的新上线会话, 发送 online 通知
-                # TODO: 确定这里到底是写成全局事件还是用户事件好...
-                # 在引入 app.session.tokens 之前是写的用户事件,
-                # 但我觉得作为一个小社区的话, 还是多一点存在感比较好,
-                # 也算是借鉴了 osu! 的 IRC 机制吧.
-                # 性能问题这个阶段还是不用考虑的...
-                pubsub.publish_global_event(
-                        'user_online',
-                        uid=uid,
-                        # 同时送去用户的显示名称...
-                        # 免得造成一大波又一大波的 account/xxx/stat/ 请求
-                        display_name=user_obj['display_name'],
-                        )
+                # 确实是该用户的新上线会话, 交给 presence 组件合并后通知
+                # 同时送去用户的显示名称...
+                # 免得造成一大波又一大波的 account/xxx/stat/ 请求
+                presence.engine.mark_online(uid, user_obj['display_name'])
         else:
             # TODO: 处理未登陆用户
             pass
@@ -207,52 +238,44 @@ class RTStateManager(object):
     def touch_rt_session(self, rt_sid):
         '''touch 一次指定的实时会话.
 
-        通过 ns 组件的周期性调用, 可以在指定实时会话的活跃期间, 使该会话在
-        Redis 中的记录不过期.
+        使该会话在 Redis 中的记录不过期. 一般由 keepalive 组件通过
+        :meth:`touch_rt_sessions` 批量进行.
 
         '''
 
-        conn = self.conn
-        curtime = int(time.time())
-        rt_session_key = get_rt_session_key(rt_sid)
+        return not self.touch_rt_sessions([rt_sid, ])
 
-        # 刷新实时会话记录, 同时拉取该实时会话的关联用户信息
-        with conn.pipeline() as pipe:
-            pipe.hset(rt_session_key, 'atime', curtime)
-            pipe.expire(rt_session_key, RT_SESSION_TTL_SECS)
-            pipe.hmget(rt_session_key, 'logged_in', 'uid')
+    def touch_rt_sessions(self, rt_sids):
+        '''批量 touch 给定的实时会话, 返回其中已经不存在的会话 ID 列表.
 
-            results = pipe.execute()
+        刷新会话记录和关联用户的会话索引的 TTL, 以及全局活跃用户集合中的
+        时间, 全部在一次 Lua 脚本调用中完成.
 
-        # 准备刷新用户相关的数据结构, 不过先得保证 UID 的 sanity...
-        logged_in, uid = results[2]
-        # 应该是个字符串, 但如果是 None 呢?
-        if logged_in is None:
-            # 纯粹是为了能执行到下面的 except 子句
-            logged_in = ''
+        '''
 
-        try:
-            logged_in = int(smartstr(logged_in)) != 0
-        except ValueError:
-            # 包括 UnicodeDecodeError
-            logged_in = uid is not None and uid != '0'
+        if not rt_sids:
+            return []
 
-        uid = uid if logged_in else None
-        if uid is not None:
-            # 是登陆用户
-            user_sessions_key = get_user_sessions_key(uid)
+        if self._touch_script is None:
+            self._touch_script = self.conn.register_script(_TOUCH_SCRIPT)
 
-            with conn.pipeline() as pipe:
-                # 刷新全局活跃用户集合
-                pipe.zadd(USERS_KEY, curtime, uid)
+        keys = [get_rt_session_key(rt_sid) for rt_sid in rt_sids]
+        missing = self._touch_script(
+                keys=keys,
+                args=[
+                    int(time.time()),
+                    RT_SESSION_TTL_SECS,
+                    USERS_KEY,
+                    get_user_sessions_key(''),
+                    get_user_name_key(''),
+                    ],
+                )
 
-                # 刷新他的会话索引 TTL
-                pipe.expire(user_sessions_key, RT_SESSION_TTL_SECS)
+        if not missing:
+            return []
 
-                pipe.execute()
-        else:
-            # TODO: 未登陆用户
-            pass
+        sid_by_key = dict(zip(keys, rt_sids))
+        return [sid_by_key[smartstr(key)] for key in missing]
 
     def do_rt_logout(self, rt_sid):
         '''注销指定的实时会话 (正常窗口关闭/掉线等情况).'''
@@ -282,26 +305,69 @@ class RTStateManager(object):
             with conn.pipeline() as pipe:
                 pipe.srem(user_sessions_key, rt_sid)
                 pipe.scard(user_sessions_key)
+                pipe.get(get_user_name_key(uid))
                 results = pipe.execute()
 
-            remaining_sessions = results[1]
+            remaining_sessions, display_name = results[1], results[2]
             if remaining_sessions == 0:
                 # 该用户已经没有活动的实时会话了
                 # 从全局活跃用户中删除
                 conn.zrem(USERS_KEY, uid)
 
-                # 发送通知
-                user_obj = user.User.fetch(uid)
-                pubsub.publish_global_event(
-                        'user_offline',
-                        uid=uid,
-                        display_name=user_obj['display_name'],
-                        )
+                # 显示名称缓存只在极少数情况下会不存在, 比如刚刚过期
+                if display_name is None:
+                    display_name = user.User.fetch(uid)['display_name']
+                else:
+                    display_name = smartstr(display_name)
+
+                # 交给 presence 组件合并后通知
+                presence.engine.mark_offline(uid, display_name)
         else:
             # 未登陆用户的会话
             # TODO: 处理未登陆用户
             pass
 
+    def online_states(self, uids):
+        '''查询给定用户当前是否在线, 返回 UID 到布尔值的映射.'''
+
+        uids = list(uids)
+        with self.conn.pipeline(transaction=False) as pipe:
+            for uid in uids:
+                pipe.scard(get_user_sessions_key(uid))
+            counts = pipe.execute()
+
+        return dict(
+                (uid, count > 0, )
+                for uid, count in zip(uids, counts)
+                )
+
+    def online_users(self):
+        '''返回当前在线用户的快照.
+
+        结果是 ``(UID, 显示名称)`` 的列表, 数据全部来自 Redis, 一次往返.
+        显示名称没有缓存时为 :const:`None`.
+
+        '''
+
+        if self._online_script is None:
+            self._online_script = self.conn.register_script(_ONLINE_SCRIPT)
+
+        result = self._online_script(
+                keys=[USERS_KEY, ],
+                args=[
+                    int(time.time()) - RT_SESSION_TTL_SECS,
+                    get_user_name_key(''),
+                    ],
+                )
+
+        return [
+                (
+                    smartstr(uid),
+                    smartstr(name) if name is not None else None,
+                    )
+                for uid, name in zip(result[::2], result[1::2])
+                ]
+
 
 state_mgr = RTStateManager()
 
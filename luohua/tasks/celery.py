@@ -38,6 +38,10 @@ project_root = os.path.join(os.path.dirname(__file__),  '../..')
 os.chdir(project_root)
 init.boot()
 
+# Celery worker 不跑 gevent 的事件循环, 只负责在保存文档时通知其他进程
+from ..rt import cachesync
+cachesync.install(listen=False)
+
 
 class ConfigPlaceholder(object):
     pass
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 任务队列 / 会话 token 清理
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, unicode_literals
+
+from . import celery
+
+
+@celery.jsontask
+def sweep_session_tokens():
+    '''清理会话 token 映射. 返回值是清理的统计信息, 会出现在 worker 日志里.'''
+
+    from ..app.session import tokens
+
+    return tokens.sweep_tokens()
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 应用 / 会话 token
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+from ..utils import Case
+from ..shortcuts import *
+
+import time
+
+from luohua.app.session import tokens
+from luohua.utils import randomness
+
+
+class FakeRequest(object):
+    def __init__(self, remote_addr):
+        self.remote_addr = remote_addr
+        self.user = None
+
+
+class TestTokens(Case):
+    @classmethod
+    def setup_class(cls):
+        # 每次用不同的 UID, 免得受上一次测试残留的影响
+        cls.uid = 'test-tokens-' + randomness.fixed_length_b64(8)
+        cls.request = FakeRequest('127.0.0.1')
+
+    def _mapped_token(self, typ, uid):
+        return tokens._get_redis().hget(
+                tokens._get_user_tokens_key(uid),
+                tokens._get_token_field(typ, '127.0.0.1'),
+                )
+
+    def test_request_allocate(self):
+        uid = self.uid + '-a'
+
+        token1 = tokens.request_token(self.request, 'test', uid)
+        token2 = tokens.request_token(self.request, 'test', uid)
+        assert token1 == token2
+        assert self._mapped_token('test', uid) == token1
+
+        token_data = tokens.query_token('test', token1)
+        assert token_data['uid'] == uid
+        assert token_data['remote_addr'] == '127.0.0.1'
+        assert tokens.query_token('other', token1) is None
+
+        # 强制新建会替换映射
+        token3 = tokens.allocate_token(self.request, 'test', uid)
+        assert token3 != token1
+        assert self._mapped_token('test', uid) == token3
+        assert tokens.request_token(self.request, 'test', uid) == token3
+
+        tokens.purge_token(token1)
+        tokens.purge_token(token3)
+
+    def test_revoke(self):
+        uid = self.uid + '-r'
+        token = tokens.request_token(self.request, 'test', uid)
+
+        assert not tokens.revoke_token(self.request, 'other', uid, token)
+        assert not tokens.revoke_token(self.request, 'test', 'nobody', token)
+        assert tokens.query_token('test', token) is not None
+
+        assert tokens.revoke_token(self.request, 'test', uid, token)
+        assert tokens.query_token('test', token) is None
+        assert self._mapped_token('test', uid) is None
+        assert not tokens.revoke_token(self.request, 'test', uid, token)
+
+    def test_purge_keeps_newer_mapping(self):
+        uid = self.uid + '-p'
+        token1 = tokens.request_token(self.request, 'test', uid)
+        token2 = tokens.allocate_token(self.request, 'test', uid)
+
+        # 旧 token 已经不在映射里了, 删除它不能连带删掉新 token 的映射
+        tokens.purge_token(token1)
+        assert tokens.query_token('test', token1) is None
+        assert self._mapped_token('test', uid) == token2
+
+        tokens.purge_token(token2)
+        assert tokens.query_token('test', token2) is None
+        assert self._mapped_token('test', uid) is None
+
+    def test_ttl(self):
+        uid = self.uid + '-t'
+        conn = tokens._get_redis()
+
+        token = tokens.request_token(self.request, 'login', uid)
+        ttl = conn.ttl(token)
+        assert 0 < ttl <= tokens.get_token_ttl('login')
+        assert conn.ttl(tokens._get_user_tokens_key(uid)) >= ttl
+
+        token2 = tokens.request_token(self.request, 'test', uid)
+        assert conn.ttl(token2) <= tokens.DEFAULT_TOKEN_TTL
+
+        tokens.purge_token(token)
+        tokens.purge_token(token2)
+
+    def test_sweep_orphans(self):
+        uid = self.uid + '-s'
+        conn = tokens._get_redis()
+
+        token = tokens.request_token(self.request, 'test', uid)
+        token2 = tokens.request_token(self.request, 'login', uid)
+
+        # 模拟 token 过期
+        conn.delete(token)
+        stats = tokens.sweep_tokens()
+        assert stats['reclaimed'] >= 1
+        assert self._mapped_token('test', uid) is None
+        assert self._mapped_token('login', uid) == token2
+
+        tokens.purge_token(token2)
+
+    def test_sweep_legacy(self):
+        uid = self.uid + '-l'
+        conn = tokens._get_redis()
+        curtime = int(time.time())
+
+        def _legacy_token(ctime):
+            token = tokens.new_token_string()
+            conn.hmset(token, {
+                    'type': 'login',
+                    'ctime': ctime,
+                    'remote_addr': '127.0.0.1',
+                    'uid': uid,
+                    })
+            return token
+
+        fresh = _legacy_token(curtime)
+        stale = _legacy_token(curtime - tokens.get_token_ttl('login') - 1)
+        conn.hset(tokens.LEGACY_TOKENS_HASH_KEY, 'token:login:' + uid, fresh)
+        conn.hset(tokens.LEGACY_TOKENS_HASH_KEY, 'token:stale:' + uid, stale)
+
+        stats = tokens.sweep_tokens()
+        assert stats['legacy_migrated'] >= 1
+        assert stats['legacy_reclaimed'] >= 1
+
+        assert self._mapped_token('login', uid) == fresh
+        assert 0 < conn.ttl(fresh) <= tokens.get_token_ttl('login')
+        assert not conn.exists(stale)
+        assert not conn.hexists(
+                tokens.LEGACY_TOKENS_HASH_KEY,
+                'token:login:' + uid,
+                )
+
+        tokens.purge_token(fresh)
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
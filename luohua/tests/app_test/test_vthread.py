@@ -26,6 +26,36 @@ from weiyu.router import router_hub
 from luohua.app.v1 import vthread
 
 
+class FakeRequest(object):
+    method = 'GET'
+
+    def __init__(self, if_none_match=None, query=''):
+        self.conditional = {}
+        self.env = {'QUERY_STRING': query, }
+        if if_none_match is not None:
+            self.env['HTTP_IF_NONE_MATCH'] = if_none_match
+
+
+class FakeTree(object):
+    version = 5
+    tree = [['a', ], ]
+
+
+class FakeVThread(dict):
+    fresh = None
+
+    @classmethod
+    def peek_freshness(cls, vthid):
+        return cls.fresh
+
+    @classmethod
+    def fetch(cls, vthid):
+        return cls({'mtime': 100, 'tree': FakeTree(), })
+
+    def remember_freshness(self):
+        pass
+
+
 class TestVThreadViews(Case):
     @classmethod
     def setup_class(cls):
@@ -43,5 +73,34 @@ class TestVThreadViews(Case):
         assert 'vthread-getdents-v1' in http_views
         assert 'vthread-fcntl-v1' in http_views
 
+    def test_getdents_etag_v1(self):
+        orig_vthread = vthread.VThread
+        vthread.VThread = FakeVThread
+        try:
+            # 正常返回时带上 ETag 响应头
+            response = vthread.vthread_getdents_v1_view(FakeRequest(), 'x')
+            assert response.status == 200
+            assert response.context['headers'] == [('ETag', '"5"', ), ]
+
+            # 没有新鲜度记录, 读出虚线索之后发现没有变化
+            response = vthread.vthread_getdents_v1_view(
+                    FakeRequest('"5"'),
+                    'x',
+                    )
+            assert response.status == 304
+            assert response.context['headers'] == [('ETag', '"5"', ), ]
+
+            # 有新鲜度记录, 不读虚线索本体就返回 304
+            FakeVThread.fresh = (100, 5, )
+            response = vthread.vthread_getdents_v1_view(
+                    FakeRequest('W/"5-10-0"', 'limit=10'),
+                    'x',
+                    )
+            assert response.status == 304
+            assert response.context['headers'] == [('ETag', '"5-10-0"', ), ]
+        finally:
+            vthread.VThread = orig_vthread
+            FakeVThread.fresh = None
+
 
 # vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 认证 / 审计记录查询
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+import calendar
+import collections
+
+from nose.tools import assert_raises
+
+from ..utils import Case
+
+from luohua.auth import audit
+from luohua.auth import auditarchive
+from luohua.auth import auditquery
+from luohua.utils.radixcodec import encode36
+
+
+class FakePage(object):
+    def __init__(self, results, continuation):
+        self.results = results
+        self.continuation = continuation
+
+
+class FakeObject(object):
+    def __init__(self, bucket, key, data=None, encoded_data=None):
+        self.bucket = bucket
+        self.key = key
+        self.data = data
+        self.encoded_data = encoded_data
+        self.indexes = []
+        self.exists = data is not None or encoded_data is not None
+
+    def add_index(self, idx, value):
+        self.indexes.append((idx, value, ))
+
+    def store(self):
+        self.bucket.objects[self.key] = self
+        self.exists = True
+
+
+class FakeBucket(object):
+    '''按 Riak 的语义模拟一个 bucket, 2i 查询结果按 (索引值, ID) 排序.'''
+
+    def __init__(self):
+        self.objects = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def new(self, key, data=None, content_type=None, encoded_data=None):
+        return FakeObject(self, key, data, encoded_data)
+
+    def get(self, key):
+        return self.objects.get(key) or FakeObject(self, key)
+
+    def delete(self, key):
+        del self.objects[key]
+
+    def stream_keys(self):
+        yield list(self.objects)
+
+    def get_index(
+            self,
+            idx,
+            start,
+            end=None,
+            return_terms=None,
+            max_results=None,
+            continuation=None,
+            ):
+        end = start if end is None else end
+        matches = sorted(
+                (value, key, )
+                for key, obj in self.objects.items()
+                for obj_idx, value in obj.indexes
+                if obj_idx == idx and start <= value <= end
+                )
+
+        offset = int(continuation) if continuation is not None else 0
+        page = matches[offset:offset + max_results]
+        next_offset = offset + max_results
+        next_continuation = (
+                str(next_offset)
+                if next_offset < len(matches)
+                else None
+                )
+
+        if return_terms:
+            return FakePage(page, next_continuation)
+        return FakePage([key for _, key in page], next_continuation)
+
+
+class FakeEntry(dict):
+    buckets = collections.defaultdict(FakeBucket)
+    fetched = []
+
+    def __init__(self, data=None, ts=None, rawobj=None):
+        super(FakeEntry, self).__init__()
+        if data is not None:
+            self.update(data)
+        if ts is not None:
+            self['id'] = ts
+
+    @classmethod
+    def partition_storage(cls, partition):
+        return cls.buckets[partition]
+
+    @classmethod
+    def _do_bulk_fetch(cls, conn, keys, concurrency=None, timeout=None):
+        for key in keys:
+            cls.fetched.append(key)
+            obj = conn.objects.get(key)
+            yield cls(obj.data, key) if obj is not None else None
+
+    def encode(self):
+        data = dict(self)
+        del data['id']
+        return data
+
+
+class FakeAuditQuery(auditquery.AuditQuery):
+    entry_cls = FakeEntry
+
+
+def _ts(year, month, day):
+    return calendar.timegm((year, month, day, 0, 0, 0, ))
+
+
+MAY = _ts(2014, 5, 1)
+JUNE = _ts(2014, 6, 1)
+ENTRIES = [
+        ('u1', 'sess', 'login', MAY + 10, ),
+        ('u2', 'sess', 'login', MAY + 20, ),
+        ('u1', 'sess', 'logout', MAY + 30, ),
+        ('u1', 'ident', 'activate', JUNE + 10, ),
+        ('u2', 'sess', 'logout', JUNE + 20, ),
+        ('u1', 'sess', 'login', JUNE + 30, ),
+        ]
+
+
+def _key(i):
+    return encode36(ENTRIES[i][3]) + '%04x' % (i, )
+
+
+def _store(key, uid, module, typ, ts):
+    '''按 AuditEntry._do_sync_2i 的方式把一条记录写进所在的分区.'''
+
+    data = {
+            'uid': uid,
+            'module': module,
+            'type': typ,
+            'group': key,
+            'ctime': ts + 0.5,
+            }
+    bucket = FakeEntry.buckets[audit.partition_of_ts(ts)]
+    obj = bucket.new(key, data)
+    obj.add_index(audit.AUDIT_UID_IDX, uid.encode('utf-8'))
+    obj.add_index(audit.AUDIT_MODULE_IDX, module.encode('utf-8'))
+    obj.add_index(audit.AUDIT_ACTION_IDX, typ.encode('utf-8'))
+    obj.add_index(audit.AUDIT_GROUP_IDX, key.encode('utf-8'))
+    obj.add_index(audit.AUDIT_TIMESTAMP_IDX, ts)
+    obj.store()
+
+
+def _populate():
+    '''把 ENTRIES 写进各分区, 并清掉进程内记下的清单和最早分区.'''
+
+    FakeEntry.buckets.clear()
+    auditarchive._MANIFESTS.clear()
+    auditquery._FIRST_PARTITIONS.clear()
+    for i, (uid, module, typ, ts, ) in enumerate(ENTRIES):
+        _store(_key(i), uid, module, typ, ts)
+
+
+def _ids(query, cursor=None):
+    return [
+            ENTRIES_BY_KEY[entry['id']]
+            for entry in query.iter_entries(cursor)
+            ]
+
+
+ENTRIES_BY_KEY = {_key(i): i for i in range(len(ENTRIES))}
+
+QUERIES = [
+        ({'uid': 'u1', }, [0, 2, 3, 5, ], ),
+        ({'uid': 'u1', 'module': 'sess', }, [0, 2, 5, ], ),
+        ({'uid': 'u1', 'type': 'login', }, [0, 5, ], ),
+        ({'uid': 'u3', }, [], ),
+        ({'uid': 'u2', 'module': 'ident', }, [], ),
+        ({'start': MAY + 30, 'end': JUNE + 20, }, [2, 3, 4, ], ),
+        ({'end': MAY + 20, }, [0, 1, ], ),
+        ({'start': JUNE, }, [3, 4, 5, ], ),
+        ({'uid': 'u1', 'start': MAY + 30, 'end': JUNE + 20, }, [2, 3, ], ),
+        ({}, [0, 1, 2, 3, 4, 5, ], ),
+        ]
+
+
+class TestAuditPartitions(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_partitions(self):
+        assert audit.partition_of_ts(MAY) == '201405'
+        assert audit.partition_of_ts(JUNE - 1) == '201405'
+        assert audit.partition_of_key(_key(0)) == '201405'
+        assert audit.partition_of_key(_key(3)) == '201406'
+        assert audit.next_partition('201412') == '201501'
+        assert list(audit.iter_partitions(
+                _ts(2014, 11, 30),
+                _ts(2015, 2, 1),
+                )) == ['201411', '201412', '201501', '201502', ]
+
+
+class TestAuditQuery(Case):
+    @classmethod
+    def setup_class(cls):
+        cls._orig_page_size = auditquery.AUDIT_INDEX_PAGE_SIZE
+        # 把每页调小, 才能覆盖到逐页读取的逻辑
+        auditquery.AUDIT_INDEX_PAGE_SIZE = 2
+
+    @classmethod
+    def teardown_class(cls):
+        auditquery.AUDIT_INDEX_PAGE_SIZE = cls._orig_page_size
+
+    def test_query(self):
+        _populate()
+        for kwargs, expected in QUERIES:
+            assert _ids(FakeAuditQuery(**kwargs)) == expected, kwargs
+
+    def test_page(self):
+        _populate()
+        for query in (
+                FakeAuditQuery(module='sess'),
+                FakeAuditQuery(start=0),
+                ):
+            everything = _ids(query)
+
+            ids, cursor = [], None
+            while True:
+                entries, cursor = query.page(2, cursor)
+                assert len(entries) <= 2
+                ids.extend(ENTRIES_BY_KEY[entry['id']] for entry in entries)
+                if cursor is None:
+                    break
+
+            assert ids == everything
+
+    def test_cursor(self):
+        _populate()
+        entry = {'id': _key(2), 'ctime': MAY + 30.5, }
+        cursor = auditquery.encode_cursor(entry)
+        assert auditquery.decode_cursor(cursor) == (MAY + 30, _key(2), )
+        assert _ids(FakeAuditQuery(start=0), cursor) == [3, 4, 5]
+        assert _ids(FakeAuditQuery(uid='u1'), cursor) == [3, 5]
+
+        assert_raises(ValueError, auditquery.decode_cursor, 'k03')
+        assert_raises(ValueError, auditquery.decode_cursor, 'x:k03')
+
+    def test_key_pruning(self):
+        _populate()
+
+        # 时间范围和游标之外的 ID 不会去读
+        del FakeEntry.fetched[:]
+        query = FakeAuditQuery(uid='u1', start=MAY + 30, end=JUNE + 20)
+        assert _ids(query) == [2, 3]
+        assert sorted(FakeEntry.fetched) == [_key(2), _key(3)]
+
+        del FakeEntry.fetched[:]
+        cursor = auditquery.encode_cursor({
+                'id': _key(3),
+                'ctime': JUNE + 10.5,
+                })
+        assert _ids(FakeAuditQuery(module='sess'), cursor) == [4, 5]
+        assert sorted(FakeEntry.fetched) == [_key(4), _key(5)]
+
+    def test_first_partition(self):
+        _populate()
+        query = FakeAuditQuery()
+        assert query._first_partition() == '201405'
+
+        # 记下之后不再逐月查询
+        FakeEntry.buckets.clear()
+        assert query._first_partition() == '201405'
+
+        # 过期之后重新查找
+        partition, expires = auditquery._FIRST_PARTITIONS[FakeEntry]
+        auditquery._FIRST_PARTITIONS[FakeEntry] = (
+                partition,
+                expires - auditquery.AUDIT_FIRST_PARTITION_TTL_SECS,
+                )
+        assert query._first_partition() is None
+        assert _ids(query) == []
+
+        # 往以前的分区写入之后清掉, 马上就能查到
+        _populate()
+        assert query._first_partition() == '201405'
+        april = MAY - 86400
+        _store(encode36(april) + '0000', 'u1', 'sess', 'login', april)
+        auditquery.clear_first_partitions()
+        assert query._first_partition() == '201404'
+
+
+class TestAuditArchive(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_compact(self):
+        _populate()
+        archive = auditarchive.AuditArchive(FakeEntry)
+
+        stats = archive.compact('201405', chunk_size=2)
+        assert stats['entries'] == 3
+        assert stats['chunks'] == 2
+        assert stats['deleted'] == 3
+        assert stats['stray'] == 0
+        assert not FakeEntry.buckets['201405'].objects
+
+        manifest = archive.load_manifest('201405')
+        assert [chunk['n'] for chunk in manifest['c']] == [2, 1]
+        assert archive.load_manifest('201406') is None
+
+        # 查询透明地跨越压缩过和没压缩的分区
+        for kwargs, expected in QUERIES:
+            assert _ids(FakeAuditQuery(**kwargs)) == expected, kwargs
+        assert _ids(FakeAuditQuery(uid='u1'), '0:' + _key(0)) == [2, 3, 5]
+
+        entry = archive.fetch('201405', _key(1))
+        assert entry['uid'] == 'u2'
+        assert entry['ctime'] == MAY + 20.5
+        assert archive.fetch('201405', _key(3)) is None
+
+        # 再压缩一次不会重复打包
+        stats = archive.compact('201405')
+        assert stats['deleted'] == 0
+        assert len(archive.load_manifest('201405')['c']) == 2
+
+        # 清单不会再变, 之后不用再读数据库
+        del FakeEntry.buckets['archive'].objects['201405']
+        assert len(archive.load_manifest('201405')['c']) == 2
+
+    def test_strays(self):
+        _populate()
+        archive = auditarchive.AuditArchive(FakeEntry)
+        archive.compact('201405', chunk_size=2)
+
+        # 压缩之后才写进分区的记录照样能查到, 并且排在正确的位置
+        stray_key = encode36(MAY + 25) + 'ffff'
+        _store(stray_key, 'u1', 'sess', 'login', MAY + 25)
+        ENTRIES_BY_KEY[stray_key] = 'stray'
+        try:
+            assert _ids(FakeAuditQuery(uid='u1')) == [
+                    0, 'stray', 2, 3, 5,
+                    ]
+            assert _ids(FakeAuditQuery(end=MAY + 30)) == [
+                    0, 1, 'stray', 2,
+                    ]
+            assert _ids(FakeAuditQuery(uid='u1'), '0:' + _key(0)) == [
+                    'stray', 2, 3, 5,
+                    ]
+        finally:
+            del ENTRIES_BY_KEY[stray_key]
+
+    def test_compact_open_partition(self):
+        _populate()
+        archive = auditarchive.AuditArchive(FakeEntry)
+        current = audit.partition_of_ts(auditarchive.time.time())
+
+        assert_raises(ValueError, archive.compact, current)
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
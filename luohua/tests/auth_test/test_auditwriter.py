@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 认证 / 审计记录异步写入
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+import json
+import os
+import shutil
+import tempfile
+
+from ..utils import Case
+
+from luohua.auth import audit
+from luohua.auth import auditquery
+from luohua.auth import auditwriter
+
+
+class StopWriting(BaseException):
+    pass
+
+
+class FakeStorage(object):
+    def __init__(self):
+        self.available = True
+
+    def __enter__(self):
+        if not self.available:
+            raise IOError('storage unavailable')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class FakeEntry(object):
+    storage = FakeStorage()
+    saved = []
+
+    def __init__(
+            self,
+            name,
+            fail_times=0,
+            partition='201405',
+            valid=True,
+            data=None,
+            ):
+        self.name = name
+        self.fail_times = fail_times
+        self.partition = partition
+        self.valid = valid
+        self.data = data
+
+    def __getitem__(self, key):
+        assert key == 'id'
+        return self.name
+
+    def encode(self):
+        assert self.valid
+        return self.data if self.data is not None else {'name': self.name, }
+
+    @classmethod
+    def partition_storage(cls, partition):
+        return cls.storage
+
+    def save_to_conn(self, conn):
+        assert conn is self.storage
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise IOError('write failed')
+        self.saved.append(self.name)
+
+    def save(self):
+        with self.storage as conn:
+            self.save_to_conn(conn)
+
+
+class TestAuditWriter(Case):
+    @classmethod
+    def setup_class(cls):
+        cls.published = []
+        cls._orig_publish = auditwriter.pubsub.publish_event
+        auditwriter.pubsub.publish_event = cls._fake_publish
+
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.spill_path = os.path.join(cls.tmpdir, 'spill.jsonl')
+
+    @classmethod
+    def teardown_class(cls):
+        auditwriter.pubsub.publish_event = cls._orig_publish
+        audit.install_writer(None)
+        shutil.rmtree(cls.tmpdir)
+
+    @classmethod
+    def _fake_publish(cls, channel, typ, obj):
+        cls.published.append((channel, typ, obj.name, ))
+
+    def _reset(self):
+        del FakeEntry.saved[:]
+        del self.published[:]
+        FakeEntry.storage.available = True
+        if os.path.exists(self.spill_path):
+            os.unlink(self.spill_path)
+
+    def _read_spilled(self):
+        with open(self.spill_path) as fp:
+            return [json.loads(line) for line in fp]
+
+    def test_batched_write(self):
+        self._reset()
+        writer = auditwriter.AuditWriter(batch_size=2)
+        audit.install_writer(writer)
+        try:
+            audit.submit_entry(FakeEntry('a'), 'save')
+            audit.submit_entry(FakeEntry('b'), 'update')
+            audit.submit_entry(FakeEntry('c'), 'save')
+
+            # 提交时只是放进缓冲区
+            assert FakeEntry.saved == []
+            assert writer.stats()['pending'] == 3
+
+            assert writer.flush() == 3
+            assert FakeEntry.saved == ['a', 'b', 'c']
+            assert self.published == [
+                    ('_auditlog', 'save', 'a', ),
+                    ('_auditlog', 'update', 'b', ),
+                    ('_auditlog', 'save', 'c', ),
+                    ]
+            assert writer.stats()['pending'] == 0
+            assert writer.stats()['written'] == 3
+        finally:
+            audit.install_writer(None)
+
+    def test_retry_and_drop(self):
+        self._reset()
+        writer = auditwriter.AuditWriter(
+                max_attempts=2,
+                spill_path=self.spill_path,
+                )
+        writer.submit(FakeEntry('a', fail_times=1), 'save')
+        writer.submit(FakeEntry('b', fail_times=5), 'save')
+        writer.submit(FakeEntry('c'), 'save')
+
+        # 每轮每条只尝试一次, 失败的按原顺序留在缓冲区里
+        assert writer.flush() == 1
+        assert FakeEntry.saved == ['c']
+        assert [item[0].name for item in writer._pending] == ['a', 'b']
+
+        writer.close()
+        assert FakeEntry.saved == ['c', 'a']
+
+        stats = writer.stats()
+        assert stats['pending'] == 0
+        assert stats['written'] == 2
+        assert stats['retried'] == 2
+        assert stats['dropped'] == 1
+        assert stats['spilled'] == 1
+
+        # 放弃的记录转存到了本地文件
+        assert self._read_spilled() == [{
+                'id': 'b',
+                'data': {'name': 'b', },
+                'event_type': 'save',
+                }]
+
+    def test_unserializable_drop(self):
+        self._reset()
+        writer = auditwriter.AuditWriter(
+                max_attempts=1,
+                spill_path=self.spill_path,
+                )
+
+        # 转存时序列化失败也不能抛出, 同一轮里别的记录照常处理
+        writer.submit(FakeEntry('a', fail_times=1, data=object()), 'save')
+        writer.submit(FakeEntry('b', fail_times=1), 'save')
+        writer.submit(FakeEntry('c'), 'save')
+        assert writer.flush() == 1
+
+        stats = writer.stats()
+        assert stats['dropped'] == 2
+        assert stats['spilled'] == 1
+        assert [record['id'] for record in self._read_spilled()] == ['b']
+
+    def test_writer_survives_errors(self):
+        self._reset()
+        writer = auditwriter.AuditWriter()
+        # 不经过 submit, 免得启动真正的后台 greenlet
+        writer._pending.append([FakeEntry('a'), 'save', 0])
+        calls = []
+
+        def _flush():
+            calls.append(None)
+            raise ValueError('unexpected')
+
+        class FakeEvent(object):
+            def wait(self, timeout):
+                if len(calls) >= 2:
+                    raise StopWriting
+
+            def clear(self):
+                pass
+
+        writer.flush = _flush
+        writer._wakeup = FakeEvent()
+        try:
+            writer._write_forever()
+        except StopWriting:
+            pass
+
+        # 出错之后仍然继续下一轮
+        assert len(calls) == 2
+
+    def test_invalid_entry(self):
+        self._reset()
+        writer = auditwriter.AuditWriter()
+
+        # 不合格的记录在提交时就报错, 不进入缓冲区
+        try:
+            writer.submit(FakeEntry('a', valid=False), 'save')
+        except AssertionError:
+            pass
+        else:
+            assert False, 'should raise on invalid entries'
+
+        assert writer.stats()['pending'] == 0
+
+    def test_replay_spilled(self):
+        self._reset()
+        with open(self.spill_path, 'w') as fp:
+            for key in ('a', 'b', ):
+                fp.write(json.dumps({
+                        'id': key,
+                        'data': {'name': key, },
+                        'event_type': 'save',
+                        }) + '\n')
+
+        replayed = []
+
+        def _fake_write_entry(entry, event_type):
+            if entry['id'] == 'b':
+                raise IOError('write failed')
+            replayed.append((entry['id'], event_type, ))
+
+        orig_entry_cls = auditwriter.audit.AuditEntry
+        orig_write_entry = auditwriter.audit.write_entry
+        auditwriter.audit.AuditEntry = lambda data, key: {'id': key, }
+        auditwriter.audit.write_entry = _fake_write_entry
+        auditquery._FIRST_PARTITIONS[FakeEntry] = ('201405', 0, )
+        try:
+            assert auditwriter.replay_spilled(self.spill_path) == 1
+        finally:
+            auditwriter.audit.AuditEntry = orig_entry_cls
+            auditwriter.audit.write_entry = orig_write_entry
+
+        # 写入成功的移出文件, 失败的留着下次再试
+        assert replayed == [('a', 'save', )]
+        assert [record['id'] for record in self._read_spilled()] == ['b']
+
+        # 可能写进了以前的分区, 记下的最早分区作废
+        assert FakeEntry not in auditquery._FIRST_PARTITIONS
+
+    def test_storage_unavailable(self):
+        self._reset()
+        writer = auditwriter.AuditWriter(max_pending=2)
+        writer.submit(FakeEntry('a'), 'save')
+        writer.submit(FakeEntry('b'), 'save')
+
+        FakeEntry.storage.available = False
+        assert writer.flush() == 0
+        assert writer.stats()['pending'] == 2
+
+        # 缓冲区已满且写不出去, 新记录退回同步写入, 错误抛给调用方
+        try:
+            writer.submit(FakeEntry('c'), 'save')
+        except IOError:
+            pass
+        else:
+            assert False, 'should raise when storage is unavailable'
+
+        FakeEntry.storage.available = True
+        writer.submit(FakeEntry('d'), 'save')
+        writer.close()
+        assert FakeEntry.saved == ['a', 'b', 'd']
+
+    def test_sync_without_writer(self):
+        self._reset()
+        audit.install_writer(None)
+        audit.submit_entry(FakeEntry('a'), 'save')
+
+        assert FakeEntry.saved == ['a']
+        assert self.published == [('_auditlog', 'save', 'a', )]
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -24,7 +24,8 @@ from nose.tools import assert_raises
 from ..utils import Case
 from ..shortcuts import *
 
-from luohua.auth.role import has_cap, combine_caps, canonicalize_caps, Role
+from luohua.auth.role import has_cap, combine_caps, canonicalize_caps
+from luohua.auth.role import compile_caps, CompiledCaps, Role
 
 
 class TestRole(Case):
@@ -127,6 +128,38 @@ class TestRole(Case):
         caps = Role.allcaps(['testuser', 'restricted-user', ])
         assert caps == {'c1', 'c2', '-c1', }
 
+    def test_compile_caps(self):
+        caps = compile_caps({'*', 'a', '-foo', })
+
+        assert isinstance(caps, CompiledCaps)
+        assert compile_caps(caps) is caps
+        assert set(caps) == {'*', 'a', '-foo', }
+        assert 'bar' in caps
+        assert 'foo' not in caps
+        assert has_cap(caps, 'a')
+        assert not has_cap(caps, 'foo')
+        assert_raises(ValueError, has_cap, caps, '-foo')
+
+        caps = compile_caps(['c1', '-c1', 'c2', ])
+        assert 'c1' not in caps
+        assert 'c2' in caps
+        assert '*' not in caps
+
+    def test_compiled_caps(self):
+        caps = Role.compiled_caps(['testuser', 'testadm', ])
+
+        assert isinstance(caps, CompiledCaps)
+        assert set(caps) == {'c1', 'c2', 'c3', 'c5', }
+
+        # 按角色组合缓存, 与顺序和重复无关
+        assert Role.compiled_caps(['testadm', 'testuser', 'testadm', ]) is caps
+
+        # 保存角色后缓存失效
+        Role.fetch('testuser').save()
+        caps2 = Role.compiled_caps(['testuser', 'testadm', ])
+        assert caps2 is not caps
+        assert set(caps2) == set(caps)
+
     def test_combine_caps(self):
         def combine_case(*args):
             return set(combine_caps(*args))
@@ -100,6 +100,14 @@ class TestVFile(Case):
         assert vfl[0]['id'] == vfid
         del vfl
 
+        found, missing = vfile.VFile.fetch_multiple_split(
+                ['this-does-not-exist-too', vfid, ],
+                concurrency=1,
+                )
+        assert len(found) == 1
+        assert found[0]['id'] == vfid
+        assert missing == ['this-does-not-exist-too', ]
+
         vf2.purge()
         assert 'id' not in vf2
 
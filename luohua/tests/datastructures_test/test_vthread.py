@@ -47,6 +47,7 @@ class TestVThreadTree(Case):
 
         # 单独给插入回复测试用, 因为会变
         cls.thread_2 = vthread.VThreadTree(copy.deepcopy(t1))
+        cls.thread_3 = vthread.VThreadTree(copy.deepcopy(t1))
 
     @classmethod
     def teardown_class(cls):
@@ -62,6 +63,16 @@ class TestVThreadTree(Case):
         assert len(self.thread_1) == 12
         assert self.thread_1.num_direct_children() == 5
 
+    def test_version(self):
+        assert self.thread_0.version == 1
+        assert self.thread_1.version == 12
+
+        thread = vthread.VThreadTree([A, [B, ], ])
+        thread.append_to(None, C)
+        assert thread.version == 3
+        thread.append_to(C, D)
+        assert thread.version == 4
+
     def test_contains(self):
         assert A in self.thread_1
         assert Z not in self.thread_1
@@ -104,5 +115,21 @@ class TestVThreadTree(Case):
         assert 'ABCFIKM' == ''.join(self.thread_2.iter())
         assert 'CEJN' == ''.join(self.thread_2.tree[2])
 
+        # 时序索引也要跟着更新
+        assert 'ABCDEFGHIJKLMN' == ''.join(self.thread_2.iter_time_order())
+        assert 'KLMN' == ''.join(self.thread_2.iter_paginated(5, 2))
+        assert self.thread_2.num_pages(5) == 3
+
+    def test_append_to_before_indexing(self):
+        # 索引是用到时才建立的, 之前添加的直接回复也不能丢
+        self.thread_3.append_to(None, M)
+        self.thread_3.append_to(M, N)
+
+        assert 'ABCFIKM' == ''.join(self.thread_3.iter())
+        assert 'MN' == ''.join(self.thread_3.tree[6])
+        assert 'ABCDEFGHIJKLMN' == ''.join(self.thread_3.iter_time_order())
+        assert len(self.thread_3) == 14
+        assert N in self.thread_3
+
 
 # vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 实时信道 / 缓存一致性
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+import redis
+
+from ..utils import Case
+
+from luohua.rt import cachesync
+from luohua.utils import dblayer
+
+
+class StopListening(BaseException):
+    pass
+
+
+class FailingJSONPubSub(object):
+    def __init__(self, exc):
+        self.exc = exc
+        self.closed = 0
+
+    def subscribe(self, channels):
+        pass
+
+    def listen(self):
+        raise self.exc('boom')
+
+    def close(self):
+        self.closed += 1
+
+
+class TestCacheSync(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    def test_listener_failures(self):
+        # 连接超时, 非法 JSON 以及其他任何异常都不能让监听 greenlet 退出,
+        # 旧的订阅连接也要关掉
+        for exc in [redis.TimeoutError, ValueError, RuntimeError, ]:
+            listener = FailingJSONPubSub(exc)
+            delays = []
+
+            def _sleep(secs):
+                delays.append(secs)
+                if len(delays) >= 2:
+                    raise StopListening
+
+            orig_pubsub = cachesync.pubsub.JSONPubSub
+            orig_sleep = cachesync.gevent.sleep
+            cachesync.pubsub.JSONPubSub = lambda: listener
+            cachesync.gevent.sleep = _sleep
+            try:
+                try:
+                    cachesync.CacheSync()._listen_forever()
+                except StopListening:
+                    pass
+            finally:
+                cachesync.pubsub.JSONPubSub = orig_pubsub
+                cachesync.gevent.sleep = orig_sleep
+
+            assert listener.closed == 2
+            # 订阅成功过, 所以等待时间从头算起
+            assert delays == [
+                    cachesync.RESUBSCRIBE_DELAY_SECS,
+                    cachesync.RESUBSCRIBE_DELAY_SECS,
+                    ]
+
+    def test_admin_installs_publisher(self):
+        orig = dblayer.get_cache_coherence()
+        try:
+            dblayer.install_cache_coherence(None)
+
+            from luohua import admin
+            admin.install_cache_publisher()
+            impl = dblayer.get_cache_coherence()
+            assert isinstance(impl, cachesync.CacheSync)
+            assert not impl.listen
+
+            # 已经装上了的话不替换
+            admin.install_cache_publisher()
+            assert dblayer.get_cache_coherence() is impl
+        finally:
+            dblayer.install_cache_coherence(orig)
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
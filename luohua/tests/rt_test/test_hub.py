@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 实时信道 / 进程内 PubSub 分发
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+import json
+import os
+
+import redis
+
+from ..utils import Case
+
+from luohua.rt import hub
+
+GLOBAL = hub.GLOBAL_EVENT_CHANNEL
+USER_A = '/lh/evt/user/a'
+USER_B = '/lh/evt/user/b'
+
+
+class FakeListener(object):
+    def __init__(self):
+        self.calls = []
+
+    def subscribe(self, channels):
+        self.calls.append(('subscribe', sorted(channels), ))
+
+    def unsubscribe(self, channels):
+        self.calls.append(('unsubscribe', sorted(channels), ))
+
+
+class StopListening(BaseException):
+    pass
+
+
+class FailingJSONPubSub(object):
+    '''订阅成功, 但是 listen 时抛出给定的异常; 第二次起连订阅都失败.'''
+
+    def __init__(self, exc):
+        self.exc = exc
+        self.subscribed = []
+        self.closed = 0
+
+    def subscribe(self, channels):
+        if self.subscribed:
+            raise self.exc('again')
+        self.subscribed.append(sorted(channels))
+
+    def listen(self):
+        raise self.exc('boom')
+
+    def close(self):
+        self.closed += 1
+
+
+def _make_hub():
+    pubsub_hub = hub.PubSubHub()
+    # 不启动真正的监听 greenlet
+    pubsub_hub._listener_pid = os.getpid()
+    pubsub_hub._listener = FakeListener()
+    return pubsub_hub
+
+
+def _message(channel, data):
+    return {
+            'type': 'message',
+            'pattern': None,
+            'channel': channel,
+            'data': data,
+            }
+
+
+class TestPubSubHub(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    def test_refcount(self):
+        pubsub_hub = _make_hub()
+        calls = pubsub_hub._listener.calls
+
+        sub1 = pubsub_hub.subscriber()
+        sub2 = pubsub_hub.subscriber()
+
+        # 全局频道始终订阅着, 不需要再发命令
+        sub1.subscribe([GLOBAL, USER_A, ])
+        sub2.subscribe([GLOBAL, USER_A, USER_B, ])
+        assert calls == [
+                ('subscribe', [USER_A, ], ),
+                ('subscribe', [USER_B, ], ),
+                ]
+        assert pubsub_hub.channel_stats() == {
+                GLOBAL: 2,
+                USER_A: 2,
+                USER_B: 1,
+                }
+
+        # 重复订阅不增加计数
+        sub1.subscribe([USER_A, ])
+        assert pubsub_hub.channel_stats()[USER_A] == 2
+
+        del calls[:]
+        sub1.close()
+        assert calls == []
+
+        sub2.close()
+        assert calls == [('unsubscribe', [USER_A, USER_B, ], ), ]
+        assert pubsub_hub.channel_stats() == {}
+
+    def test_fanout(self):
+        pubsub_hub = _make_hub()
+
+        sub1 = pubsub_hub.subscriber()
+        sub2 = pubsub_hub.subscriber()
+        sub1.subscribe([GLOBAL, ])
+        sub2.subscribe([GLOBAL, USER_B, ])
+
+        msg1 = _message(GLOBAL, {'type': 'x', })
+        msg2 = _message(USER_B, {'type': 'y', })
+        pubsub_hub._dispatch(msg1)
+        pubsub_hub._dispatch(msg2)
+
+        # 所有订阅者拿到的是同一个对象
+        it1, it2 = sub1.listen(), sub2.listen()
+        event1 = next(it1)
+        assert next(it2) is event1
+        assert event1.channel == GLOBAL
+        assert event1.type == 'x'
+        assert event1.data == {}
+
+        event2 = next(it2)
+        assert event2.channel == USER_B
+        assert event2.type == 'y'
+
+        # 原始消息没有被改动
+        assert msg1['data'] == {'type': 'x', }
+
+        assert pubsub_hub.stats['messages'] == 2
+        assert pubsub_hub.stats['deliveries'] == 3
+
+        # 关闭之后 listen 结束
+        sub1.close()
+        assert list(it1) == []
+
+    def test_stray_channel(self):
+        pubsub_hub = _make_hub()
+        calls = pubsub_hub._listener.calls
+
+        # 没人订阅的频道来了消息, 退订之
+        pubsub_hub._dispatch(_message(USER_A, {}))
+        assert calls == [('unsubscribe', [USER_A, ], ), ]
+
+        # 全局频道不退订
+        pubsub_hub._dispatch(_message(GLOBAL, {}))
+        assert len(calls) == 1
+
+    def test_overflow(self):
+        pubsub_hub = _make_hub()
+
+        sub = pubsub_hub.subscriber(queue_size=2)
+        sub.subscribe([GLOBAL, USER_A, ])
+
+        for i in range(3):
+            pubsub_hub._dispatch(_message(GLOBAL, {'i': i, }))
+
+        assert sub.overflowed
+        assert sub.closed
+        assert pubsub_hub.stats['dropped'] == 1
+        assert pubsub_hub.channel_stats() == {}
+        assert list(sub.listen()) == []
+
+    def test_listener_failures(self):
+        # 连接超时, 非法 JSON 以及其他任何异常都不能让监听 greenlet 退出,
+        # 旧的订阅连接也要关掉
+        for exc in [redis.TimeoutError, ValueError, RuntimeError, ]:
+            pubsub_hub = _make_hub()
+            pubsub_hub._listener = None
+            listener = FailingJSONPubSub(exc)
+            delays = []
+
+            def _sleep(secs):
+                delays.append(secs)
+                if len(delays) >= 2:
+                    raise StopListening
+
+            orig_pubsub, orig_sleep = hub.pubsub.JSONPubSub, hub.gevent.sleep
+            hub.pubsub.JSONPubSub = lambda: listener
+            hub.gevent.sleep = _sleep
+            try:
+                try:
+                    pubsub_hub._listen_forever()
+                except StopListening:
+                    pass
+            finally:
+                hub.pubsub.JSONPubSub = orig_pubsub
+                hub.gevent.sleep = orig_sleep
+
+            assert listener.subscribed == [sorted(pubsub_hub.base_channels), ]
+            assert listener.closed == 2
+            assert pubsub_hub._listener is None
+            # 连续失败时等待时间加倍
+            assert delays == [
+                    hub.RESUBSCRIBE_DELAY_SECS,
+                    hub.RESUBSCRIBE_DELAY_SECS * 2,
+                    ]
+
+
+class TestEvent(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    def test_frame(self):
+        event = hub.Event(GLOBAL, {'type': 'x', 'uid': 'a', })
+
+        frame = event.frame('/rt')
+        assert event.frame('/rt') is frame
+
+        prefix = '5::/rt:'
+        assert frame.startswith(prefix)
+        assert json.loads(frame[len(prefix):]) == {
+                'name': 'rtEvent',
+                'args': [
+                    {
+                        'channel': GLOBAL,
+                        'type': 'x',
+                        'data': {'uid': 'a', },
+                        },
+                    ],
+                }
+
+    def test_non_dict(self):
+        event = hub.Event(GLOBAL, [1, 2, ])
+        assert event.type == ''
+        assert event.data == [1, 2, ]
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 实时信道 / 实时会话保活
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+import os
+
+from ..utils import Case
+
+from luohua.rt import keepalive
+
+
+class FakeStateManager(object):
+    def __init__(self, missing=()):
+        self.missing = set(missing)
+        self.batches = []
+
+    def touch_rt_sessions(self, rt_sids):
+        self.batches.append(sorted(rt_sids))
+        return [rt_sid for rt_sid in rt_sids if rt_sid in self.missing]
+
+
+def _make_scheduler(state_mgr, batch_size=2):
+    scheduler = keepalive.KeepaliveScheduler(
+            batch_size=batch_size,
+            state_mgr=state_mgr,
+            )
+    # 不启动真正的后台 greenlet
+    scheduler._runner_pid = os.getpid()
+    return scheduler
+
+
+class TestKeepaliveScheduler(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    def test_batches(self):
+        state_mgr = FakeStateManager()
+        scheduler = _make_scheduler(state_mgr)
+
+        for rt_sid in ['a', 'b', 'c', 'd', 'e', ]:
+            scheduler.add(rt_sid)
+        scheduler.discard('e')
+        scheduler.discard('nonexistent')
+        assert len(scheduler) == 4
+
+        scheduler.tick()
+        assert len(state_mgr.batches) == 2
+        assert sorted(sum(state_mgr.batches, [])) == ['a', 'b', 'c', 'd', ]
+        assert scheduler.stats['ticks'] == 1
+        assert scheduler.stats['touched'] == 4
+
+    def test_expired(self):
+        state_mgr = FakeStateManager(missing=['b', ])
+        scheduler = _make_scheduler(state_mgr, batch_size=10)
+
+        scheduler.add('a')
+        scheduler.add('b')
+        scheduler.tick()
+        assert scheduler.stats['touched'] == 1
+        assert scheduler.stats['expired'] == 1
+        assert len(scheduler) == 1
+
+        # 过期的会话不再 touch
+        scheduler.tick()
+        assert state_mgr.batches[-1] == ['a', ]
+
+    def test_empty(self):
+        state_mgr = FakeStateManager()
+        scheduler = _make_scheduler(state_mgr)
+
+        scheduler.tick()
+        assert state_mgr.batches == []
+        assert scheduler.stats['ticks'] == 1
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
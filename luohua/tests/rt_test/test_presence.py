@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 实时信道 / 在线状态
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+import os
+
+import redis
+
+from nose.tools import assert_raises
+
+from ..utils import Case
+
+from luohua.rt import presence
+
+
+class StopFlushing(BaseException):
+    pass
+
+
+class FakeStateManager(object):
+    def __init__(self):
+        self.online = set()
+        self.fail = False
+
+    def online_states(self, uids):
+        if self.fail:
+            raise redis.ConnectionError('down')
+
+        return dict((uid, uid in self.online, ) for uid in uids)
+
+
+def _make_engine():
+    state_mgr = FakeStateManager()
+    published = []
+
+    def _publish(typ, **kwargs):
+        published.append((typ, kwargs, ))
+
+    engine = presence.PresenceEngine(
+            window=1,
+            state_mgr=state_mgr,
+            publish=_publish,
+            )
+    # 不启动真正的后台 greenlet
+    engine._flusher_pid = os.getpid()
+    return engine, state_mgr, published
+
+
+class TestPresenceEngine(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    def test_batched(self):
+        engine, state_mgr, published = _make_engine()
+
+        state_mgr.online.update(['a', 'b', ])
+        engine.mark_online('a', 'A')
+        engine.mark_online('b', 'B')
+        engine.mark_offline('c', 'C')
+
+        online, offline = engine.flush()
+        assert online == [
+                {'uid': 'a', 'display_name': 'A', },
+                {'uid': 'b', 'display_name': 'B', },
+                ]
+        assert offline == [{'uid': 'c', 'display_name': 'C', }, ]
+
+        # 一个窗口只发一条通知
+        assert published == [
+                (
+                    presence.PRESENCE_EVENT_TYPE,
+                    {'online': online, 'offline': offline, },
+                    ),
+                ]
+        assert engine.stats['published'] == 3
+
+        # 没有新变化就不发送
+        assert engine.flush() == ([], [])
+        assert len(published) == 1
+
+    def test_flapping(self):
+        engine, state_mgr, published = _make_engine()
+
+        # 下线又上线
+        state_mgr.online.add('a')
+        engine.mark_offline('a', 'A')
+        engine.mark_online('a', 'A')
+
+        # 上线又下线
+        engine.mark_online('b', 'B')
+        engine.mark_offline('b', 'B')
+
+        assert engine.flush() == ([], [])
+        assert published == []
+        assert engine.stats['suppressed'] == 2
+
+    def test_current_state_wins(self):
+        engine, state_mgr, published = _make_engine()
+
+        # 本进程看到的是下线, 但用户已经在别的进程上重新登录了
+        state_mgr.online.add('a')
+        engine.mark_offline('a', 'A')
+
+        assert engine.flush() == ([], [])
+        assert published == []
+
+    def test_retry_on_error(self):
+        engine, state_mgr, published = _make_engine()
+
+        engine.mark_offline('a', 'A')
+        state_mgr.fail = True
+        with assert_raises(redis.ConnectionError):
+            engine.flush()
+
+        # 重试期间又上线了; 窗口开始时在线, 最终仍在线, 不需要通知
+        engine.mark_online('a', 'A')
+        state_mgr.fail = False
+        state_mgr.online.add('a')
+        assert engine.flush() == ([], [])
+
+    def test_retry_on_publish_error(self):
+        state_mgr = FakeStateManager()
+        published, failures = [], [1]
+
+        def _publish(typ, **kwargs):
+            if failures[0]:
+                failures[0] -= 1
+                raise redis.ConnectionError('down')
+            published.append((typ, kwargs, ))
+
+        engine = presence.PresenceEngine(
+                window=1,
+                state_mgr=state_mgr,
+                publish=_publish,
+                )
+        engine._flusher_pid = os.getpid()
+
+        engine.mark_offline('a', 'A')
+        with assert_raises(redis.ConnectionError):
+            engine.flush()
+
+        # 发送失败的窗口没有丢, 下次和新的变化一起发出
+        engine.mark_offline('b', 'B')
+        online, offline = engine.flush()
+        assert online == []
+        assert offline == [
+                {'uid': 'a', 'display_name': 'A', },
+                {'uid': 'b', 'display_name': 'B', },
+                ]
+        assert len(published) == 1
+
+    def test_flusher_survives_errors(self):
+        engine, state_mgr, published = _make_engine()
+        calls = []
+
+        def _flush():
+            calls.append(None)
+            raise ValueError('unexpected')
+
+        def _sleep(secs):
+            if len(calls) >= 2:
+                raise StopFlushing
+
+        engine.flush = _flush
+        orig_sleep = presence.gevent.sleep
+        presence.gevent.sleep = _sleep
+        try:
+            with assert_raises(StopFlushing):
+                engine._flush_forever()
+        finally:
+            presence.gevent.sleep = orig_sleep
+
+        # 出错之后仍然继续下一轮
+        assert len(calls) == 2
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 工具 / 数据库抽象层
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+from ..utils import Case
+from ..shortcuts import *
+
+from luohua.utils import dblayer
+
+
+class LazyTestDocument(dblayer.RiakDocument):
+    struct_id = 'luohua.test.lazy'
+
+
+@LazyTestDocument.decoder(1)
+def lazy_test_dec_v1(data):
+    return {
+            'plain': data['p'],
+            'lazy': dblayer.LazyField(_record_conversion, data['l']),
+            }
+
+
+_CONVERSIONS = []
+
+
+def _record_conversion(value):
+    _CONVERSIONS.append(value)
+    return value * 2
+
+
+class TestLazyField(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_resolve_once(self):
+        del _CONVERSIONS[:]
+        doc = LazyTestDocument({'_V': 1, 'p': 1, 'l': 21, }, A)
+
+        assert doc['plain'] == 1
+        assert doc['id'] == A
+        assert _CONVERSIONS == []
+
+        assert doc['lazy'] == 42
+        assert doc.get('lazy') == 42
+        assert _CONVERSIONS == [21, ]
+
+    def test_bulk_access(self):
+        del _CONVERSIONS[:]
+        doc = LazyTestDocument({'_V': 1, 'p': 1, 'l': 2, }, A)
+
+        assert sorted(doc.values()) == [1, 4, A, ]
+        assert dict(doc.items())['lazy'] == 4
+        assert doc == {'plain': 1, 'lazy': 4, 'id': A, }
+        assert _CONVERSIONS == [2, ]
+
+        doc = LazyTestDocument({'_V': 1, 'p': 1, 'l': 3, }, A)
+        assert doc.pop('lazy') == 6
+        assert 'lazy' not in doc
+
+
+class TestDocumentCache(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_get_put(self):
+        cache = dblayer.DocumentCache(60, 10)
+
+        assert cache.get(A) is None
+        cache.put(A, 1)
+        assert cache.get(A) == 1
+        assert len(cache) == 1
+
+        cache.put(A, 2)
+        assert cache.get(A) == 2
+        assert len(cache) == 1
+
+        cache.invalidate(A)
+        cache.invalidate(B)
+        assert cache.get(A) is None
+        assert len(cache) == 0
+
+    def test_lru(self):
+        cache = dblayer.DocumentCache(60, 2)
+
+        cache.put(A, 1)
+        cache.put(B, 2)
+
+        # A 最近用过, 所以接下来被淘汰的应该是 B
+        assert cache.get(A) == 1
+        cache.put(C, 3)
+
+        assert cache.get(B) is None
+        assert cache.get(A) == 1
+        assert cache.get(C) == 3
+        assert cache.stats()['evictions'] == 1
+
+    def test_ttl(self):
+        cache = dblayer.DocumentCache(-1, 10)
+
+        cache.put(A, 1)
+        assert cache.get(A) is None
+        assert len(cache) == 0
+
+    def test_stats(self):
+        cache = dblayer.DocumentCache(60, 10)
+
+        cache.put(A, 1)
+        cache.get(A)
+        cache.get(A)
+        cache.get(B)
+
+        stats = cache.stats()
+        assert stats['hits'] == 2
+        assert stats['misses'] == 1
+        assert stats['size'] == 1
+        assert stats['maxsize'] == 10
+
+        cache.clear()
+        assert len(cache) == 0
+        assert cache.stats()['hits'] == 2
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 工具 / 快速数制转换
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+from nose.tools import assert_raises
+
+from ..utils import Case
+
+from luohua.utils import radices
+from luohua.utils import radixcodec
+
+# 覆盖一组和两组数码的边界, 以及需要多次循环的大数
+SAMPLE_INTS = [
+        0, 1, 35, 36, 61, 62, 1295, 1296, 1297, 3843, 3844, 3845,
+        13368, 46655, 46656, 238327, 238328, 1400000000, 2 ** 31,
+        18446744073709551616,
+        ]
+
+
+class TestRadixCodec(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    @classmethod
+    def teardown_class(cls):
+        pass
+
+    def test_encode_matches_radices(self):
+        for x in SAMPLE_INTS:
+            for v in (x, -x, ):
+                assert radixcodec.encode36(v) == radices.to36(v)
+                assert radixcodec.encode62(v) == radices.to62(v)
+
+        assert radixcodec.encode36(18446744073709551616) == '3w5e11264sgsg'
+        assert radixcodec.encode62(18446744073709551616) == 'LygHa16AHYG'
+
+    def test_decode(self):
+        for x in SAMPLE_INTS:
+            for v in (x, -x, ):
+                assert radixcodec.decode36(radices.to36(v)) == v
+                assert radixcodec.decode62(radices.to62(v)) == v
+
+        assert radixcodec.decode62('LygHa16AHYG') == 18446744073709551616
+        assert_raises(ValueError, radixcodec.decode62, '')
+        assert_raises(ValueError, radixcodec.decode62, '10.0')
+        assert_raises(ValueError, radixcodec.decode62, ' 1')
+
+    def test_encode_fixed(self):
+        assert radixcodec.encode36_fixed(0, 1) == '0'
+        assert radixcodec.encode36_fixed(0, 4) == '0000'
+        assert radixcodec.encode36_fixed(35, 3) == '00z'
+        assert radixcodec.encode36_fixed(13368, 3) == 'abc'
+        assert radixcodec.encode36_fixed(13368, 6) == '000abc'
+        assert radixcodec.encode62_fixed(61, 2) == '0z'
+        assert radixcodec.encode62_fixed(62, 5) == '00010'
+
+        for x in SAMPLE_INTS:
+            for width in (13, 14, ):
+                assert (
+                        radixcodec.encode36_fixed(x, width)
+                        == radices.to36(x).rjust(width, '0')
+                        )
+                assert (
+                        radixcodec.encode62_fixed(x, width)
+                        == radices.to62(x).rjust(width, '0')
+                        )
+
+        assert_raises(ValueError, radixcodec.encode36_fixed, 36, 1)
+        assert_raises(ValueError, radixcodec.encode36_fixed, -1, 4)
+        assert_raises(ValueError, radixcodec.encode62_fixed, 3844, 2)
+        assert_raises(ValueError, radixcodec.encode62_fixed, 0, 0)
+
+    def test_bulk(self):
+        ints = SAMPLE_INTS + [-x for x in SAMPLE_INTS]
+
+        assert radixcodec.encode36_many(ints) == [
+                radices.to36(x) for x in ints
+                ]
+        assert radixcodec.encode62_many(ints) == [
+                radices.to62(x) for x in ints
+                ]
+        assert radixcodec.encode36_fixed_many([1, 36], 3) == ['001', '010']
+        assert radixcodec.encode62_fixed_many([1, 62], 3) == ['001', '010']
+        assert_raises(
+                ValueError,
+                radixcodec.encode36_fixed_many,
+                [1, 46656],
+                3,
+                )
+
+        assert radixcodec.decode36_many(
+                radixcodec.encode36_many(ints)
+                ) == ints
+        assert radixcodec.decode62_many(
+                radixcodec.encode62_many(ints)
+                ) == ints
+        assert radixcodec.encode36_many([]) == []
+        assert radixcodec.decode62_many([]) == []
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
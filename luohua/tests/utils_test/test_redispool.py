@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 测试套件 / 辅助组件 / Redis 连接池
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+import redis
+
+from nose.tools import assert_raises
+
+from ..utils import Case
+
+from luohua.utils import redispool
+
+# 本机上不会有服务监听这个端口, 连接会立即被拒绝
+DEAD_PORT = 1
+
+
+def _dead_client(pool_cls=redis.ConnectionPool, **kwargs):
+    pool = pool_cls(host='127.0.0.1', port=DEAD_PORT, **kwargs)
+    stats = redispool.RedisPoolManager()._new_stats()
+    return redispool.PooledRedis(
+            connection_pool=pool,
+            pool_stats=stats,
+            max_retries=2,
+            retry_backoff=0,
+            retry_backoff_max=0,
+            ), stats
+
+
+class TestRedisPool(Case):
+    @classmethod
+    def setup_class(cls):
+        pass
+
+    def test_retry(self):
+        client, stats = _dead_client()
+
+        with assert_raises(redis.ConnectionError):
+            client.get('foo')
+
+        assert stats['errors'] == 3
+        assert stats['retries'] == 2
+
+    def test_check_health(self):
+        mgr = redispool.RedisPoolManager()
+        mgr._pools[('dead', 0)] = _dead_client()
+
+        assert not mgr.check_health()
+
+        stats = mgr.stats()['dead/0']
+        assert stats['healthy'] is False
+        assert stats['health_checks'] == 1
+        assert stats['health_failures'] == 1
+
+    def test_stats(self):
+        mgr = redispool.RedisPoolManager()
+        mgr._pools[('dead', 1)] = _dead_client(
+                redis.BlockingConnectionPool,
+                max_connections=4,
+                )
+        mgr._pubsub_pools[('dead', 1)] = _dead_client()
+
+        result = mgr.stats()
+        assert set(result.keys()) == {'dead/1', 'dead/1 (pubsub)', }
+
+        stats = result['dead/1']
+        assert stats['max_connections'] == 4
+        assert stats['created'] == 0
+        assert stats['in_use'] == 0
+
+        # 模拟借出一个连接. get_connection 会真的去连接, 所以手工操作
+        pool = mgr._pools[('dead', 1)][0].connection_pool
+        pool.pool.get_nowait()
+        conn = pool.make_connection()
+        stats = mgr.stats()['dead/1']
+        assert stats['created'] == 1
+        assert stats['idle'] == 0
+        assert stats['in_use'] == 1
+
+        pool.release(conn)
+        stats = mgr.stats()['dead/1']
+        assert stats['idle'] == 1
+        assert stats['in_use'] == 0
+
+        assert mgr.stats()['dead/1 (pubsub)']['max_connections'] is None
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -22,11 +22,45 @@ from __future__ import unicode_literals, division
 import time
 import six
 
+from nose.tools import assert_raises
+
 from ..utils import Case
 
 from luohua.utils import sequences
 
 
+class FakeRedis(object):
+    '''只实现了工作进程号租约用到的几个命令.'''
+
+    def __init__(self):
+        self.counter = 0
+        self.leases = {}
+
+    def incr(self, key):
+        assert key == sequences.WORKER_ID_COUNTER_KEY
+        self.counter += 1
+        return self.counter
+
+    def set(self, key, value, nx=False, ex=None):
+        assert nx and ex == sequences.WORKER_LEASE_SECS
+        if key in self.leases:
+            return None
+        self.leases[key] = value
+        return True
+
+    def register_script(self, source):
+        assert source == sequences._RENEW_LEASE_SCRIPT
+
+        def _renew(keys, args):
+            holder = self.leases.get(keys[0])
+            if holder is not None and holder != args[0]:
+                return 0
+            self.leases[keys[0]] = args[0]
+            return 1
+
+        return _renew
+
+
 class TestSequences(Case):
     @classmethod
     def setup_class(cls):
@@ -77,5 +111,100 @@ class TestSequences(Case):
         assert tds1 > tds2
         assert tas1 < tas2
 
+    def test_unique_allocator(self):
+        ts = 1400000000
+        alloc1 = sequences.UniqueIDAllocator(1)
+        alloc2 = sequences.UniqueIDAllocator(2)
+
+        # 同一秒内大量生成也不重复, 并且严格单调
+        asc = [alloc1.ascending(ts) for i in six.moves.range(2000)]
+        assert len(set(asc)) == len(asc)
+        assert asc == sorted(asc)
+        assert all(isinstance(i, six.text_type) for i in asc)
+
+        desc = [alloc2.descending(ts) for i in six.moves.range(2000)]
+        assert len(set(desc)) == len(desc)
+        assert desc == sorted(desc, reverse=True)
+
+        # 不同进程号之间不冲突
+        assert not set(asc) & set(alloc2.ascending(ts) for i in range(10))
+
+        # 时间顺序优先于进程号
+        assert alloc2.ascending(ts) < alloc1.ascending(ts + 100)
+        assert alloc1.descending(ts + 100) < alloc2.descending(ts)
+
+        # 计数器用完时借用下一秒, 仍然单调
+        alloc3 = sequences.UniqueIDAllocator(3)
+        ids = [
+                alloc3.next(ts)
+                for i in six.moves.range(sequences.UNIQUE_COUNTER_LIMIT + 1)
+                ]
+        assert ids[-1] == (ts + 1, 3, 0, )
+        assert ids == sorted(ids)
+
+        assert_raises(
+                ValueError,
+                sequences.UniqueIDAllocator,
+                sequences.UNIQUE_WORKER_ID_LIMIT,
+                )
+
+    def test_worker_id_lease(self):
+        client = FakeRedis()
+        orig_get_client = sequences.redispool.get_client
+        orig_worker_id = list(sequences._WORKER_ID)
+        sequences.redispool.get_client = lambda storage_id: client
+        try:
+            # 跳过租约在别的进程手里的号码
+            client.leases[sequences.WORKER_LEASE_KEY_FORMAT % 0] = 'other'
+            del sequences._WORKER_ID[:]
+            assert sequences._get_worker_id() == 1
+            assert client.counter == 1
+
+            # 租约有效期内不访问 Redis
+            del client.leases[sequences.WORKER_LEASE_KEY_FORMAT % 1]
+            assert sequences._get_worker_id() == 1
+            assert not client.leases.get(sequences.WORKER_LEASE_KEY_FORMAT % 1)
+
+            # 该续租时, 租约没了 (例如 Redis 重启) 就重新占上
+            sequences._WORKER_ID[3] -= sequences.WORKER_LEASE_RENEW_SECS
+            assert sequences._get_worker_id() == 1
+            assert client.leases[sequences.WORKER_LEASE_KEY_FORMAT % 1] == (
+                    sequences._WORKER_ID[2]
+                    )
+
+            # 租约被别的进程占去了就换一个号码
+            client.leases[sequences.WORKER_LEASE_KEY_FORMAT % 1] = 'other'
+            sequences._WORKER_ID[3] -= sequences.WORKER_LEASE_RENEW_SECS
+            assert sequences._get_worker_id() == 2
+        finally:
+            sequences.redispool.get_client = orig_get_client
+            sequences._WORKER_ID[:] = orig_worker_id
+
+    def test_unique_allocator_bulk(self):
+        ts_ms = 1400000000123
+        alloc1 = sequences.UniqueIDAllocator(1, millis=True)
+        alloc2 = sequences.UniqueIDAllocator(1, millis=True)
+
+        # 批量生成与逐个生成的结果相同
+        n = alloc1.counter_limit * 2 + 10
+        bulk = alloc1.bulk(n, ts_ms)
+        single = [alloc2.ascending(ts_ms) for i in six.moves.range(n)]
+        assert bulk == single
+        assert len(set(bulk)) == n
+        assert bulk == sorted(bulk)
+
+        # 批量生成之后继续逐个生成, 仍然单调
+        assert alloc1.ascending(ts_ms) > bulk[-1]
+        assert alloc1.bulk(0) == []
+
+        desc = alloc1.bulk(100, ts_ms + 5, descending=True)
+        assert len(set(desc)) == 100
+        assert desc == sorted(desc, reverse=True)
+
+        # 毫秒精度
+        alloc3 = sequences.UniqueIDAllocator(1, millis=True)
+        assert alloc3.ascending(ts_ms) < alloc3.ascending(ts_ms + 1)
+        assert alloc3.descending(ts_ms + 2) > alloc3.descending(ts_ms + 3)
+
 
 # vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
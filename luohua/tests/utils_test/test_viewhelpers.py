@@ -19,6 +19,13 @@
 
 from __future__ import unicode_literals, division
 
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from nose.tools import assert_raises
+
 from ..utils import Case
 from ..shortcuts import *
 
@@ -40,6 +47,37 @@ class TestViewHelpers(Case):
         assert content == {'r': 0, }
         assert ctx == {}
 
+    def test_stream_jsonreply(self):
+        def gen():
+            for i in range(3):
+                yield {'i': i, 'n': '中' * i, }
+
+        status, content, ctx = viewhelpers.stream_jsonreply('l', gen(), r=0)
+        assert status == 200
+        assert ctx['is_raw_file']
+
+        # 推送原始文件时 weiyu 不会生成 Content-Type, 要自己带上
+        assert ctx['headers'] == [
+                ('Content-Type', 'application/json; charset=utf-8', ),
+                ]
+
+        fp = content['sendfile_fp']
+        chunks = []
+        chunk = fp.read(5)
+        while chunk:
+            assert len(chunk) <= 5
+            chunks.append(chunk)
+            chunk = fp.read(5)
+        fp.close()
+
+        result = json.loads(b''.join(chunks).decode('utf-8'))
+        assert result['r'] == 0
+        assert [item['i'] for item in result['l']] == [0, 1, 2, ]
+        assert result['l'][2]['n'] == '中中'
+
+        _, content, _ = viewhelpers.stream_jsonreply('l', [])
+        assert json.loads(content['sendfile_fp'].read()) == {'l': [], }
+
     def test_parse_form(self):
         class MockRequest(object):
             def __init__(self, form):
@@ -56,5 +94,23 @@ class TestViewHelpers(Case):
                 c=0, d=0,
                 )
 
+    def test_parse_query(self):
+        class MockRequest(object):
+            def __init__(self, query):
+                self.env = {'QUERY_STRING': query, }
+
+        req = MockRequest(b'a=1&b=%E4%B8%AD&a=2')
+
+        assert () == viewhelpers.parse_query(req)
+        assert ('1', ) == viewhelpers.parse_query(req, 'a', )
+        assert ('中', '1', ) == viewhelpers.parse_query(req, 'b', 'a', )
+        assert ('1', None, ) == viewhelpers.parse_query(
+                req,
+                'a', 'c',
+                c=None,
+                )
+        assert_raises(KeyError, viewhelpers.parse_query, req, 'c')
+        assert ('x', ) == viewhelpers.parse_query(MockRequest(b''), 'a', a='x')
+
 
 # vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
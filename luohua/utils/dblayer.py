@@ -19,9 +19,38 @@
 
 from __future__ import unicode_literals, division
 
+import collections
+import copy
+import functools
+import itertools
+import time
+
+import six
+
+from gevent import Timeout
+from gevent.pool import Pool
+
 from weiyu.helpers.misc import smartbytes, smartstr
 from weiyu.db.mapper.base import Document
 
+# 批量获取对象时同时进行的数据库请求数上限
+BULK_FETCH_CONCURRENCY = 16
+
+# 文档缓存默认的容量 (对象个数)
+DEFAULT_CACHE_SIZE = 1024
+
+# 逐页读取 2i 查询结果时默认的每页条数
+INDEX_PAGE_SIZE = 1000
+
+# struct_id -> 文档缓存
+_CACHES = {}
+
+# 跨进程缓存失效通知的实现, 见 install_cache_coherence
+_COHERENCE = []
+
+# struct_id -> 缓存条目失效时的回调列表, 见 add_invalidation_hook
+_INVALIDATION_HOOKS = collections.defaultdict(list)
+
 
 class MultipleObjectsError(ValueError):
     '''2i 查询对最多只期待 1 个结果的查询返回了多于 1 个的结果.'''
@@ -29,6 +58,331 @@ class MultipleObjectsError(ValueError):
     pass
 
 
+class FetchTimeoutError(RuntimeError):
+    '''批量获取对象时, 某个对象的读取请求超出了指定的时间限制.
+
+    异常参数为超时对象的文档 ID.
+
+    '''
+
+    pass
+
+
+class LazyField(object):
+    '''解码器里用来推迟转换字段值的包装.
+
+    解码器把开销较大的转换写成 ``LazyField(fn, *args)``, 则只有第一次通过
+    ``doc[key]`` 等方式读取该字段时才会调用 ``fn(*args)``, 结果替换掉
+    本包装存在文档里. 只读取状态或少数字段的场合就可以省下这部分开销.
+
+    '''
+
+    __slots__ = ('fn', 'args', )
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __repr__(self):
+        return '<LazyField %r>' % (self.fn, )
+
+    def resolve(self):
+        return self.fn(*self.args)
+
+
+def _resolving(name):
+    '''生成一个先转换全部延迟字段再调用 :class:`dict` 同名方法的方法.'''
+
+    dict_method = getattr(dict, name)
+
+    def _method_(self, *args, **kwargs):
+        self._resolve_lazy_fields()
+        return dict_method(self, *args, **kwargs)
+
+    _method_.__name__ = str(name)
+    _method_.__doc__ = dict_method.__doc__
+    return _method_
+
+
+def _get_with_timeout(conn, timeout, key):
+    '''在指定时间内从数据库连接读取一个对象, 超时则抛
+    :exc:`FetchTimeoutError` 异常. ``timeout`` 为 :const:`None` 则不限时.
+
+    '''
+
+    with Timeout(timeout, FetchTimeoutError(key)):
+        return conn.get(key)
+
+
+class DocumentCache(object):
+    '''进程内的文档缓存, 按最近最少使用 (LRU) 原则淘汰, 条目有存活时间.
+
+    缓存的值对本类是不透明的. 要换用其他实现的话, 只要提供同样的
+    :meth:`get`, :meth:`peek`, :meth:`put`, :meth:`invalidate`,
+    :meth:`clear` 和 :meth:`stats` 方法, 再用 :func:`install_cache` 装上即可.
+
+    :param ttl: 条目的存活时间, 单位为秒.
+    :type ttl: float
+    :param maxsize: 最多缓存的条目数.
+    :type maxsize: int
+
+    '''
+
+    def __init__(self, ttl, maxsize=DEFAULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+        # key -> (过期时间, 值), 越靠后越是最近用过的
+        self._entries = collections.OrderedDict()
+
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        '''取出缓存的值; 不存在或已过期则返回 :const:`None`.'''
+
+        try:
+            expires, value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if expires < time.time():
+            # 过期了, 顺便扔掉
+            self.misses += 1
+            return None
+
+        # 重新放到最后, 表示最近用过
+        self._entries[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        '''放入一个值, 必要时淘汰最久没用过的条目.'''
+
+        entries = self._entries
+        entries.pop(key, None)
+        entries[key] = (time.time() + self.ttl, value)
+
+        while len(entries) > self.maxsize:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    def peek(self, key):
+        '''取出缓存的值, 但不计入统计, 也不影响淘汰顺序.
+
+        不存在或已过期则返回 :const:`None`.
+
+        '''
+
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            return None
+
+        return value if expires >= time.time() else None
+
+    def invalidate(self, key):
+        '''使一个条目失效. 条目不存在也不会出错.'''
+
+        self._entries.pop(key, None)
+
+    def clear(self):
+        '''清空所有条目. 统计数据不受影响.'''
+
+        self._entries.clear()
+
+    def stats(self):
+        '''返回命中率等统计数据.
+
+        :rtype: dict
+
+        '''
+
+        return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                }
+
+
+def install_cache(struct_id, cache):
+    '''为指定 struct_id 的文档装上一个缓存, 替换掉默认的实现.
+
+    ``cache`` 为 :const:`None` 则关闭该类文档的缓存.
+
+    '''
+
+    _CACHES[struct_id] = cache
+
+
+def get_cache(struct_id):
+    '''返回指定 struct_id 的文档当前所用的缓存.
+
+    该类文档未启用缓存, 或者还没有被读取过的话, 返回 :const:`None`.
+
+    '''
+
+    return _CACHES.get(struct_id)
+
+
+def clear_caches():
+    '''清空当前进程中的所有文档缓存.'''
+
+    for cache in six.itervalues(_CACHES):
+        if cache is not None:
+            cache.clear()
+
+    for struct_id, hooks in six.iteritems(_INVALIDATION_HOOKS):
+        for hook in hooks:
+            hook(None)
+
+
+def add_invalidation_hook(struct_id, hook):
+    '''注册一个回调, 在指定 struct_id 的文档缓存条目失效时调用.
+
+    不论失效是因为本进程保存/删除了对象, 还是收到了其他进程的通知, 都会
+    调用 ``hook(key)``; 整个缓存被清空时 ``key`` 为 :const:`None`.
+    适用于缓存了由这类文档派生出的数据的场合.
+
+    '''
+
+    _INVALIDATION_HOOKS[struct_id].append(hook)
+
+
+def _run_invalidation_hooks(struct_id, key):
+    for hook in _INVALIDATION_HOOKS.get(struct_id, ()):
+        hook(key)
+
+
+def encode_vclock(vclock):
+    '''把 Riak 对象的 vclock 转换为可比较, 可以用 JSON 传输的文本.
+
+    ``vclock`` 为 :const:`None` 时返回 :const:`None`.
+
+    '''
+
+    if vclock is None:
+        return None
+
+    return smartstr(vclock.encode('base64')).strip()
+
+
+def invalidate_cached(struct_id, key, vclock=None):
+    '''使当前进程中指定文档的缓存失效.
+
+    如果给出了 ``vclock`` (:func:`encode_vclock` 的结果), 而缓存的版本
+    恰好就是这个版本, 则保留缓存. 除此之外都会调用通过
+    :func:`add_invalidation_hook` 注册的回调, 因为派生数据的缓存可能比
+    文档缓存活得更久.
+
+    :return: 是否确实丢弃了缓存条目.
+    :rtype: bool
+
+    '''
+
+    cache = _CACHES.get(struct_id)
+    entry = cache.peek(key) if cache is not None else None
+    if entry is None:
+        _run_invalidation_hooks(struct_id, key)
+        return False
+
+    if vclock is not None and encode_vclock(entry[1]) == vclock:
+        return False
+
+    cache.invalidate(key)
+    _run_invalidation_hooks(struct_id, key)
+    return True
+
+
+def install_cache_coherence(impl):
+    '''装上跨进程缓存失效通知的实现.
+
+    ``impl`` 需要提供两个方法:
+
+    * ``publish(struct_id, key, vclock)``: 对象被保存或删除之后调用,
+      ``vclock`` 是 :func:`encode_vclock` 的结果, 删除时为 :const:`None`;
+    * ``ensure_listening()``: 每次通过缓存读取对象时调用, 用来保证本进程
+      在接收其他进程发出的通知.
+
+    ``impl`` 为 :const:`None` 则卸下当前的实现. 目前的实现见
+    :mod:`luohua.rt.cachesync`.
+
+    '''
+
+    _COHERENCE[:] = [impl] if impl is not None else []
+
+
+def get_cache_coherence():
+    '''返回当前装上的跨进程缓存失效通知实现, 没有则返回 :const:`None`.'''
+
+    return _COHERENCE[0] if _COHERENCE else None
+
+
+def cache_stats():
+    '''返回当前进程中所有文档缓存的统计数据.
+
+    :return: struct_id 到统计数据的映射, 统计数据格式见
+            :meth:`DocumentCache.stats`.
+    :rtype: dict
+
+    '''
+
+    return {
+            struct_id: cache.stats()
+            for struct_id, cache in six.iteritems(_CACHES)
+            if cache is not None
+            }
+
+
+def _smart_continuation(continuation):
+    '''把 2i 查询返回的 continuation 转换为文本, 以便传给客户端.'''
+
+    return smartstr(continuation) if continuation is not None else None
+
+
+def iter_index(conn, idx, start, end=None, return_terms=False, page_size=None):
+    '''逐页读取一个 2i 查询的全部结果, 不一次性把所有结果堆在内存里.
+
+    :param conn: 数据库连接.
+    :type conn: :class:`RiakBucket <riak.bucket.RiakBucket>`
+    :param idx: 索引名.
+    :param start: 索引值, 范围查询时为起始值.
+    :param end: 范围查询的结束值, 精确查询时为 :const:`None`.
+    :param return_terms: 是否同时返回索引值. 为真时每项结果是
+            ``(索引值, 文档 ID)``, 否则只有文档 ID.
+    :type return_terms: bool
+    :param page_size: 每页条数, 默认为 :data:`INDEX_PAGE_SIZE`.
+    :type page_size: int
+    :return: 查询结果的迭代器.
+    :rtype: :data:`types.GeneratorType`
+
+    '''
+
+    continuation = None
+    while True:
+        page = conn.get_index(
+                idx,
+                start,
+                end,
+                return_terms=return_terms or None,
+                max_results=page_size or INDEX_PAGE_SIZE,
+                continuation=continuation,
+                )
+
+        for result in page.results:
+            yield result
+
+        continuation = page.continuation
+        if not continuation:
+            return
+
+
 class RiakDocument(Document):
     '''存储于 Riak 的对象公共包装.
 
@@ -41,6 +395,13 @@ class RiakDocument(Document):
     # 并实现 _do_sync_2i 方法
     uses_2i = False
 
+    # 进程内缓存的条目存活时间, 单位为秒; 为 None 则不缓存.
+    # 读多写少的类型可以在子类里打开
+    cache_ttl = None
+
+    # 进程内缓存最多容纳的对象个数
+    cache_size = DEFAULT_CACHE_SIZE
+
     def __init__(self, data=None, key=None, rawobj=None):
         super(RiakDocument, self).__init__()
 
@@ -52,7 +413,47 @@ class RiakDocument(Document):
 
         self._rawobj = rawobj
 
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, LazyField):
+            value = value.resolve()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *args):
+        value = dict.pop(self, key, *args)
+        return value.resolve() if isinstance(value, LazyField) else value
+
+    def _resolve_lazy_fields(self):
+        '''转换所有还没转换的延迟字段 (:class:`LazyField`).'''
+
+        for key, value in list(dict.items(self)):
+            if isinstance(value, LazyField):
+                dict.__setitem__(self, key, value.resolve())
+
+    # 这些方法会直接接触到字段值, 需要先把延迟字段都转换掉
+    items = _resolving('items')
+    values = _resolving('values')
+    copy = _resolving('copy')
+    popitem = _resolving('popitem')
+    setdefault = _resolving('setdefault')
+    __eq__ = _resolving('__eq__')
+    __ne__ = _resolving('__ne__')
+
+    if six.PY2:
+        iteritems = _resolving('iteritems')
+        itervalues = _resolving('itervalues')
+        viewitems = _resolving('viewitems')
+        viewvalues = _resolving('viewvalues')
+
     def __repr__(self):
+        self._resolve_lazy_fields()
         return '<RiakDocument {1} raw={2}>'.format(
                 self.struct_id,
                 super(RiakDocument, self).__repr__(),
@@ -65,13 +466,97 @@ class RiakDocument(Document):
 
         return cls(obj.data, obj.key, obj) if obj.exists else None
 
+    @classmethod
+    def _get_cache(cls):
+        '''返回本类文档所用的缓存, 未启用缓存则返回 :const:`None`.'''
+
+        try:
+            return _CACHES[cls.struct_id]
+        except KeyError:
+            pass
+
+        cache = None
+        if cls.cache_ttl is not None:
+            cache = DocumentCache(cls.cache_ttl, cls.cache_size)
+
+        _CACHES[cls.struct_id] = cache
+        return cache
+
+    @classmethod
+    def _invalidate_cached(cls, key, vclock=None):
+        cache = cls._get_cache()
+        hooked = cls.struct_id in _INVALIDATION_HOOKS
+        if cache is None and not hooked:
+            return
+
+        key = smartstr(key)
+        if cache is not None:
+            cache.invalidate(key)
+        _run_invalidation_hooks(cls.struct_id, key)
+
+        # 通知其他进程
+        if _COHERENCE:
+            _COHERENCE[0].publish(cls.struct_id, key, encode_vclock(vclock))
+
+    @classmethod
+    def _fetch_one(cls, conn, key, timeout=None):
+        '''使用给定的数据库连接获取一个对象, 启用了缓存的话先查缓存.
+
+        这是内部方法, 外界不应直接使用.
+
+        '''
+
+        cache = cls._get_cache()
+        if cache is None:
+            return cls._from_obj(_get_with_timeout(conn, timeout, key))
+
+        if _COHERENCE:
+            _COHERENCE[0].ensure_listening()
+
+        key = smartstr(key)
+        entry = cache.get(key)
+        if entry is not None:
+            # 缓存的是数据库里的原始数据和 vclock. 每次都重新构造一个 Riak
+            # 对象, 免得不同请求改到同一份数据; 带上 vclock 则保证对缓存
+            # 得来的对象执行保存或删除操作时, 行为和直接读取的对象一样
+            data, vclock = entry
+            obj = conn.new(smartbytes(key), copy.deepcopy(data))
+            obj.vclock = vclock
+            return cls(obj.data, key, obj)
+
+        obj = _get_with_timeout(conn, timeout, key)
+        if obj.exists:
+            cache.put(key, (copy.deepcopy(obj.data), obj.vclock, ))
+
+        return cls._from_obj(obj)
+
+    @classmethod
+    def _do_bulk_fetch(cls, conn, keys, concurrency=None, timeout=None):
+        '''使用给定的数据库连接并发获取多个对象, 按 ``keys`` 的顺序逐个返回.
+
+        同时进行的请求数不超过 ``concurrency``, 默认为
+        :data:`BULK_FETCH_CONCURRENCY`. 每个请求最多等待 ``timeout`` 秒,
+        超时则抛 :exc:`FetchTimeoutError` 异常. 不存在的对象对应位置返回
+        :const:`None`. 这是内部方法, 外界不应直接使用.
+
+        '''
+
+        pool = Pool(concurrency or BULK_FETCH_CONCURRENCY)
+        getter = functools.partial(cls._fetch_one, conn, timeout=timeout)
+        try:
+            # imap 保证结果顺序与输入顺序一致
+            for obj in pool.imap(getter, keys):
+                yield obj
+        finally:
+            # 调用方提前放弃迭代的话, 就不要再让剩下的请求白跑了
+            pool.kill()
+
     @classmethod
     def _do_fetch_by_index(cls, idx, key):
         with cls.storage as conn:
             page = conn.get_index(smartbytes(idx), smartbytes(key))
-            for obj_key in page.results:
-                obj = conn.get(obj_key)
-                yield cls._from_obj(obj)
+            for obj in cls._do_bulk_fetch(conn, page.results):
+                yield obj
 
     @classmethod
     def _do_fetch_one_by_index(cls, idx, key):
@@ -92,9 +577,84 @@ class RiakDocument(Document):
     def _do_fetch_range_by_index(cls, idx, start, end):
         with cls.storage as conn:
             page = conn.get_index(smartbytes(idx), start, end)
-            for obj_key in page.results:
-                obj = conn.get(obj_key)
-                yield cls._from_obj(obj)
+            for obj in cls._do_bulk_fetch(conn, page.results):
+                yield obj
+
+    @classmethod
+    def _do_fetch_range_page_by_index(
+            cls,
+            idx,
+            start,
+            end,
+            max_results,
+            continuation=None,
+            ):
+        '''分页进行 2i 范围查询, 每次最多取回 ``max_results`` 个对象.
+
+        结果按索引值排序. 首页的 ``continuation`` 传 :const:`None`,
+        之后每页传入上一页返回的 continuation 即可.
+
+        :return: ``(对象列表, 下一页的 continuation)``; 如果已经是最后一页,
+                continuation 为 :const:`None`.
+        :rtype: tuple
+
+        '''
+
+        with cls.storage as conn:
+            page = conn.get_index(
+                    smartbytes(idx),
+                    start,
+                    end,
+                    max_results=max_results,
+                    continuation=(
+                        smartbytes(continuation)
+                        if continuation is not None
+                        else None
+                        ),
+                    )
+            objs = list(cls._do_bulk_fetch(conn, page.results))
+
+            return objs, _smart_continuation(page.continuation)
+
+    @classmethod
+    def _do_fetch_range_terms_page_by_index(
+            cls,
+            idx,
+            start,
+            end,
+            max_results,
+            continuation=None,
+            ):
+        '''分页进行 2i 范围查询, 只返回索引值和文档 ID, 不读取对象本身.
+
+        适用于把少量数据直接编码进索引值的场合. 分页方式与
+        :meth:`._do_fetch_range_page_by_index` 相同.
+
+        :return: ``([(索引值, 文档 ID), ...], 下一页的 continuation)``;
+                如果已经是最后一页, continuation 为 :const:`None`.
+        :rtype: tuple
+
+        '''
+
+        with cls.storage as conn:
+            page = conn.get_index(
+                    smartbytes(idx),
+                    start,
+                    end,
+                    return_terms=True,
+                    max_results=max_results,
+                    continuation=(
+                        smartbytes(continuation)
+                        if continuation is not None
+                        else None
+                        ),
+                    )
+
+            results = [
+                    (smartstr(term), smartstr(key))
+                    for term, key in page.results
+                    ]
+            return results, _smart_continuation(page.continuation)
 
     @classmethod
     def fetch(cls, key):
@@ -110,27 +670,63 @@ class RiakDocument(Document):
 
         # XXX 这个方法不能叫 get, 因为那样会覆盖掉 dict 的 get 方法!
         with cls.storage as conn:
-            obj = conn.get(key)
-            return cls._from_obj(obj)
+            return cls._fetch_one(conn, key)
 
     @classmethod
-    def fetch_multiple(cls, keys):
+    def fetch_multiple(cls, keys, concurrency=None, timeout=None):
         '''按文档 ID 列表一次性获取多个被包装对象.
 
+        各对象的读取请求是并发进行的, 但结果仍然按 ``keys`` 的顺序返回;
+        不存在的对象对应位置为 :const:`None`.
+
         :param keys: 要获取对象的文档 ID 列表.
         :type keys: list
+        :param concurrency: 同时进行的读取请求数上限, 默认为
+                :data:`BULK_FETCH_CONCURRENCY`.
+        :type concurrency: int
+        :param timeout: 单个读取请求的时间限制, 单位为秒; 默认不限时.
+        :type timeout: float
         :return: 按顺序返回指定对象的迭代器.
         :rtype: :data:`types.GeneratorType`
+        :raises FetchTimeoutError: 某个对象读取超时.
 
         '''
 
         with cls.storage as conn:
-            for key in keys:
-                yield cls._from_obj(conn.get(key))
+            for obj in cls._do_bulk_fetch(conn, keys, concurrency, timeout):
+                yield obj
 
     @classmethod
-    def find_all(cls):
-        '''一次性获取所有被包装对象.
+    def fetch_multiple_split(cls, keys, concurrency=None, timeout=None):
+        '''按文档 ID 列表一次性获取多个被包装对象, 并单独报告不存在的 ID.
+
+        参数含义与 :meth:`.fetch_multiple` 相同.
+
+        :return: ``(存在的对象列表, 不存在的文档 ID 列表)``, 两个列表都保持
+                ``keys`` 中的相对顺序.
+        :rtype: tuple
+        :raises FetchTimeoutError: 某个对象读取超时.
+
+        '''
+
+        keys = list(keys)
+        found, missing = [], []
+        objs = cls.fetch_multiple(keys, concurrency, timeout)
+        for key, obj in six.moves.zip(keys, objs):
+            if obj is None:
+                missing.append(key)
+            else:
+                found.append(obj)
+
+        return found, missing
+
+    @classmethod
+    def find_all(cls, concurrency=None, timeout=None):
+        '''获取所有被包装对象.
+
+        文档 ID 以流的形式从数据库取回, 随即并发读取对应的对象, 不会先把
+        整个 bucket 的 ID 列表堆在内存里. 参数含义与 :meth:`.fetch_multiple`
+        相同.
 
         :return: 按顺序返回对象的迭代器.
         :rtype: :data:`types.GeneratorType`
@@ -138,8 +734,11 @@ class RiakDocument(Document):
         '''
 
         with cls.storage as conn:
-            for key in conn.get_keys():
-                yield cls._from_obj(conn.get(key))
+            keys = itertools.chain.from_iterable(conn.stream_keys())
+            for obj in cls._do_bulk_fetch(conn, keys, concurrency, timeout):
+                # 流式列举 key 的时候可能列出刚被删除的对象, 跳过
+                if obj is not None:
+                    yield obj
 
     @classmethod
     def fetch_fts(cls, expression):
@@ -217,6 +816,9 @@ class RiakDocument(Document):
         # 刷新对象关联信息
         self['id'], self._rawobj = smartstr(obj.key), obj
 
+        # 缓存里的旧版本作废
+        self._invalidate_cached(self['id'], obj.vclock)
+
     def save(self):
         '''保存对象到数据库.
 
@@ -249,6 +851,7 @@ class RiakDocument(Document):
 
             self._rawobj.delete()
             self._rawobj = None
+            self._invalidate_cached(self['id'])
             del self['id']
 
 
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 工具 / 快速数制转换
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'encode36',
+        'encode62',
+        'encode36_fixed',
+        'encode62_fixed',
+        'encode36_many',
+        'encode62_many',
+        'encode36_fixed_many',
+        'encode62_fixed_many',
+        'decode36',
+        'decode62',
+        'decode36_many',
+        'decode62_many',
+        ]
+
+import six
+
+from .radices import BASE36_MAP, BASE62_MAP
+
+# 这里的函数与 luohua.utils.radices 中的对应函数结果相同, 但是针对生成 ID
+# 这样的热点路径做了优化:
+#
+# * 预先算好所有两位数码组合的表, 每次循环处理两位, 循环次数减半;
+# * 定宽版本从右往左直接填进定长列表, 不需要最后再反转;
+# * 批量版本把查表用的对象绑定到局部变量, 省掉每个元素的全局查找.
+#
+# 解码只接受规范的输入 (没有空白和正负号), 需要宽松解析的场合仍然应该用
+# radices 中的函数.
+
+PAIRS36 = [a + b for a in BASE36_MAP for b in BASE36_MAP]
+PAIRS62 = [a + b for a in BASE62_MAP for b in BASE62_MAP]
+PAIR_BASE36 = 36 * 36
+PAIR_BASE62 = 62 * 62
+
+INVERSE_PAIRS62 = {pair: i for i, pair in enumerate(PAIRS62)}
+INVERSE_MAP62 = {ch: i for i, ch in enumerate(BASE62_MAP)}
+
+# (进制, 宽度) -> 该宽度能表示的数的上限
+_FIXED_LIMITS = {}
+
+
+def _encode(x, pairs, pair_base):
+    if x < 0:
+        return '-' + _encode(-x, pairs, pair_base)
+
+    if x < pair_base:
+        # 只有一组数码, 去掉可能的前导零
+        pair = pairs[x]
+        return pair[1] if pair[0] == '0' else pair
+
+    parts = []
+    while x:
+        x, r = divmod(x, pair_base)
+        parts.append(pairs[r])
+    parts.reverse()
+
+    # 只有最高一组可能带前导零
+    result = ''.join(parts)
+    return result[1:] if result[0] == '0' else result
+
+
+def _fixed_limit(base, width):
+    key = (base, width, )
+    try:
+        return _FIXED_LIMITS[key]
+    except KeyError:
+        pass
+
+    if width <= 0:
+        raise ValueError('width must be positive: %d' % (width, ))
+
+    limit = _FIXED_LIMITS[key] = base ** width
+    return limit
+
+
+def _encode_fixed(x, width, pairs, pair_base, limit):
+    if not 0 <= x < limit:
+        raise ValueError(
+                'cannot encode %d in %d digit(s)' % (x, width, )
+                )
+
+    if x < pair_base:
+        # 只有一组数码, 计数器之类的小数最常见的情形
+        pair = pairs[x]
+        if width <= 2:
+            return pair[2 - width:]
+        return '0' * (width - 2) + pair
+
+    # 从最低一组开始往左填, 不需要最后再反转
+    i = (width + 1) // 2
+    parts = [pairs[0]] * i
+    while x:
+        i -= 1
+        x, r = divmod(x, pair_base)
+        parts[i] = pairs[r]
+
+    # 宽度为奇数时最高一组多出一位零
+    result = ''.join(parts)
+    return result[1:] if width & 1 else result
+
+
+def encode36(x):
+    '''把一个整数转换为 36 进制字符串, 与 :func:`radices.to36
+    <luohua.utils.radices.to36>` 结果相同.
+
+    '''
+
+    return _encode(x, PAIRS36, PAIR_BASE36)
+
+
+def encode62(x):
+    '''把一个整数转换为 62 进制字符串, 与 :func:`radices.to62
+    <luohua.utils.radices.to62>` 结果相同.
+
+    '''
+
+    return _encode(x, PAIRS62, PAIR_BASE62)
+
+
+def encode36_fixed(x, width):
+    '''把一个非负整数转换为定宽的 36 进制字符串, 不足的位数补零.
+
+    定宽的字符串按字典序比较与按数值比较的结果一致, 适合用作 ID 的组成\
+    部分. 宽度不够表示 ``x`` 时抛 :exc:`ValueError` 异常.
+
+    '''
+
+    limit = _fixed_limit(36, width)
+    return _encode_fixed(x, width, PAIRS36, PAIR_BASE36, limit)
+
+
+def encode62_fixed(x, width):
+    '''把一个非负整数转换为定宽的 62 进制字符串, 不足的位数补零.
+
+    见 :func:`encode36_fixed`.
+
+    '''
+
+    limit = _fixed_limit(62, width)
+    return _encode_fixed(x, width, PAIRS62, PAIR_BASE62, limit)
+
+
+def encode36_many(xs):
+    '''对一组整数逐个执行 :func:`encode36`, 返回列表.'''
+
+    encode, pairs, pair_base = _encode, PAIRS36, PAIR_BASE36
+    return [encode(x, pairs, pair_base) for x in xs]
+
+
+def encode62_many(xs):
+    '''对一组整数逐个执行 :func:`encode62`, 返回列表.'''
+
+    encode, pairs, pair_base = _encode, PAIRS62, PAIR_BASE62
+    return [encode(x, pairs, pair_base) for x in xs]
+
+
+def encode36_fixed_many(xs, width):
+    '''对一组整数逐个执行 :func:`encode36_fixed`, 返回列表.'''
+
+    limit = _fixed_limit(36, width)
+    encode, pairs, pair_base = _encode_fixed, PAIRS36, PAIR_BASE36
+    return [encode(x, width, pairs, pair_base, limit) for x in xs]
+
+
+def encode62_fixed_many(xs, width):
+    '''对一组整数逐个执行 :func:`encode62_fixed`, 返回列表.'''
+
+    limit = _fixed_limit(62, width)
+    encode, pairs, pair_base = _encode_fixed, PAIRS62, PAIR_BASE62
+    return [encode(x, width, pairs, pair_base, limit) for x in xs]
+
+
+def decode36(s):
+    '''把一个 36 进制字符串转换为整数.
+
+    ``int()`` 本身就支持 36 进制, 这里只是为了接口完整.
+
+    '''
+
+    return int(s, 36)
+
+
+def _decode62(s, inverse_pairs, inverse_map):
+    if s[:1] == '-':
+        return -_decode62(s[1:], inverse_pairs, inverse_map)
+
+    try:
+        n = len(s)
+        if not n:
+            raise KeyError(s)
+
+        # 奇数长度时先处理最高一位, 剩下的两位两位地处理
+        start = n & 1
+        result = inverse_map[s[0]] if start else 0
+        for i in six.moves.range(start, n, 2):
+            result = result * PAIR_BASE62 + inverse_pairs[s[i:i + 2]]
+    except KeyError:
+        # 故意模仿 Python int() 的错误信息
+        raise ValueError('invalid literal for int() with base 62: ' + repr(s))
+
+    return result
+
+
+def decode62(s):
+    '''把一个规范的 62 进制字符串转换为整数.
+
+    与 :func:`radices.from62 <luohua.utils.radices.from62>` 不同, 不接受\
+    空白和正号.
+
+    '''
+
+    return _decode62(s, INVERSE_PAIRS62, INVERSE_MAP62)
+
+
+def decode36_many(ss):
+    '''对一组字符串逐个执行 :func:`decode36`, 返回列表.'''
+
+    return [int(s, 36) for s in ss]
+
+
+def decode62_many(ss):
+    '''对一组字符串逐个执行 :func:`decode62`, 返回列表.'''
+
+    decode, inverse_pairs, inverse_map = (
+            _decode62,
+            INVERSE_PAIRS62,
+            INVERSE_MAP62,
+            )
+    return [decode(s, inverse_pairs, inverse_map) for s in ss]
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# 落花 / 辅助组件 / Redis 连接池
+#
+# Copyright (C) 2013-2014 JNRain
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import unicode_literals, division
+
+__all__ = [
+        'REDIS_CONFIG_REGISTRY',
+        'PooledRedis',
+        'RedisPoolManager',
+        'pool_mgr',
+        'get_client',
+        'get_pubsub_client',
+        ]
+
+import os
+import time
+
+import gevent
+import redis
+
+from weiyu import registry
+from weiyu.db import db_hub
+
+REDIS_CONFIG_REGISTRY = 'luohua.redis'
+
+# 没有配置 luohua.redis 时使用的默认值
+DEFAULT_CONFIG = {
+        # 每个 Redis 库的连接数上限, 用完之后调用方会等待
+        'max_connections': 50,
+        # 等待空闲连接的最长时间, 单位: 秒; 超时抛 redis.ConnectionError
+        'pool_timeout': 5,
+        'socket_timeout': 5,
+        'socket_connect_timeout': 2,
+        # 连接闲置超过这个时间后, 下次使用前先 PING 一下, 单位: 秒
+        'health_check_interval': 30,
+        # 后台健康检查的间隔, 单位: 秒
+        'health_check_period': 15,
+        # 连接失败时的重试次数和退避时间, 单位: 秒
+        'max_retries': 3,
+        'retry_backoff': 0.1,
+        'retry_backoff_max': 2,
+        }
+
+
+def _read_config():
+    config = dict(DEFAULT_CONFIG)
+    try:
+        config.update(registry.request(REDIS_CONFIG_REGISTRY))
+    except KeyError:
+        pass
+
+    return config
+
+
+class PooledRedis(redis.StrictRedis):
+    '''连接失败时按指数退避自动重试的 StrictRedis.
+
+    只重试 :exc:`redis.ConnectionError`. 超时的命令可能已经执行过了,
+    重试会让 ``INCR`` 之类的命令执行两次, 所以 :exc:`redis.TimeoutError`
+    照常抛出.
+
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.pool_stats = kwargs.pop('pool_stats')
+        self.max_retries = kwargs.pop('max_retries')
+        self.retry_backoff = kwargs.pop('retry_backoff')
+        self.retry_backoff_max = kwargs.pop('retry_backoff_max')
+        super(PooledRedis, self).__init__(*args, **kwargs)
+
+    def execute_command(self, *args, **options):
+        attempts = 0
+        while True:
+            try:
+                return super(PooledRedis, self).execute_command(
+                        *args,
+                        **options
+                        )
+            except redis.TimeoutError:
+                self.pool_stats['errors'] += 1
+                raise
+            except redis.ConnectionError:
+                self.pool_stats['errors'] += 1
+                if attempts >= self.max_retries:
+                    raise
+
+            delay = min(
+                    self.retry_backoff * (2 ** attempts),
+                    self.retry_backoff_max,
+                    )
+            attempts += 1
+            self.pool_stats['retries'] += 1
+            time.sleep(delay)
+
+
+class RedisPoolManager(object):
+    '''按存储 ID 提供共享连接池的 Redis 客户端.
+
+    存储配置指向同一个 Redis 库的存储 ID 共用一个连接池, 而不是像
+    ``storage.raw()`` 那样每处各自缓存一个客户端. 连接池的大小和超时设置
+    读自 ``luohua.redis`` 配置项, 缺省值见 :data:`DEFAULT_CONFIG`.
+
+    连接池本身会在 fork 之后自动重建, 所以在 gunicorn 的 master 进程里
+    取得的客户端对象在 worker 进程里仍然可以用.
+
+    '''
+
+    def __init__(self):
+        # 这么写是为了防止在模块 import 时做出真正的初始化动作
+        self._config = None
+        # (库名, 库序号) -> (客户端, 统计)
+        self._pools = {}
+        self._pubsub_pools = {}
+        # 存储 ID -> (库名, 库序号)
+        self._storage_map = {}
+        self._checker_pid = None
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = _read_config()
+        return self._config
+
+    def _resolve(self, storage_id):
+        try:
+            return self._storage_map[storage_id]
+        except KeyError:
+            pass
+
+        storage_conf = db_hub.get_storage_conf(storage_id)
+        pool_key = (storage_conf['db'], storage_conf['bucket'], )
+        self._storage_map[storage_id] = pool_key
+        return pool_key
+
+    def _make_pool_kwargs(self, pool_key):
+        db_name, bucket = pool_key
+        drv = db_hub.get_database(db_name)
+        config = self.config
+
+        kwargs = dict(drv.options)
+        kwargs.update({
+                'host': drv.host,
+                'port': drv.port,
+                'db': bucket,
+                'socket_timeout': config['socket_timeout'],
+                'socket_connect_timeout': config['socket_connect_timeout'],
+                'socket_keepalive': True,
+                'health_check_interval': config['health_check_interval'],
+                })
+        return kwargs
+
+    def _make_client(self, pool, stats):
+        config = self.config
+        return PooledRedis(
+                connection_pool=pool,
+                pool_stats=stats,
+                max_retries=config['max_retries'],
+                retry_backoff=config['retry_backoff'],
+                retry_backoff_max=config['retry_backoff_max'],
+                )
+
+    def _new_stats(self):
+        return {
+                'errors': 0,
+                'retries': 0,
+                'health_checks': 0,
+                'health_failures': 0,
+                'healthy': None,
+                'last_ping_ms': None,
+                }
+
+    def get_client(self, storage_id):
+        '''取得给定存储 ID 对应的 Redis 客户端.
+
+        所有客户端共享有上限的连接池, 连接用完后调用方会等待至多
+        ``pool_timeout`` 秒. 长期占用连接的 PubSub 订阅请使用
+        :meth:`get_pubsub_client`.
+
+        '''
+
+        pool_key = self._resolve(storage_id)
+        try:
+            return self._pools[pool_key][0]
+        except KeyError:
+            pass
+
+        pool = redis.BlockingConnectionPool(
+                max_connections=self.config['max_connections'],
+                timeout=self.config['pool_timeout'],
+                **self._make_pool_kwargs(pool_key)
+                )
+        stats = self._new_stats()
+        client = self._make_client(pool, stats)
+        self._pools[pool_key] = (client, stats, )
+        return client
+
+    def get_pubsub_client(self, storage_id):
+        '''取得用于 PubSub 订阅的 Redis 客户端.
+
+        订阅会一直占着一个连接, 放进有上限的连接池会把别的请求饿死,
+        所以订阅用的客户端单独使用一个不限数量的连接池. 发布消息是普通命令,
+        请用 :meth:`get_client`.
+
+        '''
+
+        pool_key = self._resolve(storage_id)
+        try:
+            return self._pubsub_pools[pool_key][0]
+        except KeyError:
+            pass
+
+        kwargs = self._make_pool_kwargs(pool_key)
+        # 订阅连接要一直阻塞着等消息, 不能有读超时
+        kwargs['socket_timeout'] = None
+        pool = redis.ConnectionPool(**kwargs)
+        stats = self._new_stats()
+        client = self._make_client(pool, stats)
+        self._pubsub_pools[pool_key] = (client, stats, )
+        return client
+
+    def _pool_stats(self, client, stats):
+        pool = client.connection_pool
+        result = dict(stats)
+
+        # 以下用到了 redis-py 连接池的内部属性, 升级 redis-py 时需要留意
+        if isinstance(pool, redis.BlockingConnectionPool):
+            created = len(pool._connections)
+            idle = sum(1 for conn in list(pool.pool.queue) if conn is not None)
+            result['max_connections'] = pool.max_connections
+        else:
+            created = pool._created_connections
+            idle = len(pool._available_connections)
+            result['max_connections'] = None
+
+        result['created'] = created
+        result['idle'] = idle
+        result['in_use'] = created - idle
+        return result
+
+    def stats(self):
+        '''返回各连接池的使用情况.
+
+        键名是 ``'库名/库序号'``, 订阅用的连接池再加上 ``' (pubsub)'`` 的后缀.
+        每个值包含已建立的连接数 ``created``, 其中空闲的 ``idle`` 和使用中的
+        ``in_use`` 数目, 上限 ``max_connections``, 连接错误与重试次数, 以及
+        最近一次健康检查的结果.
+
+        '''
+
+        result = {}
+        all_pools = (
+                ('', self._pools),
+                (' (pubsub)', self._pubsub_pools),
+                )
+        for suffix, pools in all_pools:
+            for (db_name, bucket), (client, stats) in pools.items():
+                name = '{0}/{1}{2}'.format(db_name, bucket, suffix)
+                result[name] = self._pool_stats(client, stats)
+
+        return result
+
+    def check_health(self):
+        '''对每个普通连接池 PING 一次, 更新统计信息. 返回是否全部正常.'''
+
+        all_ok = True
+        for client, stats in list(self._pools.values()):
+            stats['health_checks'] += 1
+            start = time.time()
+            try:
+                client.ping()
+            except (redis.ConnectionError, redis.TimeoutError):
+                # 连不上的时候丢掉池中的连接, 恢复之后重新建立
+                client.connection_pool.disconnect()
+                stats['health_failures'] += 1
+                stats['healthy'] = False
+                all_ok = False
+                continue
+
+            stats['healthy'] = True
+            stats['last_ping_ms'] = (time.time() - start) * 1000
+
+        return all_ok
+
+    def ensure_health_checks(self):
+        '''保证本进程中有定期检查连接池的 greenlet 在运行.'''
+
+        # 按进程号判断, 这样 fork 出来的 worker 进程也会启动自己的检查
+        pid = os.getpid()
+        if self._checker_pid == pid:
+            return
+
+        self._checker_pid = pid
+        gevent.spawn(self._check_forever)
+
+    def _check_forever(self):
+        while True:
+            gevent.sleep(self.config['health_check_period'])
+            self.check_health()
+
+
+pool_mgr = RedisPoolManager()
+
+
+def get_client(storage_id):
+    '''取得给定存储 ID 对应的共享 Redis 客户端. 见
+    :meth:`RedisPoolManager.get_client`.
+
+    '''
+
+    return pool_mgr.get_client(storage_id)
+
+
+def get_pubsub_client(storage_id):
+    '''取得给定存储 ID 对应的 PubSub 订阅用 Redis 客户端. 见
+    :meth:`RedisPoolManager.get_pubsub_client`.
+
+    '''
+
+    return pool_mgr.get_pubsub_client(storage_id)
+
+
+# vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
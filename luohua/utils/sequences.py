@@ -30,12 +30,27 @@ __all__ = [
         'time_descending_short_suffixed',
         'ascending_ts',
         'descending_ts',
+        'UniqueIDAllocator',
+        'time_ascending_unique',
+        'time_descending_unique',
+        'time_ascending_ms',
+        'time_descending_ms',
+        'time_ascending_ms_bulk',
+        'time_descending_ms_bulk',
         ]
 
+import logging
+import os
+import socket
 import time
 import random
 
-from .radices import to36, to62
+import six
+
+from .radixcodec import encode36, encode36_fixed, encode62
+from . import redispool
+
+_LOGGER = logging.getLogger(__name__)
 
 # 这是 UTC 时间 3058/10/26 03:46:08, 一千多年之后还会有人在用这个软件么...
 # 抛开感伤, 这只是实现递减时间戳必须给定的一个 "时间尽头" 而已, 给到这个程度
@@ -47,6 +62,45 @@ TIMESTAMP_LIMIT = 1 << 35
 
 PRNG = random.SystemRandom()
 
+# 唯一 ID 中工作进程号和计数器各占的 36 进制位数
+# 毫秒精度的 ID 每个时间单位短得多, 计数器少用一位
+UNIQUE_WORKER_ID_DIGITS = 3
+UNIQUE_COUNTER_DIGITS = 3
+UNIQUE_MS_COUNTER_DIGITS = 2
+UNIQUE_WORKER_ID_LIMIT = 36 ** UNIQUE_WORKER_ID_DIGITS
+UNIQUE_COUNTER_LIMIT = 36 ** UNIQUE_COUNTER_DIGITS
+
+# 分配工作进程号用的 Redis 库. 计数器只是一个起点提示, 真正保证不冲突的是\
+# 每个号码上的租约 seq:worker:<号码>
+SEQUENCES_STORAGE_ID = 'luohua.sequences'
+WORKER_ID_COUNTER_KEY = 'seq:worker'
+WORKER_LEASE_KEY_FORMAT = 'seq:worker:%d'
+
+# 工作进程号租约的有效期, 以及使用号码前距上次续租超过多久就先续租,
+# 单位: 秒. 续租间隔要比有效期短得多, 留出余量给 Redis 的往返. Redis 被清空
+# 或重启后, 持有者要到下次续租时才会重新占上自己的号码, 期间新启动的进程\
+# 仍可能拿到同一个号码, 所以续租间隔也不宜太长
+WORKER_LEASE_SECS = 60
+WORKER_LEASE_RENEW_SECS = 20
+
+# 续租: 租约还是自己的就延长; 租约已经没了 (过期, 或者 Redis 被清空/重启)
+# 就重新占上; 被别人占了则返回 0
+_RENEW_LEASE_SCRIPT = '''
+local holder = redis.call('GET', KEYS[1])
+if holder == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+if not holder then
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return 1
+end
+return 0
+'''
+
+# [pid, 工作进程号, 租约标识, 上次续租的时间]
+_WORKER_ID = []
+
 
 def _get_suffix():
     '''生成一个随机后缀字符串.'''
@@ -58,14 +112,14 @@ def time_ascending(timestamp=None):
     '''生成一个随时间推移而比较顺序递增的字符串.'''
 
     ts_actual = timestamp if timestamp is not None else int(time.time())
-    return to36(ts_actual)
+    return encode36(ts_actual)
 
 
 def time_descending(timestamp=None):
     '''生成一个随时间推移而比较顺序递减的字符串.'''
 
     ts_actual = timestamp if timestamp is not None else int(time.time())
-    return to36(TIMESTAMP_LIMIT - ts_actual)
+    return encode36(TIMESTAMP_LIMIT - ts_actual)
 
 
 def time_ascending_suffixed(timestamp=None):
@@ -84,14 +138,14 @@ def time_ascending_short(timestamp=None):
     '''生成一个简短的随时间推移而比较顺序递增的字符串.'''
 
     ts_actual = timestamp if timestamp is not None else int(time.time())
-    return to62(ts_actual)
+    return encode62(ts_actual)
 
 
 def time_descending_short(timestamp=None):
     '''生成一个简短的随时间推移而比较顺序递减的字符串.'''
 
     ts_actual = timestamp if timestamp is not None else int(time.time())
-    return to62(TIMESTAMP_LIMIT - ts_actual)
+    return encode62(TIMESTAMP_LIMIT - ts_actual)
 
 
 def time_ascending_short_suffixed(timestamp=None):
@@ -120,4 +174,315 @@ def descending_ts(timestamp=None):
             )
 
 
+def _claim_worker_id(token):
+    '''占用一个没有被别的进程持有租约的工作进程号.
+
+    从 Redis 计数器给出的号码开始往后找, 跳过租约还在别人手里的号码.
+
+    :raises RuntimeError: 所有号码都被占用.
+
+    '''
+
+    client = redispool.get_client(SEQUENCES_STORAGE_ID)
+    first = client.incr(WORKER_ID_COUNTER_KEY) - 1
+    for i in six.moves.range(UNIQUE_WORKER_ID_LIMIT):
+        worker_id = (first + i) % UNIQUE_WORKER_ID_LIMIT
+        claimed = client.set(
+                WORKER_LEASE_KEY_FORMAT % worker_id,
+                token,
+                nx=True,
+                ex=WORKER_LEASE_SECS,
+                )
+        if claimed:
+            return worker_id
+
+    raise RuntimeError('no free worker id')
+
+
+def _renew_worker_lease(worker_id, token):
+    '''续租, 租约已被别的进程占用时返回 :const:`False`.'''
+
+    client = redispool.get_client(SEQUENCES_STORAGE_ID)
+    script = client.register_script(_RENEW_LEASE_SCRIPT)
+    renewed = script(
+            keys=[WORKER_LEASE_KEY_FORMAT % worker_id, ],
+            args=[token, WORKER_LEASE_SECS, ],
+            )
+    return bool(renewed)
+
+
+def _get_worker_id():
+    '''返回本进程持有租约的工作进程号.
+
+    进程 fork 之后会重新占用一个号码. 使用号码前如果距上次续租超过
+    :data:`WORKER_LEASE_RENEW_SECS` 就先续租; 租约在这期间被别的进程占去\
+    (例如本进程长时间闲置, 租约过期了) 的话换一个新号码.
+
+    '''
+
+    pid = os.getpid()
+    now = time.time()
+    if _WORKER_ID and _WORKER_ID[0] == pid:
+        _, worker_id, token, renewed_at = _WORKER_ID
+        if now - renewed_at < WORKER_LEASE_RENEW_SECS:
+            return worker_id
+
+        if _renew_worker_lease(worker_id, token):
+            _WORKER_ID[3] = now
+            return worker_id
+
+        _LOGGER.warning(
+                'worker id %d was taken by another process, reallocating',
+                worker_id,
+                )
+        del _WORKER_ID[:]
+
+    token = '%s:%d:%04x' % (socket.gethostname(), pid, PRNG.getrandbits(16))
+    worker_id = _claim_worker_id(token)
+
+    # 分配时可能切换了 greenlet, 别的 greenlet 已经分配过就用它的. 多占的\
+    # 号码没人续租, 租约到期后自然释放
+    if _WORKER_ID and _WORKER_ID[0] == pid:
+        return _WORKER_ID[1]
+
+    _WORKER_ID[:] = [pid, worker_id, token, now]
+    return worker_id
+
+
+class UniqueIDAllocator(object):
+    '''不需要查询数据库就能保证唯一的时间序 ID 生成器.
+
+    生成的 ID 由时间戳, 工作进程号和进程内计数器三部分组成. 工作进程号\
+    由 Redis 上会过期的租约保证同一时刻只属于一个进程, 所以不同进程之间\
+    不冲突, 计数器保证同一进程同一时间单位内不冲突; 同一\
+    进程生成的 ID 严格按时间单调. 计数器用完时借用下一个时间单位, 时钟\
+    回拨时沿用上次的时间戳, 所以 ID 中的时间可能比实际稍晚一点.
+
+    :param worker_id: 工作进程号, 取值范围为 0 到
+            :data:`UNIQUE_WORKER_ID_LIMIT` - 1. 省略则使用本进程从 Redis
+            计数器分配到的号码.
+    :type worker_id: int
+    :param millis: 为 :const:`True` 则时间戳以毫秒为单位, 否则以秒为单位.
+            毫秒精度的 ID 计数器少一位.
+    :type millis: bool
+
+    '''
+
+    def __init__(self, worker_id=None, millis=False):
+        if worker_id is not None:
+            if not 0 <= worker_id < UNIQUE_WORKER_ID_LIMIT:
+                raise ValueError('worker id out of range: %d' % worker_id)
+
+        self._fixed_worker_id = worker_id
+        self._scale = 1000 if millis else 1
+        self._counter_digits = (
+                UNIQUE_MS_COUNTER_DIGITS
+                if millis
+                else UNIQUE_COUNTER_DIGITS
+                )
+        self.counter_limit = 36 ** self._counter_digits
+        self._pid = None
+        self._last_ts = 0
+        self._counter = 0
+
+        # 最近用过的前缀, 同一时间单位内连续生成时不必重新转换进制
+        self._prefix_cache = {}
+
+        # 计数器位数少的话, 直接查表
+        self._counter_table = None
+        if self._counter_digits <= 2:
+            self._counter_table = [
+                    encode36_fixed(i, self._counter_digits)
+                    for i in six.moves.range(self.counter_limit)
+                    ]
+
+    @property
+    def worker_id(self):
+        if self._fixed_worker_id is not None:
+            return self._fixed_worker_id
+        return _get_worker_id()
+
+    def _check_fork(self):
+        # fork 出来的子进程换了进程号, 计数状态也要从头开始
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid, self._last_ts, self._counter = pid, 0, 0
+
+    def next(self, timestamp=None):
+        '''分配下一个 ID 的组成部分.
+
+        :param timestamp: 时间戳, 单位与构造时指定的一致. 省略则为当前时间.
+        :return: ``(timestamp, worker_id, counter)``
+        :rtype: tuple
+
+        '''
+
+        worker_id = self.worker_id
+        self._check_fork()
+        ts = timestamp if timestamp is not None else self._now()
+
+        # 下面没有 I/O, 不会切换 greenlet
+        if ts > self._last_ts:
+            self._last_ts, self._counter = ts, 0
+        else:
+            self._counter += 1
+            if self._counter >= self.counter_limit:
+                self._last_ts, self._counter = self._last_ts + 1, 0
+
+        return self._last_ts, worker_id, self._counter
+
+    def reserve(self, n, timestamp=None):
+        '''一次分配 ``n`` 个连续 ID 的组成部分.
+
+        :return: ``(timestamp, worker_id, first_counter, count)`` 的列表,
+                每一项是同一时间单位内计数器连续的一段, 各项按顺序排列,
+                ``count`` 之和为 ``n``.
+        :rtype: list
+
+        '''
+
+        if n <= 0:
+            return []
+
+        ts, worker_id, counter = self.next(timestamp)
+        limit = self.counter_limit
+
+        runs, remaining = [], n
+        while True:
+            take = min(remaining, limit - counter)
+            runs.append((ts, worker_id, counter, take, ))
+            remaining -= take
+            if not remaining:
+                break
+
+            ts, counter = ts + 1, 0
+
+        self._last_ts, self._counter = ts, counter + take - 1
+        return runs
+
+    def _now(self):
+        return int(time.time() * self._scale)
+
+    def _prefix(self, ts, worker_id, descending):
+        key = (descending, worker_id, )
+        cached = self._prefix_cache.get(key)
+        if cached is not None and cached[0] == ts:
+            return cached[1]
+
+        ts_value = TIMESTAMP_LIMIT * self._scale - ts if descending else ts
+        prefix = encode36(ts_value) + encode36_fixed(
+                worker_id,
+                UNIQUE_WORKER_ID_DIGITS,
+                )
+        self._prefix_cache[key] = (ts, prefix, )
+        return prefix
+
+    def _format_counter(self, counter, descending):
+        if descending:
+            counter = self.counter_limit - 1 - counter
+        if self._counter_table is not None:
+            return self._counter_table[counter]
+        return encode36_fixed(counter, self._counter_digits)
+
+    def ascending(self, timestamp=None):
+        '''生成一个唯一的, 随时间推移而比较顺序递增的字符串.'''
+
+        ts, worker_id, counter = self.next(timestamp)
+        return (
+                self._prefix(ts, worker_id, False)
+                + self._format_counter(counter, False)
+                )
+
+    def descending(self, timestamp=None):
+        '''生成一个唯一的, 随时间推移而比较顺序递减的字符串.'''
+
+        ts, worker_id, counter = self.next(timestamp)
+        return (
+                self._prefix(ts, worker_id, True)
+                + self._format_counter(counter, True)
+                )
+
+    def bulk(self, n, timestamp=None, descending=False):
+        '''一次生成 ``n`` 个唯一的, 按生成顺序排列的字符串.
+
+        结果与连续调用 ``n`` 次 :meth:`ascending` (或 :meth:`descending`)
+        相同, 但每个时间单位只需构造一次前缀, 适合导入数据, 批量写审计记录\
+        等场合.
+
+        :rtype: list
+
+        '''
+
+        result = []
+        fmt = self._format_counter
+        for ts, worker_id, first, count in self.reserve(n, timestamp):
+            prefix = self._prefix(ts, worker_id, descending)
+            result.extend(
+                    prefix + fmt(counter, descending)
+                    for counter in six.moves.range(first, first + count)
+                    )
+
+        return result
+
+
+_DEFAULT_ALLOCATOR = UniqueIDAllocator()
+_DEFAULT_MS_ALLOCATOR = UniqueIDAllocator(millis=True)
+
+
+def time_ascending_unique(timestamp=None):
+    '''生成一个唯一的, 随时间推移而比较顺序递增的字符串.
+
+    与 :func:`time_ascending_suffixed` 不同, 生成的字符串保证不会重复,
+    不需要查询数据库确认. 见 :class:`UniqueIDAllocator`.
+
+    '''
+
+    return _DEFAULT_ALLOCATOR.ascending(timestamp)
+
+
+def time_descending_unique(timestamp=None):
+    '''生成一个唯一的, 随时间推移而比较顺序递减的字符串.
+
+    见 :func:`time_ascending_unique`.
+
+    '''
+
+    return _DEFAULT_ALLOCATOR.descending(timestamp)
+
+
+def time_ascending_ms(timestamp_ms=None):
+    '''生成一个唯一的, 毫秒精度的, 随时间推移而比较顺序递增的字符串.
+
+    :param timestamp_ms: 毫秒为单位的时间戳, 省略则为当前时间.
+    :type timestamp_ms: int
+
+    '''
+
+    return _DEFAULT_MS_ALLOCATOR.ascending(timestamp_ms)
+
+
+def time_descending_ms(timestamp_ms=None):
+    '''生成一个唯一的, 毫秒精度的, 随时间推移而比较顺序递减的字符串.'''
+
+    return _DEFAULT_MS_ALLOCATOR.descending(timestamp_ms)
+
+
+def time_ascending_ms_bulk(n, timestamp_ms=None):
+    '''一次生成 ``n`` 个 :func:`time_ascending_ms` 格式的字符串,
+    按递增顺序排列.
+
+    '''
+
+    return _DEFAULT_MS_ALLOCATOR.bulk(n, timestamp_ms)
+
+
+def time_descending_ms_bulk(n, timestamp_ms=None):
+    '''一次生成 ``n`` 个 :func:`time_descending_ms` 格式的字符串,
+    按递减顺序排列.
+
+    '''
+
+    return _DEFAULT_MS_ALLOCATOR.bulk(n, timestamp_ms, True)
+
+
 # vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
@@ -21,14 +21,106 @@ from __future__ import unicode_literals, division
 
 __all__ = [
         'jsonreply',
+        'stream_jsonreply',
         'parse_form',
+        'parse_query',
         ]
 
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import six
+urlparse = six.moves.urllib.parse
+
+from weiyu.helpers.misc import smartbytes, smartstr
+
+# 流式响应每次交给 WSGI 服务器的块大小
+STREAM_BLOCK_SIZE = 16384
+
+# 流式 JSON 响应的 Content-Type. weiyu 推送原始文件时不会根据 mimetype
+# 生成这个头, 只能自己放进 headers 里
+STREAM_JSON_CONTENT_TYPE = 'application/json; charset=utf-8'
+
 
 def jsonreply(**kwargs):
     return 200, kwargs, {}
 
 
+class _ChunkReader(object):
+    '''把逐段生成的文本包装成只读的类文件对象.
+
+    weiyu 推送原始文件时会交给 WSGI 服务器的 ``wsgi.file_wrapper``,
+    后者只调用 ``read(size)`` 和 ``close()``, 所以这样就能实现流式输出.
+
+    '''
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+
+    def read(self, size=-1):
+        buf = self._buf
+        while size < 0 or len(buf) < size:
+            try:
+                buf += smartbytes(next(self._chunks))
+            except StopIteration:
+                break
+
+        if size < 0:
+            self._buf = b''
+            return buf
+
+        self._buf = buf[size:]
+        return buf[:size]
+
+    def close(self):
+        close = getattr(self._chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def _iter_json_with_list(fields, list_key, items):
+    # 先输出其他字段, 再逐个输出列表元素, 最后补上括号
+    head = json.dumps(fields)[:-1]
+    yield head + (',' if fields else '') + json.dumps(list_key) + ':['
+
+    sep = ''
+    for item in items:
+        yield sep + json.dumps(item)
+        sep = ','
+
+    yield ']}'
+
+
+def stream_jsonreply(list_key, items, **kwargs):
+    '''与 :func:`jsonreply` 类似, 但 ``list_key`` 对应的列表是逐个元素\
+    生成并输出的, 不会在内存里构造出整个响应.
+
+    ``items`` 可以是生成器, 在输出响应的过程中才会被迭代. 由于响应头已经\
+    发出, 迭代过程中出现的异常只能中断连接, 所以能提前发现的错误应该在\
+    调用本函数之前处理掉.
+
+    '''
+
+    return (
+            200,
+            {
+                'sendfile_fp': _ChunkReader(
+                    _iter_json_with_list(kwargs, list_key, items),
+                    ),
+                'blocksize': STREAM_BLOCK_SIZE,
+                },
+            {
+                'is_raw_file': True,
+                'headers': [
+                    ('Content-Type', STREAM_JSON_CONTENT_TYPE, ),
+                    ],
+                },
+            )
+
+
 def parse_form(request, *args, **kwargs):
     '''从请求对象顺序解出表单参数成 tuple.
 
@@ -43,4 +135,24 @@ def parse_form(request, *args, **kwargs):
             )
 
 
+def parse_query(request, *args, **kwargs):
+    '''从请求 URL 的查询字符串顺序解出参数成 tuple.
+
+    用法与 :func:`parse_form` 相同. 同名参数出现多次时取第一个值.
+
+    '''
+
+    query = urlparse.parse_qs(request.env.get('QUERY_STRING', ''))
+
+    def _get_param(name):
+        try:
+            return smartstr(query[name][0])
+        except KeyError:
+            if name in kwargs:
+                return kwargs[name]
+            raise
+
+    return tuple(_get_param(i) for i in args)
+
+
 # vim:set ai et ts=4 sw=4 sts=4 fenc=utf-8:
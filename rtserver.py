@@ -23,9 +23,13 @@ try:
     from weiyu import registry
     from weiyu.utils import server
 
+    from luohua.rt import cachesync
+    from luohua.utils import redispool
     from luohua.rt import state as rt_state
 
     init.inject_app()
+    cachesync.install()
+    redispool.pool_mgr.ensure_health_checks()
 except Exception:
     if SENTRY_CLIENT is not None:
         SENTRY_CLIENT.captureException()